@@ -0,0 +1,54 @@
+"""
+Per-call overhead of DatabaseManager lookups: connect-per-call vs pooled connections.
+
+    python benchmarks/bench_db_connections.py [calls]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix="bench_db_")
+os.chdir(WORKDIR)
+
+from bot.database import DatabaseManager  # noqa: E402
+
+
+def _legacy_conn(path):
+    # همان رفتار قبلی: اتصال جدید و PRAGMA ها در هر فراخوانی
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def main(calls: int = 5000) -> None:
+    path = os.path.join(WORKDIR, "bench.db")
+    db = DatabaseManager(path)
+    db.add_or_update_user(1, "bench", "Bench", None)
+    db.add_uuid(1, "00000000-0000-0000-0000-000000000001", "bench")
+    uuid_str = "00000000-0000-0000-0000-000000000001"
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        with _legacy_conn(path) as c:
+            c.execute("SELECT id FROM user_uuids WHERE uuid = ?", (uuid_str,)).fetchone()
+    legacy = (time.perf_counter() - start) / calls
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        db.get_uuid_id_by_uuid(uuid_str)
+    pooled = (time.perf_counter() - start) / calls
+
+    print(f"calls per variant : {calls}")
+    print(f"connect-per-call  : {legacy * 1e6:8.1f} us/call")
+    print(f"pooled connection : {pooled * 1e6:8.1f} us/call")
+    print(f"speedup           : {legacy / pooled:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,79 @@
+"""
+Per-call latency of Marzban admin actions: module-level requests.* vs the pooled session.
+
+Runs a small keep-alive HTTP/1.1 server locally and sends a burst of delete/reset
+calls two ways: the old way (a new connection per call through requests.delete/post)
+and the current way (MarzbanAPIHandler._request over one pooled session). The server
+adds no TLS, so against a real HTTPS panel the gap is wider than shown here.
+
+    python benchmarks/bench_marzban_transport.py [calls]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bench_marzban_"))
+
+from bot.marzban_api_handler import marzban_handler  # noqa: E402
+
+
+class _PanelStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        body = b'{"detail": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+def main(calls: int = 500) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PanelStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_base_url = f"http://127.0.0.1:{server.server_port}/api"
+
+    marzban_handler.api_base_url = api_base_url
+    marzban_handler.access_token = "bench"
+    marzban_handler.token_expires_at = time.time() + 3600
+    headers = {"Authorization": "Bearer bench"}
+
+    start = time.perf_counter()
+    for i in range(calls):
+        if i % 2:
+            requests.delete(f"{api_base_url}/user/u{i}", headers=headers, timeout=10)
+        else:
+            requests.post(f"{api_base_url}/user/u{i}/reset", headers=headers, timeout=10)
+    legacy = (time.perf_counter() - start) / calls
+
+    start = time.perf_counter()
+    for i in range(calls):
+        if i % 2:
+            marzban_handler.delete_user(f"u{i}")
+        else:
+            marzban_handler.reset_user_usage(f"u{i}")
+    pooled = (time.perf_counter() - start) / calls
+
+    server.shutdown()
+    print(f"calls per variant      : {calls}")
+    print(f"new connection per call: {legacy * 1e3:8.3f} ms/call")
+    print(f"pooled session         : {pooled * 1e3:8.3f} ms/call")
+    print(f"speedup                : {legacy / pooled:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,83 @@
+"""
+Plan reports: per-click plan matching vs the plan-membership index (bot/plan_index.py).
+
+Builds N synthetic combined users whose panel limits follow the plans in bot/plans.json
+(plus some custom ones), then times what one page of "users by plan" costs:
+
+  scan  : reload plans.json, parse the volumes and scan every user (the old handler)
+  build : PlanIndex.build, done once per sync generation
+  click : users_in_plan on a built index
+  load  : restore the index from its stored JSON (the other process)
+
+    python benchmarks/bench_plan_index.py [users]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid as uuid_lib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bench_plans_"))
+
+from bot.combined_handler import CombinedUsers  # noqa: E402
+from bot.plan_index import PlanIndex, plan_spec  # noqa: E402
+from bot.records import CombinedUser, HiddifyUser, MarzbanUser  # noqa: E402
+from bot.user_directory import UserDirectory  # noqa: E402
+from bot.utils import load_service_plans, parse_volume_string  # noqa: E402
+
+
+def _users(count: int, plans):
+    specs = [plan_spec(plan) for plan in plans] + [(7.0, 3.0), (100.0, -1.0)]
+    for i in range(count):
+        de, fr = random.choice(specs)
+        uuid = str(uuid_lib.uuid4())
+        h_info = HiddifyUser(name=f'user{i}', uuid=uuid, is_active=True, last_online=None, usage_limit_GB=de,
+                             current_usage_GB=0.0, expire=30, mode='no_reset') if de >= 0 else None
+        m_info = MarzbanUser(username=f'user{i}', name=f'user{i}', uuid=uuid, is_active=True, last_online=None,
+                             usage_limit_GB=fr, current_usage_GB=0.0, expire=30) if fr >= 0 else None
+        yield CombinedUser(h_info, m_info)
+
+
+def _scan(users, plan_index):
+    plan = load_service_plans()[plan_index]
+    spec = (float(parse_volume_string(plan.get('volume_de', '0'))), float(parse_volume_string(plan.get('volume_fr', '0'))))
+    result = []
+    for user in users:
+        h_info = user.get('breakdown', {}).get('hiddify', {})
+        m_info = user.get('breakdown', {}).get('marzban', {})
+        if (h_info.get('usage_limit_GB', -1.0), m_info.get('usage_limit_GB', -1.0)) == spec:
+            result.append(user)
+    return result
+
+
+def _median_ms(fn, repeat: int = 20) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+
+def main(count: int = 20_000) -> None:
+    random.seed(1)
+    plans = load_service_plans()
+    directory = UserDirectory(CombinedUsers(_users(count, plans)), [], {})
+    index = PlanIndex.build(directory, plans, 'bench')
+    data = index.to_json()
+    assert len(index.users_in_plan(0)) == len(_scan(directory.users, 0))
+
+    print(f"users                  : {count}")
+    print(f"plans                  : {len(plans)}")
+    print(f"scan per click         : {_median_ms(lambda: _scan(directory.users, 0)):8.2f} ms")
+    print(f"index build            : {_median_ms(lambda: PlanIndex.build(directory, plans, 'bench'), 5):8.2f} ms")
+    print(f"index per click        : {_median_ms(lambda: index.users_in_plan(0)):8.2f} ms")
+    print(f"index load from JSON   : {_median_ms(lambda: PlanIndex.from_json(directory, plans, 'bench', data), 5):8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,80 @@
+"""
+Online/active/inactive segments: per-user datetime scans vs PresenceIndex (bot/presence.py).
+
+Builds N combined users with last_online spread over the last 60 days (10% never connected)
+and times each segment as the handlers used to compute it (a datetime comparison per user)
+against the bisect lookups of a PresenceIndex built once per generation.
+
+    python benchmarks/bench_presence.py [users]
+"""
+import os
+import random
+import statistics
+import sys
+import time
+import uuid as uuid_lib
+from datetime import datetime, timedelta
+
+import pytz
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bot.presence import PresenceIndex  # noqa: E402
+from bot.records import CombinedUser, HiddifyUser  # noqa: E402
+
+
+def _users(count: int):
+    now = datetime.now(pytz.utc)
+    for i in range(count):
+        seen = None if random.random() < 0.1 else now - timedelta(seconds=random.uniform(0, 60 * 86400))
+        yield CombinedUser(HiddifyUser(name=f'user{i}', uuid=str(uuid_lib.uuid4()), is_active=True, last_online=seen,
+                                       usage_limit_GB=50.0, current_usage_GB=1.0, expire=30, mode='no_reset'), None)
+
+
+def _scans(users):
+    def online():
+        deadline = datetime.now(pytz.utc) - timedelta(minutes=3)
+        return [u for u in users if u.get('last_online') and u['last_online'].astimezone(pytz.utc) >= deadline]
+
+    def active():
+        deadline = datetime.now(pytz.utc) - timedelta(days=1)
+        return [u for u in users if u.get('last_online') and u['last_online'].astimezone(pytz.utc) >= deadline]
+
+    def inactive():
+        now_utc = datetime.now(pytz.utc)
+        return [u for u in users if u.get('last_online') and 1 <= (now_utc - u['last_online'].astimezone(pytz.utc)).days < 7]
+
+    def never():
+        return [u for u in users if not u.get('last_online')]
+
+    return {'online': online, 'active': active, 'inactive': inactive, 'never_connected': never}
+
+
+def _median_ms(fn, repeat: int = 20) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+
+def main(count: int = 50_000) -> None:
+    random.seed(1)
+    users = list(_users(count))
+    start = time.perf_counter()
+    index = PresenceIndex((u.get('last_online'), u) for u in users)
+    build = time.perf_counter() - start
+
+    print(f"users                  : {count}")
+    print(f"index build            : {build * 1e3:8.1f} ms")
+    print(f"{'segment':<22} {'scan (ms)':>10} {'index (ms)':>11} {'size':>7}")
+    for name, scan in _scans(users).items():
+        lookup = getattr(index, name)
+        assert len(lookup()) == len(scan())
+        print(f"{name:<22} {_median_ms(scan, 5):10.2f} {_median_ms(lookup):11.3f} {len(lookup()):7d}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -0,0 +1,93 @@
+"""
+Memory held by one combined user snapshot: plain dicts vs the slotted records in bot/records.py.
+
+Builds N users present on both panels and measures, with tracemalloc, the memory retained by
+
+  dicts   : the structures the code built before the records existed: a dict per panel
+            user, and a combined dict per user (a copy of the base panel dict plus usage and
+            breakdown dicts)
+  records : HiddifyUser / MarzbanUser per panel and a CombinedUser per user (derived
+            fields are computed when read, breakdown points at the panel records)
+
+    python benchmarks/bench_record_memory.py [users]
+"""
+import gc
+import os
+import sys
+import tracemalloc
+import uuid as uuid_lib
+from datetime import datetime, timedelta
+
+import pytz
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bot.records import CombinedUser, HiddifyUser, MarzbanUser  # noqa: E402
+
+
+def _panel_values(count: int):
+    now = datetime.now(pytz.utc)
+    for i in range(count):
+        uuid = str(uuid_lib.uuid4())
+        common = dict(name=f'user{i}', uuid=uuid, is_active=True, last_online=now - timedelta(minutes=i),
+                      usage_limit_GB=50.0, current_usage_GB=float(i % 50), expire=30)
+        yield dict(common, mode='no_reset'), dict(common, username=f'user{i}')
+
+
+def _legacy_panel(values: dict) -> dict:
+    user = dict(values)
+    user['remaining_GB'] = max(0, user['usage_limit_GB'] - user['current_usage_GB'])
+    user['usage_percentage'] = user['current_usage_GB'] / user['usage_limit_GB'] * 100
+    return user
+
+
+def _legacy_combined(h_info: dict, m_info: dict) -> dict:
+    user = h_info.copy()
+    user['breakdown'] = {'hiddify': h_info, 'marzban': m_info}
+    user['panels'] = "آلمان (Hiddify) + فرانسه (Marzban)"
+    total_limit = h_info['usage_limit_GB'] + m_info['usage_limit_GB']
+    total_usage = h_info['current_usage_GB'] + m_info['current_usage_GB']
+    user['usage'] = {'total_usage_GB': total_usage, 'data_limit_GB': total_limit,
+                     'remaining_GB': max(0, total_limit - total_usage),
+                     'percentage': total_usage / total_limit * 100}
+    user['is_active'] = True
+    user['status'] = 'active'
+    user['last_online'] = max(h_info['last_online'], m_info['last_online'])
+    user['is_online'] = False
+    user['username'] = user['name']
+    user['expire'] = max(h_info['expire'], m_info['expire'])
+    user['on_hiddify'] = user['on_marzban'] = True
+    return user
+
+
+def _measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main(count: int = 10_000) -> None:
+    values = list(_panel_values(count))
+
+    def build_dicts():
+        return [_legacy_combined(_legacy_panel(h), _legacy_panel(m)) for h, m in values]
+
+    def build_records():
+        return [CombinedUser(HiddifyUser(**h), MarzbanUser(**m)) for h, m in values]
+
+    legacy = _measure(build_dicts)
+    records = _measure(build_records)
+    print(f"users                  : {count}")
+    print(f"dicts                  : {legacy / 2**20:8.2f} MiB ({legacy / count:6.0f} B/user)")
+    print(f"records                : {records / 2**20:8.2f} MiB ({records / count:6.0f} B/user)")
+    print(f"reduction              : {legacy / records:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,91 @@
+"""
+Admin global search: trigram/prefix index (bot/search_index.py) vs a linear substring scan.
+
+Feeds N synthetic users to a SearchIndex through a full PanelDiff, then times queries of
+several kinds (full UUID, UUID fragment, name prefix, name substring, two-letter prefix)
+against the index and against the scan search_user used to do over the combined list.
+Also times an incremental update with 5% of the users renamed.
+
+    python benchmarks/bench_search_index.py [users]
+"""
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+import uuid as uuid_lib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bench_search_"))
+
+from bot.panel_sync import diff_users  # noqa: E402
+from bot.records import HiddifyUser  # noqa: E402
+from bot.search_index import SearchIndex  # noqa: E402
+
+
+class _NoProfiles:
+    @staticmethod
+    def get_uuid_search_fields():
+        return []
+
+
+def _name() -> str:
+    return random.choice(string.ascii_lowercase) + ''.join(random.choices(string.ascii_lowercase + string.digits, k=7))
+
+
+def _timed(fn, queries):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return statistics.median(samples) * 1e3, samples[int(len(samples) * 0.95)] * 1e3
+
+
+def main(count: int = 50_000, queries: int = 200) -> None:
+    random.seed(1)
+    users = [HiddifyUser(name=_name(), uuid=str(uuid_lib.uuid4()), is_active=True, last_online=None,
+                         usage_limit_GB=50.0, current_usage_GB=1.0, expire=30, mode='no_reset')
+             for _ in range(count)]
+
+    index = SearchIndex(database=_NoProfiles())
+    diff, state = diff_users('hiddify', None, users)
+    marzban_diff, _ = diff_users('marzban', None, [])
+    start = time.perf_counter()
+    index(diff)
+    index(marzban_diff)
+    build = time.perf_counter() - start
+
+    def scan(query):
+        q = query.lower()
+        return [u for u in users if q in u['name'].lower() or q in u['uuid']]
+
+    sample = random.sample(users, queries)
+    kinds = {
+        'full uuid': [u['uuid'] for u in sample],
+        'uuid fragment': [u['uuid'][9:17] for u in sample],
+        'name prefix': [u['name'][:5] for u in sample],
+        'name substring': [u['name'][2:6] for u in sample],
+        'two letters': [u['name'][:2] for u in sample],
+    }
+    print(f"users                  : {count}")
+    print(f"full build             : {build * 1e3:8.1f} ms")
+    print(f"{'query':<22} {'index p50/p95 (ms)':>20} {'scan p50/p95 (ms)':>20}")
+    for kind, qs in kinds.items():
+        i50, i95 = _timed(index.search, qs)
+        s50, s95 = _timed(scan, qs[:20])
+        print(f"{kind:<22} {i50:9.3f} / {i95:7.3f} {s50:9.3f} / {s95:7.3f}")
+
+    renamed = [HiddifyUser(**{**u, 'name': _name()}) if random.random() < 0.05 else u for u in users]
+    diff, _ = diff_users('hiddify', state, renamed)
+    start = time.perf_counter()
+    index(diff)
+    print(f"incremental update     : {(time.perf_counter() - start) * 1e3:8.1f} ms ({len(diff.changed)} renamed)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -0,0 +1,99 @@
+"""
+Cost of one panel sync cycle: full rewrite + full scan vs fingerprint diff + changed-only work.
+
+Builds N synthetic normalized Hiddify users, then applies a churn step (a fraction of
+users change usage, a few are added and removed) and measures:
+
+  full  : replace_panel_users() with the whole list, then a downstream pass over every user
+  diff  : diff_users() against the previous state, apply_panel_user_changes() with only the
+          changed rows, then a downstream pass over the changed UUIDs only
+
+The downstream pass stands in for the scheduler jobs (a dict lookup and a threshold check).
+
+    python benchmarks/bench_sync_diff.py [users] [churn]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid as uuid_lib
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bench_sync_"))
+
+from bot.database import DatabaseManager  # noqa: E402
+from bot.panel_sync import diff_users  # noqa: E402
+
+
+def _user(i: int) -> dict:
+    limit = random.choice((10.0, 30.0, 50.0, 100.0))
+    return {
+        'uuid': str(uuid_lib.uuid4()), 'name': f'user{i}', 'is_active': True,
+        'usage_limit_GB': limit, 'current_usage_GB': round(random.uniform(0, limit), 3),
+        'expire': random.randint(-5, 60), 'mode': 'no_reset',
+        'last_online': datetime.now() - timedelta(minutes=random.randint(0, 10_000)),
+    }
+
+
+def _churn(users: list, churn: float) -> list:
+    users = [dict(u) for u in users]
+    for user in random.sample(users, int(len(users) * churn)):
+        user['current_usage_GB'] = round(user['current_usage_GB'] + random.uniform(0.01, 0.5), 3)
+        user['last_online'] = datetime.now()
+    gone = int(len(users) * churn / 10)
+    users = users[gone:] + [_user(len(users) + i) for i in range(gone)]
+    return users
+
+
+def _downstream(users_by_uuid: dict, uuids) -> int:
+    hits = 0
+    for uuid in uuids:
+        user = users_by_uuid.get(uuid)
+        if user and user['current_usage_GB'] >= 0.8 * user['usage_limit_GB']:
+            hits += 1
+    return hits
+
+
+def main(count: int = 10_000, churn: float = 0.05, rounds: int = 5) -> None:
+    random.seed(1)
+    db = DatabaseManager(os.path.join(os.getcwd(), "bench.db"))
+    users = [_user(i) for i in range(count)]
+    db.replace_panel_users('hiddify', users)
+    _, state = diff_users('hiddify', None, users)
+
+    full_total = diff_total = 0.0
+    changed_total = 0
+    for _ in range(rounds):
+        users = _churn(users, churn)
+        users_by_uuid = {u['uuid']: u for u in users}
+
+        start = time.perf_counter()
+        db.replace_panel_users('hiddify', users)
+        _downstream(users_by_uuid, users_by_uuid.keys())
+        full_total += time.perf_counter() - start
+
+        start = time.perf_counter()
+        diff, new_state = diff_users('hiddify', state, users)
+        db.apply_panel_user_changes(
+            'hiddify', list(diff.added.values()) + [u for u, _ in diff.changed.values()],
+            diff.removed.keys(), len(new_state)
+        )
+        changed = diff.uuids({'current_usage_GB'})
+        _downstream(users_by_uuid, changed)
+        diff_total += time.perf_counter() - start
+        state = new_state
+        changed_total += len(changed)
+
+    print(f"users / churn / rounds : {count} / {churn:.0%} / {rounds}")
+    print(f"accounts processed     : {count} (full) vs {changed_total // rounds} (diff) per cycle")
+    print(f"full rewrite + scan    : {full_total / rounds * 1e3:8.1f} ms/cycle")
+    print(f"diff + changed only    : {diff_total / rounds * 1e3:8.1f} ms/cycle")
+    print(f"speedup                : {full_total / diff_total:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.05)
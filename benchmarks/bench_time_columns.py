@@ -0,0 +1,124 @@
+"""
+Range queries on usage_snapshots: TIMESTAMP text columns vs integer epoch columns.
+
+Builds the same synthetic table twice: once in the old layout (TIMESTAMP text read
+back through PARSE_DECLTYPES) and once in the current layout (INTEGER epoch with
+the covering index). It then times the range queries the bot runs most.
+
+    python benchmarks/bench_time_columns.py [uuids] [hours]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+WORKDIR = tempfile.mkdtemp(prefix="bench_time_")
+
+LEGACY_SCHEMA = """
+    CREATE TABLE usage_snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        uuid_id INTEGER,
+        hiddify_usage_gb REAL DEFAULT 0,
+        marzban_usage_gb REAL DEFAULT 0,
+        taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX idx_snapshots_uuid_id_taken_at ON usage_snapshots(uuid_id, taken_at);
+"""
+
+EPOCH_SCHEMA = """
+    CREATE TABLE usage_snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        uuid_id INTEGER,
+        hiddify_usage_gb REAL DEFAULT 0,
+        marzban_usage_gb REAL DEFAULT 0,
+        taken_at INTEGER
+    );
+    CREATE INDEX idx_snapshots_uuid_taken_cover ON usage_snapshots(uuid_id, taken_at, hiddify_usage_gb, marzban_usage_gb);
+    CREATE INDEX idx_snapshots_taken_at ON usage_snapshots(taken_at);
+"""
+
+
+def _build(path, schema, to_value, uuids, hours, now):
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.executescript(schema)
+    rng = random.Random(42)
+    rows = []
+    for uuid_id in range(1, uuids + 1):
+        usage = 0.0
+        for h in range(hours, 0, -1):
+            usage += rng.random() * 0.1
+            rows.append((uuid_id, usage, usage / 2, to_value(now - timedelta(hours=h))))
+    conn.executemany(
+        "INSERT INTO usage_snapshots (uuid_id, hiddify_usage_gb, marzban_usage_gb, taken_at) VALUES (?, ?, ?, ?)", rows
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    return conn, len(rows)
+
+
+def _time(label, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"  {label:<34}: {elapsed * 1e3:9.3f} ms")
+    return elapsed
+
+
+def _run(conn, to_value, uuids, now):
+    since_24h = to_value(now - timedelta(hours=24))
+    since_7d = to_value(now - timedelta(days=7))
+    probe = list(range(1, uuids + 1, max(1, uuids // 50)))
+    results = {}
+    results['window'] = _time(
+        "per-uuid 24h window (x50 uuids)",
+        lambda: [conn.execute(
+            "SELECT hiddify_usage_gb, marzban_usage_gb, taken_at FROM usage_snapshots "
+            "WHERE uuid_id = ? AND taken_at > ? ORDER BY taken_at", (u, since_24h)).fetchall() for u in probe],
+        20,
+    )
+    results['baseline'] = _time(
+        "per-uuid baseline row (x50 uuids)",
+        lambda: [conn.execute(
+            "SELECT hiddify_usage_gb FROM usage_snapshots WHERE uuid_id = ? AND taken_at <= ? "
+            "ORDER BY taken_at DESC LIMIT 1", (u, since_24h)).fetchone() for u in probe],
+        20,
+    )
+    results['scan'] = _time(
+        "all rows newer than 7 days",
+        lambda: conn.execute(
+            "SELECT uuid_id, hiddify_usage_gb, taken_at FROM usage_snapshots WHERE taken_at > ?", (since_7d,)).fetchall(),
+        5,
+    )
+    results['count'] = _time(
+        "COUNT older than 7 days",
+        lambda: conn.execute("SELECT COUNT(*) FROM usage_snapshots WHERE taken_at < ?", (since_7d,)).fetchone(),
+        20,
+    )
+    return results
+
+
+def main(uuids: int = 500, hours: int = 24 * 30) -> None:
+    now = datetime.now(timezone.utc)
+    legacy_conn, rows = _build(os.path.join(WORKDIR, "legacy.db"), LEGACY_SCHEMA, lambda dt: dt, uuids, hours, now)
+    epoch_conn, _ = _build(os.path.join(WORKDIR, "epoch.db"), EPOCH_SCHEMA, lambda dt: int(dt.timestamp()), uuids, hours, now)
+    print(f"rows per table: {rows} ({uuids} uuids x {hours} hourly snapshots)")
+
+    print("TIMESTAMP text + PARSE_DECLTYPES:")
+    legacy = _run(legacy_conn, lambda dt: dt, uuids, now)
+    print("INTEGER epoch + covering index:")
+    epoch = _run(epoch_conn, lambda dt: int(dt.timestamp()), uuids, now)
+
+    print("speedup:")
+    for key in legacy:
+        print(f"  {key:<34}: {legacy[key] / epoch[key]:9.1f}x")
+    sizes = {name: os.path.getsize(os.path.join(WORKDIR, f"{name}.db")) for name in ("legacy", "epoch")}
+    print(f"file size: legacy {sizes['legacy'] / 1e6:.1f} MB, epoch {sizes['epoch'] / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -1,8 +1,10 @@
 import pytz
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Optional, Dict, Any
 from .config import EMOJIS, PAGE_SIZE
 from .database import db
+from .presence import is_online
+from .records import Record
 from .utils import (
     format_daily_usage, escape_markdown,
     format_relative_time, validate_uuid, create_progress_bar, format_shamsi_tehran, gregorian_to_shamsi_str, days_until_next_birthday
@@ -55,7 +57,7 @@ def fmt_users_list(users: list, list_type: str, page: int) -> str:
 
     return "\n".join(lines)
 
-def fmt_online_users_list(users: list, page: int) -> str:
+def fmt_online_users_list(users: list, page: int, *, bot_users: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
     title = "⚡️ کاربران آنلاین (۳ دقیقه اخیر)" 
 
     if not users:
@@ -71,7 +73,8 @@ def fmt_online_users_list(users: list, page: int) -> str:
     user_lines = []
     separator = escape_markdown(" | ")
 
-    uuid_to_bot_user = db.get_uuid_to_bot_user_map()
+    # scheduler نگاشت آماده UserDirectory را می‌دهد
+    uuid_to_bot_user = bot_users if bot_users is not None else db.get_uuid_to_bot_user_map()
 
     for user in paginated_users:
         panel_name_raw = user.get('name', 'کاربر ناشناس')
@@ -110,7 +113,7 @@ def fmt_admin_report(all_users_from_api: list, db_manager) -> str:
     hiddify_user_count, marzban_user_count = 0, 0
 
     now_utc = datetime.now(pytz.utc)
-    online_deadline = now_utc - timedelta(minutes=3)
+    now_ts = now_utc.timestamp()
 
     db_users_map = {u['uuid']: u.get('created_at') for u in db_manager.all_active_uuids()}
 
@@ -135,9 +138,11 @@ def fmt_admin_report(all_users_from_api: list, db_manager) -> str:
         else:
             daily_usage_dict = {}
 
-        if user_info.get('is_active') and user_info.get('last_online') and isinstance(user_info.get('last_online'), datetime) and user_info['last_online'].astimezone(pytz.utc) >= online_deadline:
-            user_info['daily_usage_dict'] = daily_usage_dict
-            online_users.append(user_info)
+        if is_online(user_info.get('last_online'), now_ts):
+            # کاربران UserDirectory مشترک‌اند؛ مصرف امروز روی کپی نوشته می‌شود
+            online_user = user_info.fork() if isinstance(user_info, Record) else user_info
+            online_user['daily_usage_dict'] = daily_usage_dict
+            online_users.append(online_user)
 
         expire_days = user_info.get('expire')
         if expire_days is not None:
@@ -148,7 +153,7 @@ def fmt_admin_report(all_users_from_api: list, db_manager) -> str:
 
 
         created_at = db_users_map.get(user_info.get('uuid'))
-        if created_at and isinstance(created_at, datetime) and (now_utc - created_at.astimezone(pytz.utc)).days < 1:
+        if created_at and now_utc.timestamp() - created_at < 86400:
             new_users_today.append(user_info)
 
     total_daily_all = total_daily_hiddify + total_daily_marzban
@@ -52,17 +52,25 @@ def _handle_marzban_backup_request(call):
     chat_id, msg_id = call.from_user.id, call.message.message_id
     bot.answer_callback_query(call.id, "در حال دریافت اطلاعات...")
     _safe_edit(chat_id, msg_id, "⏳ در حال دریافت لیست کاربران از پنل فرانسه...")
+    backup_filename = f"marzban_backup_{datetime.now().strftime('%Y-%m-%d')}.json"
     try:
-        marzban_users = marzban_handler.get_all_users()
-        if not marzban_users:
+        # کاربران صفحه به صفحه از پنل خوانده و مستقیم در فایل نوشته می‌شوند؛ لیست کامل در حافظه ساخته نمی‌شود
+        user_count = 0
+        with open(backup_filename, 'w', encoding='utf-8') as f:
+            f.write('[')
+            for user in marzban_handler.iter_users():
+                f.write(',\n' if user_count else '\n')
+                json.dump(user.to_dict(), f, ensure_ascii=False, indent=4, default=json_datetime_serializer)
+                user_count += 1
+            f.write('\n]\n')
+        if not user_count:
             _safe_edit(chat_id, msg_id, "❌ هیچ کاربری در پنل فرانسه یافت نشد.", reply_markup=menu.admin_backup_selection_menu())
             return
-        backup_filename = f"marzban_backup_{datetime.now().strftime('%Y-%m-%d')}.json"
-        with open(backup_filename, 'w', encoding='utf-8') as f:
-            json.dump(marzban_users, f, ensure_ascii=False, indent=4, default=json_datetime_serializer)
         with open(backup_filename, "rb") as backup_file:
-            bot.send_document(chat_id, backup_file, caption=f"✅ فایل پشتیبان کاربران پنل فرانسه ({len(marzban_users)} کاربر).")
-        os.remove(backup_filename)
+            bot.send_document(chat_id, backup_file, caption=f"✅ فایل پشتیبان کاربران پنل فرانسه ({user_count} کاربر).")
     except Exception as e:
         logger.error(f"Marzban backup failed: {e}")
         _safe_edit(chat_id, msg_id, f"❌ خطای ناشناخته: {escape_markdown(e)}", reply_markup=menu.admin_backup_selection_menu())
+    finally:
+        if os.path.exists(backup_filename):
+            os.remove(backup_filename)
@@ -1,15 +1,12 @@
 import logging
 import time
 from telebot import types
-import pytz
-from datetime import datetime, timedelta
 import re
 
 from ..database import db
-from ..hiddify_api_handler import hiddify_handler
-from ..marzban_api_handler import marzban_handler
 from ..menu import menu
 from ..utils import _safe_edit, escape_markdown 
+from ..user_directory import get_user_directory
 from telebot.apihelper import ApiTelegramException
 
 logger = logging.getLogger(__name__)
@@ -48,24 +45,12 @@ def _send_broadcast(message: types.Message):
     uuids_to_fetch, target_user_ids = [], []
     
     if target_group != 'all':
-        h_users = hiddify_handler.get_all_users()
-        m_users = marzban_handler.get_all_users()
-        all_users = (h_users or []) + [u for u in (m_users or []) if u.get('uuid')]
-        
-        filtered_users = []
-        now_utc = datetime.now(pytz.utc)
-        if target_group == 'online':
-            deadline = now_utc - timedelta(minutes=3)
-            filtered_users = [u for u in all_users if u.get('is_active') and u.get('last_online') and u['last_online'].astimezone(pytz.utc) >= deadline]
-        elif target_group == 'active_1':
-            deadline = now_utc - timedelta(days=1)
-            filtered_users = [u for u in all_users if u.get('last_online') and u['last_online'].astimezone(pytz.utc) >= deadline]
-        elif target_group == 'inactive_7':
-            filtered_users = [u for u in all_users if u.get('last_online') and 1 <= (now_utc - u['last_online'].astimezone(pytz.utc)).days < 7]
-        elif target_group == 'inactive_0':
-            filtered_users = [u for u in all_users if not u.get('last_online')]
-        
-        uuids_to_fetch = [u['uuid'] for u in filtered_users]
+        # گروه‌ها بر اساس آخرین اتصال ترکیبی هر UUID در هر دو پنل (PresenceIndex)
+        presence = get_user_directory().presence()
+        segments = {'online': presence.online, 'active_1': presence.active,
+                    'inactive_7': presence.inactive, 'inactive_0': presence.never_connected}
+        filtered_users = segments[target_group]() if target_group in segments else []
+        uuids_to_fetch = [u['uuid'] for u in filtered_users if u.get('uuid')]
 
     if target_group == 'all':
         target_user_ids = db.get_all_user_ids()
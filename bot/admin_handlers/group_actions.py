@@ -1,10 +1,11 @@
 import logging
 from telebot import types
-from datetime import datetime, timedelta
 from ..menu import menu
-from ..utils import _safe_edit, load_service_plans, parse_volume_string, escape_markdown
+from ..utils import _safe_edit, load_service_plans, escape_markdown
 from .. import combined_handler
-import pytz
+from ..plan_index import get_plan_index
+from ..user_directory import get_user_directory
+from ..async_api import run_bulk
 
 
 logger = logging.getLogger(__name__)
@@ -31,21 +32,9 @@ def handle_ask_action_value(call, params):
     
     elif context_type == 'plan':
         plan_index = int(context_value)
-        all_plans = load_service_plans()
-        selected_plan = all_plans[plan_index]
-
-        plan_vol_de = float(parse_volume_string(selected_plan.get('volume_de', '0')))
-        plan_vol_fr = float(parse_volume_string(selected_plan.get('volume_fr', '0')))
-        all_users = combined_handler.get_all_users_combined()
-        
-        target_users = []
-        for user in all_users:
-            h_info = user.get('breakdown', {}).get('hiddify', {})
-            m_info = user.get('breakdown', {}).get('marzban', {})
-            user_vol_de = h_info.get('usage_limit_GB', -1.0)
-            user_vol_fr = m_info.get('usage_limit_GB', -1.0)
-            if user_vol_de == plan_vol_de and user_vol_fr == plan_vol_fr:
-                target_users.append(user)
+        index = get_plan_index()
+        selected_plan = index.plans[plan_index]
+        target_users = index.users_in_plan(plan_index)
         plan_or_filter_name = f"پلن «{escape_markdown(selected_plan.get('name', ''))}»"
 
     else: # Should not happen
@@ -105,13 +94,10 @@ def _apply_group_action(message: types.Message):
     add_gb = value if action_type == 'add_gb' else 0
     add_days = int(value) if action_type == 'add_days' else 0
 
-    success_count, fail_count = 0, 0
-    for user in target_users:
-        identifier = user.get('uuid') or user.get('username')
-        if combined_handler.modify_user_on_all_panels(identifier, add_gb=add_gb, add_days=add_days):
-            success_count += 1
-        else:
-            fail_count += 1
+    identifiers = [user.get('uuid') or user.get('username') for user in target_users]
+    results = run_bulk(combined_handler.modify_user_on_all_panels, identifiers, add_gb=add_gb, add_days=add_days)
+    success_count = sum(1 for ok in results if ok)
+    fail_count = len(results) - success_count
 
     final_text = (f"✅ عملیات گروهی با موفقیت انجام شد.\n\n"
                   f"به *{success_count}* کاربر اعمال شد.\n"
@@ -143,21 +129,18 @@ def handle_select_action_for_filter(call, params):
 
     _safe_edit(uid, msg_id, "⏳ در حال فیلتر کردن کاربران، لطفاً صبر کنید\\.\\.\\.")
 
-    all_users = combined_handler.get_all_users_combined()
+    directory = get_user_directory()
     target_users = []
 
     if filter_type == 'expiring_soon':
-        for user in all_users:
+        for user in directory.users:
             expire_days = user.get('expire')
             if expire_days is not None and 0 <= expire_days < 3:
                 target_users.append(user)
     
     elif filter_type == 'inactive_30_days':
-        thirty_days_ago = datetime.now(pytz.utc) - timedelta(days=30)
-        for user in all_users:
-            last_online = user.get('last_online')
-            if not last_online or (isinstance(last_online, datetime) and last_online < thirty_days_ago):
-                target_users.append(user)
+        presence = directory.presence()
+        target_users = presence.dormant() + presence.never_connected()
     
     if not target_users:
         prompt = "❌ هیچ کاربری با این فیلتر یافت نشد\\."
@@ -1,11 +1,11 @@
 import logging
-from datetime import datetime, timedelta
-import pytz
 from telebot import types
 from .. import combined_handler
 from ..hiddify_api_handler import hiddify_handler
 from ..marzban_api_handler import marzban_handler
 from ..database import db
+from ..plan_index import get_plan_index
+from ..user_directory import get_user_directory
 from ..menu import menu
 from ..admin_formatters import (
     fmt_users_list, fmt_panel_users_list, fmt_online_users_list,
@@ -13,7 +13,7 @@ from ..admin_formatters import (
     fmt_hiddify_panel_info, fmt_marzban_system_stats, fmt_users_by_plan_list,
     fmt_payments_report_list
 )
-from ..utils import _safe_edit, load_service_plans, parse_volume_string, escape_markdown
+from ..utils import _safe_edit, escape_markdown
 
 logger = logging.getLogger(__name__)
 bot = None
@@ -63,31 +63,26 @@ def handle_paginated_list(call, params):
     if panel:
         _safe_edit(call.from_user.id, call.message.message_id, "⏳ در حال دریافت اطلاعات از پنل، لطفاً صبر کنید...", reply_markup=None, parse_mode=None)
 
-    users, all_panel_users = [], []
-    if panel == 'hiddify': all_panel_users = hiddify_handler.get_all_users()
-    elif panel == 'marzban': all_panel_users = marzban_handler.get_all_users()
-    
-    if list_type == "panel_users": 
-        users = all_panel_users
-    elif list_type == "online_users":
-        deadline = datetime.now(pytz.utc) - timedelta(minutes=3)
-        online_users = [u for u in all_panel_users if u.get('is_active') and isinstance(u.get('last_online'), datetime) and u['last_online'].astimezone(pytz.utc) >= deadline]
-        for user in online_users:
+    users = []
+    presence_lists = {"online_users": "online", "active_users": "active", "inactive_users": "inactive", "never_connected": "never_connected"}
+    if list_type in presence_lists and panel in ('hiddify', 'marzban'):
+        # بخش‌بندی از PresenceIndex همان generation خوانده می‌شود؛ خروجی رکورد همان پنل است
+        presence = get_user_directory().presence(panel)
+        users = [u['breakdown'][panel] for u in getattr(presence, presence_lists[list_type])()]
+    elif list_type in ("panel_users", "top_consumers") and panel in ('hiddify', 'marzban'):
+        users = combined_handler.get_panel_users_mirrored(panel)
+
+    if list_type == "online_users":
+        # رکوردهای directory مشترک‌اند؛ مصرف امروز روی کپی نوشته می‌شود
+        users = [u.fork() for u in users]
+        daily_usage_map = db.get_all_daily_usage_since_midnight()
+        for user in users:
             if user.get('uuid'):
-                user['daily_usage_GB'] = sum(db.get_usage_since_midnight_by_uuid(user['uuid']).values())
+                user['daily_usage_GB'] = sum(daily_usage_map.get(user['uuid'], {}).values())
             else:
                 user['daily_usage_GB'] = 0
-        users = online_users
-    elif list_type == "active_users":
-        deadline = datetime.now(pytz.utc) - timedelta(days=1)
-        users = [u for u in all_panel_users if u.get('last_online') and u['last_online'].astimezone(pytz.utc) >= deadline]
-    elif list_type == "inactive_users":
-        now_utc = datetime.now(pytz.utc)
-        users = [u for u in all_panel_users if u.get('last_online') and 1 <= (now_utc - u['last_online'].astimezone(pytz.utc)).days < 7]
-    elif list_type == "never_connected": 
-        users = [u for u in all_panel_users if not u.get('last_online')]
     elif list_type == "top_consumers":
-        sorted_users = sorted(all_panel_users, key=lambda u: u.get('current_usage_GB', 0), reverse=True)
+        sorted_users = sorted(users, key=lambda u: u.get('current_usage_GB', 0), reverse=True)
         users = sorted_users[:100]
     elif list_type == "bot_users": 
         users = db.get_all_bot_users()
@@ -127,41 +122,21 @@ def handle_report_by_plan_selection(call, params):
     prompt = "لطفاً پلنی که می‌خواهید کاربران آن را مشاهده کنید، انتخاب نمایید:"
     _safe_edit(uid, msg_id, prompt, reply_markup=menu.admin_select_plan_for_report_menu())
 
-def _find_users_matching_plan_specs(all_users, plan_specs_set, invert_match=False):
-    filtered_users = []
-    for user in all_users:
-        h_info = user.get('breakdown', {}).get('hiddify', {})
-        m_info = user.get('breakdown', {}).get('marzban', {})
-        
-        user_vol_de = h_info.get('usage_limit_GB', -1.0)
-        user_vol_fr = m_info.get('usage_limit_GB', -1.0)
-        user_spec = (user_vol_de, user_vol_fr)
-
-        is_match = user_spec in plan_specs_set
-        
-        if (invert_match and not is_match) or (not invert_match and is_match):
-            filtered_users.append(user)
-            
-    return filtered_users
-
 def handle_list_users_by_plan(call, params):
     plan_index, page = int(params[0]), int(params[1])
     uid, msg_id = call.from_user.id, call.message.message_id
 
     _safe_edit(uid, msg_id, "⏳ در حال دریافت اطلاعات و مقایسه با پلن، لطفاً صبر کنید...")
 
-    all_plans = load_service_plans()
+    # عضویت پلن‌ها یک بار برای هر همگام‌سازی حساب می‌شود و ورق زدن صفحه‌ها فقط از آن می‌خواند
+    index = get_plan_index()
+    all_plans = index.plans
     if plan_index >= len(all_plans):
         _safe_edit(uid, msg_id, escape_markdown("❌ پلن انتخاب شده نامعتبر است."), reply_markup=menu.admin_panel())
         return
         
     selected_plan = all_plans[plan_index]
-    plan_vol_de = float(parse_volume_string(selected_plan.get('volume_de', '0')))
-    plan_vol_fr = float(parse_volume_string(selected_plan.get('volume_fr', '0')))
-    
-    plan_spec_to_match = {(plan_vol_de, plan_vol_fr)}
-    all_users = combined_handler.get_all_users_combined()
-    filtered_users = _find_users_matching_plan_specs(all_users, plan_spec_to_match, invert_match=False)
+    filtered_users = index.users_in_plan(plan_index)
 
     plan_name_raw = selected_plan.get('name', '')
     text = fmt_users_by_plan_list(filtered_users, plan_name_raw, page)
@@ -178,16 +153,7 @@ def handle_list_users_no_plan(call, params):
 
     _safe_edit(uid, msg_id, "⏳ در حال دریافت اطلاعات و مقایسه با پلن‌ها، لطفاً صبر کنید...")
 
-    all_plans = load_service_plans()
-    all_users = combined_handler.get_all_users_combined()
-    
-    plan_specs = set()
-    for plan in all_plans:
-        vol_de = parse_volume_string(plan.get('volume_de', '0'))
-        vol_fr = parse_volume_string(plan.get('volume_fr', '0'))
-        plan_specs.add((float(vol_de), float(vol_fr)))
-
-    users_without_plan = _find_users_matching_plan_specs(all_users, plan_specs, invert_match=True)
+    users_without_plan = get_plan_index().users_without_plan()
 
     text = fmt_users_by_plan_list(users_without_plan, "بدون پلن مشخص", page)
 
@@ -138,7 +138,8 @@ def apply_user_edit(msg: types.Message):
 def handle_toggle_status(call, params):
     # تغيير: پانل از شناسه استخراج می‌شود
     identifier = params[0]
-    info = combined_handler.get_combined_user_info(identifier)
+    # وضعیت جدید از وضعیت فعلی محاسبه می‌شود، پس داده کش‌شده قابل اعتماد نیست
+    info = combined_handler.get_combined_user_info(identifier, use_cache=False)
     if not info:
         bot.answer_callback_query(call.id, "❌ کاربر یافت نشد.", show_alert=True)
         return
@@ -152,6 +153,7 @@ def handle_toggle_status(call, params):
     if 'marzban' in info.get('breakdown', {}):
         m_success = combined_handler.marzban_handler.modify_user(info['name'],
                                                                  data={'status': 'active' if new_status else 'disabled'})
+    combined_handler.invalidate_user_info(identifier, info.get('uuid'), info.get('name'))
 
     if h_success and m_success:
         bot.answer_callback_query(call.id, "✅ وضعیت با موفقیت تغییر کرد.")
@@ -219,6 +221,7 @@ def handle_reset_usage_action(call, params):
 
     if panel_to_reset in ['marzban', 'both'] and 'marzban' in info.get('breakdown', {}):
         m_success = combined_handler.marzban_handler.reset_user_usage(info['name'])
+    combined_handler.invalidate_user_info(identifier, info.get('uuid'), info.get('name'))
 
     if h_success and m_success:
         if uuid_id_in_db:
@@ -310,7 +313,8 @@ def _handle_global_search_response(message: types.Message):
         if len(results) == 1:
             user = results[0]
             identifier = user.get('uuid') or user.get('name')
-            info = combined_handler.get_combined_user_info(identifier)
+            # نتیجه جستجو خودش اطلاعات ترکیبی کامل کاربر است و دوباره از پنل‌ها خوانده نمی‌شود
+            info = user
             if info:
                 db_user = None
                 if info.get('uuid'):
@@ -148,6 +148,8 @@ def _finish_user_creation(uid, user_data):
 
     new_user_info = hiddify_handler.add_user(user_data)
     if new_user_info and new_user_info.get('uuid'):
+        # لیست‌های کش‌شده پنل‌ها هنوز کاربر جدید را ندارند
+        combined_handler.invalidate_user_info(new_user_info['uuid'], user_data.get('name'))
         final_info = combined_handler.get_combined_user_info(new_user_info['uuid'])
         text = fmt_admin_user_summary(final_info)
         success_text = f"✅ کاربر با موفقیت ساخته شد\\.\n\n{text}"
@@ -233,6 +235,7 @@ def _finish_user_creation_from_plan(uid, convo_data):
         identifier = new_user_info.get('username') if new_user_info else None
 
     if identifier:
+        combined_handler.invalidate_user_info(identifier, name)
         final_info = combined_handler.get_combined_user_info(identifier)
         text = fmt_admin_user_summary(final_info)
         # تغيير: escape کردن نقطه
@@ -119,6 +119,8 @@ def _finish_marzban_user_creation(uid, msg_id):
     new_user_info = marzban_handler.add_user(user_data)
     
     if new_user_info and new_user_info.get('username'):
+        # لیست‌های کش‌شده پنل‌ها هنوز کاربر جدید را ندارند
+        combined_handler.invalidate_user_info(new_user_info['username'])
         final_info = combined_handler.get_combined_user_info(new_user_info['username'])
         text = fmt_admin_user_summary(final_info)
         success_text = f"✅ کاربر با موفقیت ساخته شد\\.\n\n{text}"
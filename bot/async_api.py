@@ -0,0 +1,116 @@
+"""
+لایه asyncio برای API های Hiddify و Marzban.
+
+کتابخانه HTTP غیرهمزمانی در وابستگی‌های پروژه نیست، پس هر فراخوانی روی همان session های
+requests و همان نرمال‌سازی (_norm در Hiddify و بلاک نرمال‌سازی Marzban) در یک executor محدود
+اجرا می‌شود. اندازه executor (PANEL_CONCURRENCY_LIMIT) سقف درخواست‌های همزمان به پنل‌هاست و
+با اندازه pool اتصال‌های HTTP هر session هماهنگ است.
+
+کدهای همزمان (handler های تلگرام و scheduler) از run_bulk استفاده می‌کنند که N فراخوانی را
+به صورت موازی اجرا و نتایج را به همان ترتیب ورودی برمی‌گرداند.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from .config import PANEL_CONCURRENCY_LIMIT
+from .hiddify_api_handler import HiddifyAPIHandler, hiddify_handler
+from .marzban_api_handler import MarzbanAPIHandler, marzban_handler
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=PANEL_CONCURRENCY_LIMIT, thread_name_prefix="panel-api")
+
+
+async def run_blocking(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """یک فراخوانی همزمان (blocking) را در executor محدود پنل‌ها اجرا می‌کند."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+class AsyncHiddifyAPIHandler:
+    """نسخه async از HiddifyAPIHandler؛ خروجی‌ها دقیقا همان خروجی نرمال‌شده نسخه همزمان است."""
+
+    def __init__(self, handler: HiddifyAPIHandler):
+        self._handler = handler
+
+    async def get_all_users(self, max_age: Optional[float] = None, allow_stale: bool = True) -> List[Dict[str, Any]]:
+        return await run_blocking(self._handler.get_all_users, max_age, allow_stale)
+
+    async def user_info(self, uuid: str) -> Optional[Dict[str, Any]]:
+        return await run_blocking(self._handler.user_info, uuid)
+
+    async def add_user(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return await run_blocking(self._handler.add_user, data)
+
+    async def modify_user(self, uuid: str, data: dict) -> bool:
+        return await run_blocking(self._handler.modify_user, uuid, data)
+
+    async def delete_user(self, uuid: str) -> bool:
+        return await run_blocking(self._handler.delete_user, uuid)
+
+    async def reset_user_usage(self, uuid: str) -> bool:
+        return await run_blocking(self._handler.reset_user_usage, uuid)
+
+
+class AsyncMarzbanAPIHandler:
+    """نسخه async از MarzbanAPIHandler؛ خروجی‌ها دقیقا همان خروجی نرمال‌شده نسخه همزمان است."""
+
+    def __init__(self, handler: MarzbanAPIHandler):
+        self._handler = handler
+
+    async def get_all_users(self, max_age: Optional[float] = None, allow_stale: bool = True) -> List[Dict[str, Any]]:
+        return await run_blocking(self._handler.get_all_users, max_age, allow_stale)
+
+    async def get_user_info(self, uuid: str) -> Optional[Dict[str, Any]]:
+        return await run_blocking(self._handler.get_user_info, uuid)
+
+    async def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        return await run_blocking(self._handler.get_user_by_username, username)
+
+    async def add_user(self, user_data: dict) -> Optional[dict]:
+        return await run_blocking(self._handler.add_user, user_data)
+
+    async def modify_user(self, username: str, data: dict = None, add_usage_gb: float = 0, add_days: int = 0) -> bool:
+        return await run_blocking(self._handler.modify_user, username, data, add_usage_gb, add_days)
+
+    async def delete_user(self, username: str) -> bool:
+        return await run_blocking(self._handler.delete_user, username)
+
+    async def reset_user_usage(self, username: str) -> bool:
+        return await run_blocking(self._handler.reset_user_usage, username)
+
+
+async def gather_limited(awaitables: Iterable[Awaitable[Any]]) -> List[Any]:
+    """
+    همه awaitable ها را همزمان اجرا می‌کند (سقف همزمانی همان executor پنل‌هاست).
+    خطای هر مورد لاگ و به جای نتیجه آن None گذاشته می‌شود تا بقیه موارد از دست نروند.
+    """
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error(f"Async panel call failed: {result}", exc_info=result)
+            results[i] = None
+    return results
+
+
+def run_sync(coro: Awaitable[Any]) -> Any:
+    """Sync facade: اجرای یک coroutine از کد همزمان (handler های تلگرام و scheduler)."""
+    return asyncio.run(coro)
+
+
+def run_bulk(fn: Callable[..., Any], items: Iterable[Any], *args, **kwargs) -> List[Any]:
+    """
+    معادل موازی [fn(item, *args, **kwargs) for item in items] برای کد همزمان.
+    نتایج به ترتیب ورودی هستند؛ موردی که خطا بدهد None برمی‌گرداند.
+    """
+    items = list(items)
+    if not items:
+        return []
+    return run_sync(gather_limited(run_blocking(fn, item, *args, **kwargs) for item in items))
+
+
+async_hiddify_handler = AsyncHiddifyAPIHandler(hiddify_handler)
+async_marzban_handler = AsyncMarzbanAPIHandler(marzban_handler)
@@ -1,131 +1,122 @@
 from typing import Optional, Dict, Any, List
-from datetime import datetime, timedelta
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import time
 from .hiddify_api_handler import hiddify_handler
 from .marzban_api_handler import marzban_handler
-from .database import db
+from .database import db, read_db
+from .async_api import async_hiddify_handler, async_marzban_handler, gather_limited, run_sync
+from .config import PANEL_FETCH_DEADLINES, USER_INFO_CACHE_TTL, PANEL_MIRROR_MAX_AGE
+from .panel_cache import UserInfoCache
+from .records import CombinedUser
+from .search_index import search_index
 from .utils import validate_uuid
 import logging
-import pytz
 
 logger = logging.getLogger(__name__)
 
+# thread های ثابت برای دریافت همزمان لیست کاربران پنل‌ها
+_panel_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="panel-fetch")
+
+# اطلاعات ترکیبی هر اکانت؛ با هر تغییر روی پنل‌ها از طریق invalidate_user_info پاک می‌شود
+user_info_cache = UserInfoCache('user_info')
+
+
+class CombinedUsers(list):
+    """
+    لیست کاربران ترکیبی، به همراه وضعیت پنل‌ها.
+    اگر یکی از پنل‌ها به موقع پاسخ ندهد، partial برابر True است و نام آن در missing_panels می‌آید.
+    """
+    def __init__(self, users=(), missing_panels=()):
+        super().__init__(users)
+        self.missing_panels: List[str] = list(missing_panels)
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.missing_panels)
+
 def _process_single_user_data(h_info: Optional[Dict], m_info: Optional[Dict]) -> Optional[Dict[str, Any]]:
     """
     یک تابع داخلی برای پردازش و ترکیب اطلاعات یک کاربر از هر دو پنل.
-    این تابع قلب منطق ترکیب داده است.
+    این تابع قلب منطق ترکیب داده است؛ خروجی یک CombinedUser است که مثل dict خوانده می‌شود
+    و فیلدهای usage، status، breakdown و ... را هنگام خواندن حساب می‌کند.
     """
     if not h_info and not m_info:
         return None
+    return CombinedUser(h_info, m_info)
 
-    base_info = (h_info or m_info).copy()
-    h_info = h_info or {}
-    m_info = m_info or {}
+def _find_in_user_lists(identifier: str) -> Optional[Dict[str, Any]]:
+    """
+    اگر لیست کاربران هر دو پنل در کش تازه باشد (جوان‌تر از USER_INFO_CACHE_TTL)، اطلاعات اکانت
+    بدون درخواست جداگانه از همان لیست‌ها ساخته می‌شود. اگر لیست‌ها تازه نباشند یا کاربر در آن‌ها
+    نباشد (مثلا تازه ساخته شده)، None برمی‌گرداند تا از API تکی پرسیده شود.
+    """
+    h_users = hiddify_handler.users_cache.peek(USER_INFO_CACHE_TTL)
+    m_users = marzban_handler.users_cache.peek(USER_INFO_CACHE_TTL)
+    if h_users is None or m_users is None:
+        return None
 
-    base_info['breakdown'] = {'hiddify': h_info, 'marzban': m_info}
-    
-    # اصلاح 1: اضافه کردن فیلد panels برای نمایش در جدول
-    panels = []
-    if h_info:
-        panels.append("آلمان (Hiddify)")
-    if m_info:
-        panels.append("فرانسه (Marzban)")
-    base_info['panels'] = " + ".join(panels) if panels else "نامشخص"
-    
-    h_limit = h_info.get('usage_limit_GB', 0)
-    m_limit = m_info.get('usage_limit_GB', 0)
-    total_limit = h_limit + m_limit
-    
-    h_usage = h_info.get('current_usage_GB', 0)
-    m_usage = m_info.get('current_usage_GB', 0)
-    total_usage = h_usage + m_usage
-    
-    base_info['usage'] = {
-        'total_usage_GB': total_usage,
-        'data_limit_GB': total_limit,
-        'remaining_GB': max(0, total_limit - total_usage),
-        'percentage': (total_usage / total_limit * 100) if total_limit > 0 else 0
-    }
-
-    base_info['is_active'] = h_info.get('is_active', False) or m_info.get('is_active', False)
-    if base_info['is_active']:
-        base_info['status'] = 'active'
-    elif (h_info.get('expire', -1) < 0) or (m_info.get('expire', -1) < 0):
-        base_info['status'] = 'expired'
+    if validate_uuid(identifier):
+        uuid = identifier.lower()
+        m_info = next((u for u in m_users if (u.get('uuid') or '').lower() == uuid), None)
     else:
-        base_info['status'] = 'disabled'
+        m_info = next((u for u in m_users if u.get('username') == identifier), None)
+        if not m_info:
+            return None
+        uuid = (m_info.get('uuid') or '').lower()
 
-    # اصلاح 2: بهبود منطق last_online و is_online
-    latest_online = None
-    h_online = h_info.get('last_online')
-    m_online = m_info.get('last_online')
+    h_info = next((u for u in h_users if (u.get('uuid') or '').lower() == uuid), None) if uuid else None
+    # رکوردهای لیست کش بین directory، همگام‌سازی و بقیه مشترک‌اند؛ فراخوان روی کپی (fork) می‌نویسد
+    return _process_single_user_data(h_info.fork() if h_info else None, m_info.fork() if m_info else None)
 
-    # مدیریت string datetime ها
-    if h_online:
-        if isinstance(h_online, str):
-            try:
-                h_online = datetime.fromisoformat(h_online.replace('Z', '+00:00'))
-            except:
-                h_online = None
-        if h_online and h_online.tzinfo is None:
-            h_online = pytz.utc.localize(h_online)
-
-    if m_online:
-        if isinstance(m_online, str):
-            try:
-                m_online = datetime.fromisoformat(m_online.replace('Z', '+00:00'))
-            except:
-                m_online = None
-        if m_online and m_online.tzinfo is None:
-            m_online = pytz.utc.localize(m_online)
-
-    # انتخاب آخرین زمان اتصال
-    if h_online and m_online:
-        latest_online = max(h_online, m_online)
-    elif h_online:
-        latest_online = h_online
-    elif m_online:
-        latest_online = m_online
-
-    base_info['last_online'] = latest_online
-    
-    # محاسبه وضعیت آنلاین
-    base_info['is_online'] = False
-    if latest_online:
-        try:
-            time_diff_seconds = (datetime.now(pytz.utc) - latest_online).total_seconds()
-            if 0 <= time_diff_seconds < 180:
-                base_info['is_online'] = True
-        except:
-            base_info['is_online'] = False
-
-    base_info['name'] = h_info.get('name') or m_info.get('name', 'ناشناس')
-    base_info['username'] = base_info['name']
-    base_info['uuid'] = h_info.get('uuid') or m_info.get('uuid')
-    
-    # اصلاح 3: بهبود منطق expire
-    h_expire = h_info.get('expire', -1)
-    m_expire = m_info.get('expire', -1)
-
-    if h_expire == -1 and m_expire == -1:
-        base_info['expire'] = -1  # نامحدود
-    elif h_expire == -1:
-        base_info['expire'] = m_expire
-    elif m_expire == -1:
-        base_info['expire'] = h_expire
-    else:
-        base_info['expire'] = max(h_expire, m_expire)
-    
-    # اصلاح 4: درست کردن indentation
-    base_info['on_hiddify'] = bool(h_info)
-    base_info['on_marzban'] = bool(m_info)
 
-    return base_info
+def _cached_user_info(identifier: str) -> Optional[Dict[str, Any]]:
+    """اطلاعات اکانت از کش یا از لیست‌های تازه پنل‌ها؛ None یعنی باید از API تکی پرسیده شود."""
+    info = user_info_cache.get(identifier)
+    if info is not None:
+        return info
+    try:
+        info = _find_in_user_lists(identifier)
+    except Exception as e:
+        logger.warning(f"Error building user info for {identifier} from cached user lists: {e}")
+        return None
+    if info:
+        _remember_user_info(info, identifier)
+    return info
+
+
+def _remember_user_info(info: Dict[str, Any], identifier: str) -> None:
+    # نام کاربری مرزبان هم کلید می‌شود تا جستجو با نام کاربری همان ورودی را پیدا کند
+    marzban_username = (info.get('breakdown', {}).get('marzban') or {}).get('username')
+    user_info_cache.put(info, identifier, marzban_username)
 
 
-def get_combined_user_info(identifier: str) -> Optional[Dict[str, Any]]:
+def invalidate_user_info(*identifiers: Optional[str]) -> None:
     """
-    دریافت اطلاعات ترکیبی یک کاربر از هر دو پنل بر اساس UUID یا نام کاربری
+    بعد از هر تغییر روی پنل‌ها صدا زده می‌شود. ورودی کش اکانت پاک و لیست کاربران پنل‌ها منقضی
+    می‌شود تا خواندن بعدی داده قبل از تغییر را از لیست‌ها برنگرداند.
+    """
+    user_info_cache.invalidate(*identifiers)
+    hiddify_handler.users_cache.invalidate()
+    marzban_handler.users_cache.invalidate()
+
+
+def get_combined_user_info(identifier: str, use_cache: bool = True) -> Optional[Dict[str, Any]]:
     """
+    دریافت اطلاعات ترکیبی یک کاربر از هر دو پنل بر اساس UUID یا نام کاربری.
+    با use_cache=True ابتدا user_info_cache و لیست‌های تازه پنل‌ها بررسی می‌شوند؛ عملیات نوشتن
+    که به مقدار فعلی وابسته است (مثل افزودن حجم) باید use_cache=False بدهد.
+    """
+    if use_cache and (info := _cached_user_info(identifier)) is not None:
+        return info
+    info = _fetch_combined_user_info(identifier)
+    if info:
+        _remember_user_info(info, identifier)
+    return info
+
+
+def _fetch_combined_user_info(identifier: str) -> Optional[Dict[str, Any]]:
+    """درخواست مستقیم اطلاعات یک کاربر از API هر دو پنل."""
     try:
         is_uuid = validate_uuid(identifier)
         h_info, m_info = None, None
@@ -157,15 +148,75 @@ def get_combined_user_info(identifier: str) -> Optional[Dict[str, Any]]:
         return _process_single_user_data(h_info, m_info)
         
     except Exception as e:
-        logger.error(f"Critical error in get_combined_user_info for {identifier}: {e}")
+        logger.error(f"Critical error in _fetch_combined_user_info for {identifier}: {e}")
+        return None
+
+async def get_combined_user_info_async(identifier: str) -> Optional[Dict[str, Any]]:
+    """
+    نسخه async از get_combined_user_info. برای UUID هر دو پنل به صورت همزمان پرسیده می‌شوند.
+    """
+    if (info := _cached_user_info(identifier)) is not None:
+        return info
+    info = await _fetch_combined_user_info_async(identifier)
+    if info:
+        _remember_user_info(info, identifier)
+    return info
+
+
+async def _fetch_combined_user_info_async(identifier: str) -> Optional[Dict[str, Any]]:
+    try:
+        h_info, m_info = None, None
+
+        if validate_uuid(identifier):
+            h_result, m_result = await asyncio.gather(
+                async_hiddify_handler.user_info(identifier),
+                async_marzban_handler.get_user_info(identifier),
+                return_exceptions=True
+            )
+            if isinstance(h_result, Exception):
+                logger.warning(f"Error fetching Hiddify user {identifier}: {h_result}")
+            else:
+                h_info = h_result
+            if isinstance(m_result, Exception):
+                logger.warning(f"Error fetching Marzban user by UUID {identifier}: {m_result}")
+            else:
+                m_info = m_result
+        else:
+            # جستجو بر اساس نام کاربری: UUID هیدیفای از پاسخ مرزبان به دست می‌آید
+            try:
+                m_info = await async_marzban_handler.get_user_by_username(identifier)
+                if m_info and m_info.get('uuid'):
+                    try:
+                        h_info = await async_hiddify_handler.user_info(m_info['uuid'])
+                    except Exception as e:
+                        logger.warning(f"Error fetching Hiddify user by UUID {m_info['uuid']}: {e}")
+            except Exception as e:
+                logger.warning(f"Error fetching Marzban user by username {identifier}: {e}")
+
+        return _process_single_user_data(h_info, m_info)
+
+    except Exception as e:
+        logger.error(f"Critical error in _fetch_combined_user_info_async for {identifier}: {e}")
         return None
 
+
+def get_combined_user_infos(identifiers: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """
+    اطلاعات ترکیبی چند کاربر به صورت همزمان (با سقف PANEL_CONCURRENCY_LIMIT).
+    خروجی به ترتیب identifiers است و برای کاربر ناموجود None دارد.
+    """
+    if not identifiers:
+        return []
+    return run_sync(gather_limited(get_combined_user_info_async(identifier) for identifier in identifiers))
+
+
 def modify_user_on_all_panels(identifier: str, add_gb: float = 0, add_days: int = 0, target_panel: str = 'both') -> bool:
     """
     Modifies a user on Hiddify, Marzban, or both, handling relative additions.
     This is a new, crucial function to fix editing bugs.
     """
-    info = get_combined_user_info(identifier)
+    # مقادیر جدید نسبت به مقدار فعلی حساب می‌شوند، پس داده کش‌شده کافی نیست
+    info = get_combined_user_info(identifier, use_cache=False)
     if not info:
         logger.error(f"Cannot modify non-existent user: {identifier}")
         return False
@@ -203,6 +254,7 @@ def modify_user_on_all_panels(identifier: str, add_gb: float = 0, add_days: int
             add_days=add_days
         )
 
+    invalidate_user_info(identifier, info.get('uuid'), info.get('name'))
     return h_success and m_success
 
 def delete_user_from_all_panels(identifier: str) -> bool:
@@ -215,6 +267,7 @@ def delete_user_from_all_panels(identifier: str) -> bool:
         h_success = hiddify_handler.delete_user(h_uuid)
     if m_username and 'marzban' in info.get('breakdown', {}):
         m_success = marzban_handler.delete_user(m_username)
+    invalidate_user_info(identifier, h_uuid, m_username)
     if h_success and m_success and h_uuid:
         db_id = db.get_uuid_id_by_uuid(h_uuid)
         if db_id:
@@ -222,14 +275,89 @@ def delete_user_from_all_panels(identifier: str) -> bool:
             db.delete_user_snapshots(db_id)
     return h_success and m_success
 
-def get_all_users_combined() -> List[Dict[str, Any]]:
+def _fetch_all_panels(deadlines: Optional[Dict[str, float]] = None, max_age: Optional[float] = None,
+                      allow_stale: bool = True) -> Dict[str, Optional[List[Dict[str, Any]]]]:
+    """
+    لیست کاربران هر دو پنل را به صورت همزمان دریافت می‌کند.
+    هر پنل مهلت جداگانه خود را دارد (از لحظه شروع)؛ پنلی که به موقع پاسخ ندهد یا خطا بدهد None برمی‌گرداند.
+    درخواست کند در پس‌زمینه ادامه پیدا می‌کند و نتیجه‌اش برای فراخوانی بعدی در کش می‌ماند.
+    """
+    deadlines = {**PANEL_FETCH_DEADLINES, **(deadlines or {})}
+    fetchers = {'hiddify': hiddify_handler.get_all_users, 'marzban': marzban_handler.get_all_users}
+    started = time.monotonic()
+    futures = {panel: _panel_executor.submit(fetch, max_age, allow_stale) for panel, fetch in fetchers.items()}
+
+    results = {}
+    for panel, future in futures.items():
+        remaining = max(0.0, deadlines[panel] - (time.monotonic() - started))
+        try:
+            results[panel] = future.result(timeout=remaining) or []
+            logger.info(f"COMBINED_HANDLER: Fetched {len(results[panel])} users from {panel} in {time.monotonic() - started:.2f}s.")
+        except FutureTimeoutError:
+            logger.warning(f"COMBINED_HANDLER: {panel} did not answer within {deadlines[panel]}s, continuing without it.")
+            results[panel] = None
+        except Exception as e:
+            logger.error(f"COMBINED_HANDLER: Fetching users from {panel} failed: {e}", exc_info=True)
+            results[panel] = None
+    return results
+
+
+def get_all_users_combined(deadlines: Optional[Dict[str, float]] = None, max_age: Optional[float] = None,
+                           allow_stale: bool = True) -> CombinedUsers:
+    """
+    کاربران هر دو پنل را (به صورت همزمان) دریافت و ترکیب می‌کند.
+    خروجی یک CombinedUsers است؛ اگر پنلی در مهلت خود پاسخ ندهد، داده پنل دیگر با partial=True برگردانده می‌شود.
+    max_age و allow_stale میزان تازگی لازم برای این مصرف‌کننده را به کش پنل‌ها (panel_cache) می‌رسانند.
+    """
     logger.info("COMBINED_HANDLER: Starting to fetch users from all panels.")
+    return _combine_panel_users(_fetch_all_panels(deadlines, max_age, allow_stale))
+
+
+def _mirror_is_fresh(panels, max_age: float) -> bool:
+    state = read_db.get_panel_sync_state()
+    now = time.time()
+    return all(state.get(p, {}).get('synced_at') and now - state[p]['synced_at'] <= max_age for p in panels)
+
+
+def get_panel_users_mirrored(panel: str, max_age: float = PANEL_MIRROR_MAX_AGE) -> List[Dict[str, Any]]:
+    """
+    کاربران یک پنل از جدول panel_users (کپی محلی که panel_sync پر می‌کند).
+    اگر کپی قدیمی‌تر از max_age باشد یا در دسترس نباشد، از خود پنل خوانده می‌شود.
+    """
+    try:
+        if _mirror_is_fresh([panel], max_age):
+            return read_db.get_panel_users(panel)
+    except Exception as e:
+        logger.warning(f"COMBINED_HANDLER: Panel mirror unavailable, reading {panel} live: {e}")
+    handler = hiddify_handler if panel == 'hiddify' else marzban_handler
+    return handler.get_all_users()
+
+
+def get_all_users_mirrored(max_age: float = PANEL_MIRROR_MAX_AGE, live_max_age: Optional[float] = None) -> CombinedUsers:
+    """
+    همان خروجی get_all_users_combined، ولی از جدول panel_users و بدون درخواست به پنل‌ها.
+    برای جستجو، گزارش‌ها، فیلتر پلن‌ها، ارسال همگانی و داشبورد وب‌اپ (در هر دو پروسه).
+    اگر کپی یکی از پنل‌ها قدیمی‌تر از max_age باشد، به get_all_users_combined(max_age=live_max_age) برمی‌گردد.
+    """
+    try:
+        if _mirror_is_fresh(('hiddify', 'marzban'), max_age):
+            return _combine_panel_users({
+                'hiddify': read_db.get_panel_users('hiddify'),
+                'marzban': read_db.get_panel_users('marzban'),
+            })
+        logger.info("COMBINED_HANDLER: Panel mirror is stale, fetching users live.")
+    except Exception as e:
+        logger.warning(f"COMBINED_HANDLER: Panel mirror unavailable, fetching users live: {e}")
+    return get_all_users_combined(max_age=live_max_age)
+
+
+def _combine_panel_users(panel_users: Dict[str, Optional[List[Dict[str, Any]]]]) -> CombinedUsers:
+    """لیست کاربران دو پنل را بر اساس UUID ترکیب می‌کند؛ پنلی که None باشد در missing_panels می‌آید."""
+    missing_panels = [panel for panel, users in panel_users.items() if users is None]
     all_users_map = {}
     
     # دریافت کاربران از هیدیفای
-    logger.info("COMBINED_HANDLER: Fetching from Hiddify...")
-    h_users = hiddify_handler.get_all_users() or []
-    logger.info(f"COMBINED_HANDLER: Fetched {len(h_users)} users from Hiddify.")
+    h_users = panel_users['hiddify'] or []
     
     for user in h_users:
         uuid = user.get('uuid')
@@ -237,16 +365,14 @@ def get_all_users_combined() -> List[Dict[str, Any]]:
             all_users_map[uuid] = _process_single_user_data(user, None)
 
     # دریافت کاربران از مرزبان
-    logger.info("COMBINED_HANDLER: Fetching from Marzban...")
-    m_users = marzban_handler.get_all_users() or []
-    logger.info(f"COMBINED_HANDLER: Fetched {len(m_users)} users from Marzban.")
+    m_users = panel_users['marzban'] or []
     
     for user in m_users:
         uuid = user.get('uuid')
         if uuid:
             if uuid in all_users_map:
                 # کاربر در هر دو پنل وجود دارد
-                h_data = all_users_map[uuid]['breakdown']['hiddify']
+                h_data = all_users_map[uuid].hiddify
                 all_users_map[uuid] = _process_single_user_data(h_data, user)
             else:
                 # کاربر فقط در مرزبان وجود دارد
@@ -258,16 +384,32 @@ def get_all_users_combined() -> List[Dict[str, Any]]:
                 all_users_map[f"marzban_{username}"] = _process_single_user_data(None, user)
     
     # فیلتر کردن None values
-    result = [user for user in all_users_map.values() if user is not None]
+    result = CombinedUsers((user for user in all_users_map.values() if user is not None), missing_panels)
+    if result.partial:
+        logger.warning(f"COMBINED_HANDLER: Returning partial data, missing panels: {', '.join(missing_panels)}")
     logger.info(f"COMBINED_HANDLER: Total processed users: {len(result)}")
     return result
 
 
 def search_user(query: str) -> List[Dict[str, Any]]:
+    """
+    جستجو بر اساس نام، UUID، نام کاربری مرزبان، مشخصات تلگرام و یادداشت ادمین از طریق search_index.
+    نتایج رتبه‌بندی‌شده و اطلاعات ترکیبی کامل هر کاربر هستند. تا وقتی ایندکس آماده نباشد
+    (مثلا قبل از اولین همگام‌سازی)، نام و UUID همه کاربران کپی محلی بررسی می‌شود.
+    """
+    hits = search_index.search(query)
+    if hits is not None:
+        results = []
+        for h_info, m_info in hits:
+            user = _process_single_user_data(h_info, m_info)
+            panel = 'hiddify' if 'hiddify' in user.get('breakdown', {}) else 'marzban'
+            results.append({**user, 'panel': panel})
+        return results
+
     query_lower = query.lower()
     results, found_identifiers = [], set()
 
-    all_users = get_all_users_combined()
+    all_users = get_all_users_mirrored()
     for user in all_users:
         identifier = user.get('uuid') or user.get('name')
         if identifier in found_identifiers: continue
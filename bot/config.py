@@ -1,7 +1,6 @@
 import os
 from datetime import time
 import pytz
-from cachetools import TTLCache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -46,9 +45,25 @@ TELEGRAM_FILE_SIZE_LIMIT_BYTES = 50 * 1024 * 1024
 
 CUSTOM_SUB_LINK_BASE_URL = "https://drive.google.com/uc?export=download&id="
 
-# --- تعریف یک کش با زمان انقضای ۶۰ ثانیه ---
-# maxsize=2 یعنی حداکثر ۲ نتیجه متفاوت (معمولاً ۱ نتیجه get_all_users) را نگه می‌دارد
-api_cache = TTLCache(maxsize=2, ttl=60)
+# --- کش لیست کاربران پنل‌ها (panel_cache) ---
+PANEL_CACHE_TTL = 60              # داده جوان‌تر از این (ثانیه) تازه حساب می‌شود
+PANEL_CACHE_STALE_TTL = 600       # تا این سن، داده قدیمی برگردانده و در پس‌زمینه تازه می‌شود
+PANEL_CACHE_WEBAPP_MAX_AGE = 120  # داشبورد و گزارش‌های وب‌اپ داده کمی قدیمی‌تر را هم می‌پذیرند
+USER_INFO_CACHE_TTL = 30          # اطلاعات ترکیبی هر اکانت (get_combined_user_info) تا این مدت از کش خوانده می‌شود
+MARZBAN_USERS_PAGE_SIZE = 500     # تعداد کاربر در هر صفحه از /users مرزبان (offset/limit)
+MARZBAN_USERS_FETCH_ATTEMPTS = 3  # اگر لیست مرزبان حین صفحه‌بندی تغییر کند، دانلود کامل تا این تعداد تکرار می‌شود
+SEARCH_RESULT_LIMIT = 50          # حداکثر نتایج جستجوی سراسری ادمین (search_index)
+MARZBAN_USER_MAP_CHECK_SECONDS = 10  # فاصله بررسی تغییر فایل uuid_to_marzban_user.json و جدول marzban_user_map
+
+# --- بخش‌بندی کاربران بر اساس last_online (bot/presence.py) ---
+ONLINE_WINDOW_SECONDS = 180                 # آنلاین: اتصال در ۳ دقیقه اخیر
+ACTIVE_WINDOW_SECONDS = 24 * 3600           # فعال: اتصال در ۲۴ ساعت اخیر
+INACTIVE_WINDOW_SECONDS = 7 * 24 * 3600     # غیرفعال: آخرین اتصال بین ۱ تا ۷ روز پیش
+DORMANT_AFTER_SECONDS = 30 * 24 * 3600      # بی‌استفاده: آخرین اتصال بیش از ۳۰ روز پیش
+
+# --- کپی محلی کاربران پنل‌ها (panel_users) ---
+PANEL_SYNC_INTERVAL = 60          # فاصله همگام‌سازی پنل‌ها با جدول panel_users (ثانیه)
+PANEL_MIRROR_MAX_AGE = 300        # اگر آخرین همگام‌سازی قدیمی‌تر از این باشد، خواننده‌ها مستقیم از پنل می‌خوانند
 
 DAILY_USAGE_ALERT_THRESHOLD_GB = 5
 WARNING_USAGE_THRESHOLD = 85 # آستانه هشدار مصرف به درصد
@@ -57,12 +72,22 @@ NOTIFY_ADMIN_ON_USAGE = True # فعال/غیرفعال کردن این قابل
 USAGE_WARNING_CHECK_HOURS = 4    # فاصله زمانی چک کردن هشدار مصرف (به ساعت)
 ONLINE_REPORT_UPDATE_HOURS = 3 # فاصله زمانی آپدیت گزارش کاربران آنلاین (به ساعت)
 
+# --- Snapshot Retention ---
+SNAPSHOT_RAW_RETENTION_DAYS = 7     # snapshot های ساعتی تا این تعداد روز کامل نگه داشته می‌شوند
+SNAPSHOT_DAILY_RETENTION_DAYS = 90  # پس از آن، فقط یک نقطه در روز تا این تعداد روز می‌ماند
+SNAPSHOT_RETENTION_BATCH_SIZE = 500 # تعداد ردیف حذف‌شده در هر تراکنش
+SNAPSHOT_RETENTION_TIME = "03:30"
+
 WARNING_90_PERCENT = 90
 WARNING_DAYS_BEFORE_EXPIRY = 2
 
 # --- API Settings ---
 API_TIMEOUT = 15
 API_RETRY_COUNT = 3
+# حداکثر زمان انتظار (ثانیه) برای دریافت لیست کامل کاربران هر پنل در get_all_users_combined
+PANEL_FETCH_DEADLINES = {'hiddify': 20, 'marzban': 20}
+# حداکثر تعداد درخواست همزمان به پنل‌ها در عملیات گروهی (async_api)
+PANEL_CONCURRENCY_LIMIT = 8
 
 # --- Emojis & Visuals ---
 EMOJIS = {
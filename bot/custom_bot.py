@@ -8,6 +8,7 @@ from .bot_instance import bot, admin_conversations
 from .config import LOG_LEVEL, ADMIN_IDS, BOT_TOKEN
 from .database import db
 from .scheduler import SchedulerManager
+from .panel_sync import panel_sync
 from .user_handlers import register_user_handlers
 from .admin_router import register_admin_handlers 
 from .callback_router import register_callback_router
@@ -98,6 +99,9 @@ class HiddifyBot:
             scheduler.start()
             logger.info("✅ Scheduler thread started")
 
+            panel_sync.start()
+            logger.info("✅ Panel sync thread started")
+
             _notify_admins_start()
 
             self.running = True
@@ -124,6 +128,7 @@ class HiddifyBot:
         try:
             scheduler.shutdown()
             logger.info("Scheduler stopped")
+            panel_sync.shutdown()
             self.bot.stop_polling()
             logger.info("Telegram polling stopped")
             if self.started_at:
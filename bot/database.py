@@ -1,185 +1,739 @@
 # -*- coding: utf-8 -*-
 
+import json
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import logging
+import time
+from urllib.parse import quote
 import pytz
+from .records import panel_record
 
 logger = logging.getLogger(__name__)
 
+# تعداد statement های آماده که هر اتصال در حافظه نگه می‌دارد
+STATEMENT_CACHE_SIZE = 256
+
+# نسخه schema؛ باید با آخرین مهاجرت DatabaseManager._MIGRATIONS برابر باشد
+SCHEMA_VERSION = 7
+# مدت انتظار برای قفل دیتابیس وقتی پروسه دیگری در حال اجرای مهاجرت است
+MIGRATION_LOCK_TIMEOUT_MS = 60000
+
+# تنظیمات اتصال‌های فقط‌خواندنی (وب‌اپ): فایل تا این حجم mmap می‌شود و کش صفحه‌ها به کیلوبایت
+READ_ONLY_MMAP_SIZE = 256 * 1024 * 1024
+READ_ONLY_CACHE_KIB = 32 * 1024
+
+# snapshot بدون تغییر ذخیره نمی‌شود، مگر اینکه از آخرین ردیف ذخیره‌شده این مدت (ثانیه) گذشته باشد
+SNAPSHOT_KEYFRAME_INTERVAL = 24 * 3600
+
+USAGE_INTERVAL_HOURS = (3, 6, 12, 24)
+# حداکثر تعداد uuid_id در هر کوئری دسته‌ای (هر شناسه دو بار در کوئری تکرار می‌شود)
+_INTERVAL_BATCH_CHUNK = 400
+
+TEHRAN_TZ = pytz.timezone("Asia/Tehran")
+
+_USAGE_DAILY_UPSERT = """
+    INSERT INTO usage_daily (uuid_id, day, hiddify_min_gb, hiddify_max_gb, marzban_min_gb, marzban_max_gb, hiddify_gb, marzban_gb)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(uuid_id, day) DO UPDATE SET
+        hiddify_min_gb = MIN(hiddify_min_gb, excluded.hiddify_min_gb),
+        hiddify_max_gb = MAX(hiddify_max_gb, excluded.hiddify_max_gb),
+        marzban_min_gb = MIN(marzban_min_gb, excluded.marzban_min_gb),
+        marzban_max_gb = MAX(marzban_max_gb, excluded.marzban_max_gb),
+        hiddify_gb = MAX(hiddify_max_gb, excluded.hiddify_max_gb) - MIN(hiddify_min_gb, excluded.hiddify_min_gb),
+        marzban_gb = MAX(marzban_max_gb, excluded.marzban_max_gb) - MIN(marzban_min_gb, excluded.marzban_min_gb)
+"""
+
+
+# ستون‌های زمانی این جداول به صورت epoch صحیح (ثانیه، UTC) ذخیره می‌شوند.
+# تبدیل به datetime و وقت تهران فقط در لایه نمایش (utils.to_shamsi و ...) انجام می‌شود.
+_EPOCH_TABLE_SCHEMAS = {
+    'user_uuids': """
+        CREATE TABLE {if_not_exists}{name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            uuid TEXT UNIQUE,
+            name TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            updated_at INTEGER,
+            first_connection_time INTEGER,
+            welcome_message_sent INTEGER DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )""",
+    'usage_snapshots': """
+        CREATE TABLE {if_not_exists}{name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid_id INTEGER,
+            hiddify_usage_gb REAL DEFAULT 0,
+            marzban_usage_gb REAL DEFAULT 0,
+            taken_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            FOREIGN KEY(uuid_id) REFERENCES user_uuids(id) ON DELETE CASCADE
+        )""",
+    'warning_log': """
+        CREATE TABLE {if_not_exists}{name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid_id INTEGER NOT NULL,
+            warning_type TEXT NOT NULL, -- e.g., 'expiry', 'low_data_hiddify'
+            sent_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            UNIQUE(uuid_id, warning_type)
+        )""",
+    'payments': """
+        CREATE TABLE {if_not_exists}{name} (
+            payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid_id INTEGER NOT NULL,
+            payment_date INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            FOREIGN KEY(uuid_id) REFERENCES user_uuids(id) ON DELETE CASCADE
+        )""",
+}
+
+_EPOCH_COLUMNS = {
+    'user_uuids': ('created_at', 'updated_at', 'first_connection_time'),
+    'usage_snapshots': ('taken_at',),
+    'warning_log': ('sent_at',),
+    'payments': ('payment_date',),
+}
+
+_PANEL_USER_UPSERT = """
+    INSERT INTO panel_users (panel, panel_key, uuid, name, is_active, usage_limit_gb, current_usage_gb,
+                             expire_days, last_online, data, generation, synced_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(panel, panel_key) DO UPDATE SET
+        uuid = excluded.uuid, name = excluded.name, is_active = excluded.is_active,
+        usage_limit_gb = excluded.usage_limit_gb, current_usage_gb = excluded.current_usage_gb,
+        expire_days = excluded.expire_days, last_online = excluded.last_online, data = excluded.data,
+        generation = excluded.generation, synced_at = excluded.synced_at
+"""
+
+_BASE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_user_uuids_uuid ON user_uuids(uuid)",
+    "CREATE INDEX IF NOT EXISTS idx_user_uuids_user_id ON user_uuids(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_messages_job_type ON scheduled_messages(job_type)",
+)
+
+
+def _epoch(dt: Optional[datetime] = None) -> int:
+    """یک datetime (naive یعنی UTC) یا زمان فعلی را به epoch صحیح تبدیل می‌کند."""
+    if dt is None:
+        return int(time.time())
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return int(dt.timestamp())
+
+
+def panel_user_key(panel: str, user: Dict[str, Any]) -> Optional[str]:
+    """کلید یک کاربر در panel_users: uuid در هیدیفای، نام کاربری در مرزبان."""
+    if panel == 'hiddify':
+        return user.get('uuid') or None
+    return user.get('username') or user.get('name') or None
+
+
+def _tehran_day(ts: Optional[int] = None) -> str:
+    """روز تقویمی تهران (YYYY-MM-DD) برای یک epoch یا زمان فعلی."""
+    return datetime.fromtimestamp(time.time() if ts is None else ts, TEHRAN_TZ).strftime('%Y-%m-%d')
+
 class DatabaseManager:
-    def __init__(self, path: str = "bot_data.db"):
+    def __init__(self, path: str = "bot_data.db", read_only: bool = False):
+        """
+        read_only=True برای پروسه‌هایی مثل وب‌اپ است که فقط می‌خوانند: اتصال با mode=ro و
+        query_only باز می‌شود و هیچ مهاجرتی اجرا نمی‌کند، پس با نوشتن‌های ربات رقابت نمی‌کند.
+        فقط اگر فایل دیتابیس هنوز وجود نداشته باشد، یک بار با یک اتصال نوشتنی ساخته و مهاجرت می‌شود.
+        """
         self.path = path
-        self._init_db()
+        self.read_only = read_only
+        self._local = threading.local()
+        # آخرین مقدار ذخیره‌شده هر uuid_id: (hiddify_gb, marzban_gb, taken_at epoch)
+        self._last_snapshots: Optional[Dict[int, Tuple[float, float, int]]] = None
+        self._snapshot_lock = threading.Lock()
+        # schema به صورت lazy با اولین اتصال بررسی می‌شود، نه هنگام import
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
 
-    def _conn(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
-        conn.execute("PRAGMA journal_mode=WAL")
-        conn.execute("PRAGMA foreign_keys = ON;")
+    def _connect(self) -> sqlite3.Connection:
+        """یک اتصال جدید می‌سازد و PRAGMA ها را فقط یک بار روی آن تنظیم می‌کند."""
+        if self.read_only:
+            if not os.path.exists(self.path):
+                self._create_database()
+            conn = sqlite3.connect(
+                f"file:{quote(os.path.abspath(self.path))}?mode=ro",
+                uri=True,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+            conn.execute("PRAGMA query_only = ON")
+            conn.execute(f"PRAGMA mmap_size = {READ_ONLY_MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size = -{READ_ONLY_CACHE_KIB}")
+        else:
+            conn = sqlite3.connect(
+                self.path,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+            conn.execute("PRAGMA foreign_keys = ON;")
+            conn.execute("PRAGMA synchronous=NORMAL")
         conn.row_factory = sqlite3.Row
         return conn
 
-    def _init_db(self) -> None:
-        with self._conn() as c:
+    def _create_database(self) -> None:
+        """
+        mode=ro نمی‌تواند فایل را بسازد؛ اگر وب‌اپ قبل از ربات اجرا شود، دیتابیس با schema کامل
+        از طریق یک DatabaseManager نوشتنی ساخته می‌شود. اجرای همزمان چند worker امن است چون
+        مهاجرت‌ها در یک تراکنش EXCLUSIVE و با بررسی دوباره user_version اجرا می‌شوند.
+        """
+        logger.info(f"Database file {self.path} does not exist yet; creating it before opening read-only.")
+        writer = DatabaseManager(self.path)
+        try:
+            writer._get_connection()
+        finally:
+            writer.close()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """
+        اتصال اختصاصی thread فعلی را برمی‌گرداند و در صورت نبود، آن را می‌سازد.
+        بعد از fork (مثلاً در worker های gunicorn) اتصال والد استفاده نمی‌شود.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None or local.pid != os.getpid():
+            conn = self._connect()
+            self._ensure_schema(conn)
+            local.conn, local.pid, local.tx_depth = conn, os.getpid(), 0
+        return conn
+
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        """
+        اتصال pool شده thread فعلی را در اختیار می‌گذارد.
+        در پایان بلاک commit (یا در صورت خطا rollback) می‌کند، مگر اینکه داخل transaction() باشیم.
+        """
+        conn = self._get_connection()
+        if self._local.tx_depth:
+            yield conn
+            return
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        چند عملیات را در یک تراکنش صریح (BEGIN IMMEDIATE) اجرا می‌کند.
+        فراخوانی‌های تو در تو و متدهای دیگر داخل این بلاک به همان تراکنش می‌پیوندند.
+        """
+        conn = self._get_connection()
+        local = self._local
+        if local.tx_depth:
+            local.tx_depth += 1
             try:
-                c.execute("ALTER TABLE users ADD COLUMN data_warning_hiddify INTEGER DEFAULT 1;")
-                logger.info("Column 'data_warning_hiddify' added to 'users' table.")
-            except sqlite3.OperationalError:
-                pass
+                yield conn
+            finally:
+                local.tx_depth -= 1
+            return
+
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        local.tx_depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            local.tx_depth = 0
+
+    def close(self) -> None:
+        """اتصال thread فعلی را می‌بندد. اتصال بقیه thread ها با پایان آن‌ها بسته می‌شود."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Schema migrations
+    # ------------------------------------------------------------------
+    # هر مهاجرت با PRAGMA user_version دقیقا یک بار و به ترتیب اجرا می‌شود. مهاجرت‌ها روی
+    # دیتابیس‌های قدیمی (user_version = 0) که بخشی از schema را از قبل دارند هم بدون خطا کار می‌کنند.
+    _MIGRATIONS = (
+        (1, "_migration_base_schema"),
+        (2, "_migration_epoch_columns"),
+        (3, "_migration_usage_daily"),
+        (4, "_migration_covering_indexes"),
+        (5, "_migration_panel_mirror"),
+        (6, "_migration_plan_index"),
+        (7, "_migration_marzban_user_map"),
+    )
 
+    def _ensure_schema(self, conn: sqlite3.Connection) -> None:
+        """
+        Runs on the first connection of the process. When the schema is current this costs
+        a single PRAGMA user_version read; otherwise pending migrations are applied.
+        """
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                if self.read_only:
+                    # مهاجرت فقط توسط پروسه نویسنده (ربات) انجام می‌شود
+                    logger.warning(f"Read-only database is at schema version {version}, expected {SCHEMA_VERSION}. Start the bot to migrate it.")
+                else:
+                    self._run_migrations(conn)
+            self._schema_ready = True
+
+    def _run_migrations(self, conn: sqlite3.Connection) -> None:
+        """
+        Applies pending migrations in one BEGIN EXCLUSIVE transaction, so the bot and the
+        webapp workers starting together never apply the same migration twice. The version
+        is read again once the lock is held.
+        """
+        # journal_mode فقط بیرون از تراکنش قابل تغییر است و در فایل دیتابیس ماندگار می‌ماند
+        conn.execute("PRAGMA journal_mode=WAL")
+        # بازسازی جداول با foreign_keys روشن، ردیف‌های وابسته را cascade حذف می‌کند
+        conn.execute("PRAGMA foreign_keys = OFF")
+        conn.execute(f"PRAGMA busy_timeout = {MIGRATION_LOCK_TIMEOUT_MS}")
+        try:
+            conn.execute("BEGIN EXCLUSIVE")
             try:
-                c.execute("ALTER TABLE users ADD COLUMN data_warning_marzban INTEGER DEFAULT 1;")
-                logger.info("Column 'data_warning_marzban' added to 'users' table.")
-            except sqlite3.OperationalError:
-                pass
-
-            c.executescript("""
-                                CREATE TABLE IF NOT EXISTS users (
-                                    user_id INTEGER PRIMARY KEY,
-                                    username TEXT,
-                                    first_name TEXT,
-                                    birthday DATE,
-                                    last_name TEXT,
-                                    daily_reports INTEGER DEFAULT 1,
-                                    expiry_warnings INTEGER DEFAULT 1,
-                                    data_warning_hiddify INTEGER DEFAULT 1,
-                                    data_warning_marzban INTEGER DEFAULT 1,
-                                    admin_note TEXT
-                                );
-                                CREATE TABLE IF NOT EXISTS user_uuids (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    user_id INTEGER,
-                                    uuid TEXT UNIQUE,
-                                    name TEXT,
-                                    is_active INTEGER DEFAULT 1,
-                                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                    updated_at TIMESTAMP,
-                                    first_connection_time TIMESTAMP,
-                                    welcome_message_sent INTEGER DEFAULT 0,
-                                    FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
-                                );
-                                CREATE TABLE IF NOT EXISTS usage_snapshots (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    uuid_id INTEGER,
-                                    hiddify_usage_gb REAL DEFAULT 0,
-                                    marzban_usage_gb REAL DEFAULT 0,
-                                    taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                    FOREIGN KEY(uuid_id) REFERENCES user_uuids(id) ON DELETE CASCADE
-                                );
-                                CREATE TABLE IF NOT EXISTS scheduled_messages (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    job_type TEXT NOT NULL,
-                                    chat_id INTEGER NOT NULL,
-                                    message_id INTEGER NOT NULL,
-                                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                    UNIQUE(job_type, chat_id)
-                                );
-                                CREATE TABLE IF NOT EXISTS warning_log (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    uuid_id INTEGER NOT NULL,
-                                    warning_type TEXT NOT NULL, -- e.g., 'expiry', 'low_data_hiddify'
-                                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                    UNIQUE(uuid_id, warning_type)
-                                );
-                                CREATE TABLE IF NOT EXISTS payments (
-                                    payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    uuid_id INTEGER NOT NULL,
-                                    payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                    FOREIGN KEY(uuid_id) REFERENCES user_uuids(id) ON DELETE CASCADE
-                                );
-                                CREATE TABLE IF NOT EXISTS config_templates (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    template_str TEXT NOT NULL,     -- متن کامل کانفیگ vless://...
-                                    is_active INTEGER DEFAULT 1,           -- وضعیت فعال/غیرفعال (1=فعال)
-                                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                                );
-
-                                CREATE TABLE IF NOT EXISTS user_generated_configs (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    user_uuid_id INTEGER NOT NULL,
-                                    template_id INTEGER NOT NULL,
-                                    generated_uuid TEXT NOT NULL UNIQUE,
-                                    FOREIGN KEY(user_uuid_id) REFERENCES user_uuids(id) ON DELETE CASCADE,
-                                    FOREIGN KEY(template_id) REFERENCES config_templates(id) ON DELETE CASCADE,
-                                    UNIQUE(user_uuid_id, template_id)
-                                );
-                                    CREATE INDEX IF NOT EXISTS idx_user_uuids_uuid ON user_uuids(uuid);
-                                    CREATE INDEX IF NOT EXISTS idx_user_uuids_user_id ON user_uuids(user_id);
-                                    CREATE INDEX IF NOT EXISTS idx_snapshots_uuid_id_taken_at ON usage_snapshots(uuid_id, taken_at);
-                                    CREATE INDEX IF NOT EXISTS idx_scheduled_messages_job_type ON scheduled_messages(job_type);
-                                    CREATE INDEX IF NOT EXISTS idx_warning_log_uuid_type ON warning_log(uuid_id, warning_type);
-                                """)
-        logger.info("SQLite schema and indexes are ready.")
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for target, name in self._MIGRATIONS:
+                    if target <= version:
+                        continue
+                    logger.info(f"Applying database migration {target} ({name}).")
+                    getattr(self, name)(conn)
+                    conn.execute(f"PRAGMA user_version = {target}")
+                problems = conn.execute("PRAGMA foreign_key_check").fetchall()
+                if problems:
+                    logger.warning(f"Database migrations finished with {len(problems)} orphaned foreign key row(s).")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        finally:
+            conn.execute("PRAGMA busy_timeout = 5000")
+            conn.execute("PRAGMA foreign_keys = ON")
+        logger.info(f"SQLite schema is at version {SCHEMA_VERSION}.")
 
-    def add_usage_snapshot(self, uuid_id: int, hiddify_usage: float, marzban_usage: float) -> None:
-        with self._conn() as c:
-            c.execute(
-                "INSERT INTO usage_snapshots (uuid_id, hiddify_usage_gb, marzban_usage_gb, taken_at) VALUES (?, ?, ?, ?)",
-                (uuid_id, hiddify_usage, marzban_usage, datetime.now(pytz.utc))
+    def _migration_base_schema(self, c: sqlite3.Connection) -> None:
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                birthday DATE,
+                last_name TEXT,
+                daily_reports INTEGER DEFAULT 1,
+                expiry_warnings INTEGER DEFAULT 1,
+                data_warning_hiddify INTEGER DEFAULT 1,
+                data_warning_marzban INTEGER DEFAULT 1,
+                admin_note TEXT
+            )""")
+        user_columns = {row['name'] for row in c.execute("PRAGMA table_info(users)")}
+        for column in ('data_warning_hiddify', 'data_warning_marzban', 'admin_note'):
+            if column not in user_columns:
+                column_type = "TEXT" if column == 'admin_note' else "INTEGER DEFAULT 1"
+                c.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+                logger.info(f"Column '{column}' added to 'users' table.")
+
+        for name, schema in _EPOCH_TABLE_SCHEMAS.items():
+            c.execute(schema.format(if_not_exists="IF NOT EXISTS ", name=name))
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS scheduled_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_type TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(job_type, chat_id)
+            )""")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS config_templates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                template_str TEXT NOT NULL,     -- متن کامل کانفیگ vless://...
+                is_active INTEGER DEFAULT 1,           -- وضعیت فعال/غیرفعال (1=فعال)
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS user_generated_configs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_uuid_id INTEGER NOT NULL,
+                template_id INTEGER NOT NULL,
+                generated_uuid TEXT NOT NULL UNIQUE,
+                FOREIGN KEY(user_uuid_id) REFERENCES user_uuids(id) ON DELETE CASCADE,
+                FOREIGN KEY(template_id) REFERENCES config_templates(id) ON DELETE CASCADE,
+                UNIQUE(user_uuid_id, template_id)
+            )""")
+        for statement in _BASE_INDEXES:
+            c.execute(statement)
+
+    def _migration_epoch_columns(self, c: sqlite3.Connection) -> None:
+        """
+        جداولی که ستون زمانی آن‌ها هنوز TIMESTAMP متنی است را با ستون‌های INTEGER (epoch) بازسازی می‌کند.
+        SQLite تغییر نوع ستون را پشتیبانی نمی‌کند، پس جدول جدید ساخته، داده‌ها با strftime('%s')
+        تبدیل و کپی، و سپس جایگزین جدول قدیمی می‌شود. جداولی که از قبل INTEGER هستند دست نمی‌خورند.
+        """
+        for table, epoch_columns in _EPOCH_COLUMNS.items():
+            types = {row['name']: (row['type'] or '').upper() for row in c.execute(f"PRAGMA table_info({table})")}
+            if all(types.get(col) == 'INTEGER' for col in epoch_columns):
+                continue
+
+            logger.info(f"Migrating time columns of '{table}' to integer epoch...")
+            new_table = f"{table}_epoch_migration"
+            c.execute(f"DROP TABLE IF EXISTS {new_table}")
+            c.execute(_EPOCH_TABLE_SCHEMAS[table].format(if_not_exists="", name=new_table))
+            new_columns = [row['name'] for row in c.execute(f"PRAGMA table_info({new_table})")]
+            columns = [col for col in new_columns if col in types]
+            select = ", ".join(
+                f"CAST(strftime('%s', {col}) AS INTEGER)" if col in epoch_columns else col
+                for col in columns
             )
+            c.execute(f"INSERT INTO {new_table} ({', '.join(columns)}) SELECT {select} FROM {table}")
+            c.execute(f"DROP TABLE {table}")
+            c.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+
+        # ایندکس‌های جداول بازسازی‌شده همراه جدول قدیمی حذف شده‌اند
+        for statement in _BASE_INDEXES:
+            c.execute(statement)
+
+    def _migration_usage_daily(self, c: sqlite3.Connection) -> None:
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                uuid_id INTEGER NOT NULL,
+                day TEXT NOT NULL, -- روز تقویمی تهران، YYYY-MM-DD
+                hiddify_min_gb REAL DEFAULT 0,
+                hiddify_max_gb REAL DEFAULT 0,
+                marzban_min_gb REAL DEFAULT 0,
+                marzban_max_gb REAL DEFAULT 0,
+                hiddify_gb REAL DEFAULT 0, -- مصرف روز (max - min)
+                marzban_gb REAL DEFAULT 0,
+                PRIMARY KEY (uuid_id, day),
+                FOREIGN KEY(uuid_id) REFERENCES user_uuids(id) ON DELETE CASCADE
+            ) WITHOUT ROWID""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_usage_daily_day ON usage_daily(day)")
+        self._backfill_usage_daily(c)
+
+    def _migration_covering_indexes(self, c: sqlite3.Connection) -> None:
+        for statement in (
+            "DROP INDEX IF EXISTS idx_snapshots_uuid_id_taken_at",
+            "DROP INDEX IF EXISTS idx_warning_log_uuid_type",
+            "CREATE INDEX IF NOT EXISTS idx_snapshots_uuid_taken_cover ON usage_snapshots(uuid_id, taken_at, hiddify_usage_gb, marzban_usage_gb)",
+            "CREATE INDEX IF NOT EXISTS idx_snapshots_taken_at ON usage_snapshots(taken_at)",
+            "CREATE INDEX IF NOT EXISTS idx_warning_log_uuid_type_sent ON warning_log(uuid_id, warning_type, sent_at)",
+            "CREATE INDEX IF NOT EXISTS idx_warning_log_sent_cover ON warning_log(sent_at, uuid_id, warning_type)",
+            "CREATE INDEX IF NOT EXISTS idx_payments_uuid_date ON payments(uuid_id, payment_date)",
+        ):
+            c.execute(statement)
+
+    def _migration_panel_mirror(self, c: sqlite3.Connection) -> None:
+        # کپی محلی لیست کاربران پنل‌ها؛ توسط panel_sync پر می‌شود و ربات و وب‌اپ هر دو از آن می‌خوانند
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS panel_users (
+                panel TEXT NOT NULL,          -- 'hiddify' یا 'marzban'
+                panel_key TEXT NOT NULL,      -- uuid در هیدیفای، نام کاربری در مرزبان
+                uuid TEXT,
+                name TEXT,
+                is_active INTEGER DEFAULT 0,
+                usage_limit_gb REAL DEFAULT 0,
+                current_usage_gb REAL DEFAULT 0,
+                expire_days INTEGER,
+                last_online INTEGER,          -- epoch
+                data TEXT NOT NULL,           -- خروجی نرمال‌شده handler به صورت JSON
+                generation INTEGER NOT NULL,
+                synced_at INTEGER NOT NULL,
+                PRIMARY KEY (panel, panel_key)
+            ) WITHOUT ROWID""")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS panel_sync_state (
+                panel TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL DEFAULT 0,
+                synced_at INTEGER,
+                user_count INTEGER DEFAULT 0,
+                last_error TEXT,
+                last_error_at INTEGER
+            )""")
+        for statement in (
+            "CREATE INDEX IF NOT EXISTS idx_panel_users_uuid ON panel_users(uuid)",
+            "CREATE INDEX IF NOT EXISTS idx_panel_users_name ON panel_users(name COLLATE NOCASE)",
+            "CREATE INDEX IF NOT EXISTS idx_panel_users_last_online ON panel_users(last_online)",
+            "CREATE INDEX IF NOT EXISTS idx_panel_users_expire ON panel_users(expire_days)",
+        ):
+            c.execute(statement)
+
+    def _migration_plan_index(self, c: sqlite3.Connection) -> None:
+        # عضویت کاربران در پلن‌ها (bot/plan_index.py) برای هر generation، مشترک بین ربات و وب‌اپ
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS plan_index (
+                plans_key TEXT NOT NULL,      -- mtime و حجم plans.json
+                generation TEXT NOT NULL,     -- generation هیدیفای و مرزبان، مثل '12:9'
+                data TEXT NOT NULL,           -- اعضای هر پلن و کاربران بدون پلن به صورت JSON
+                built_at INTEGER NOT NULL,
+                PRIMARY KEY (plans_key, generation)
+            ) WITHOUT ROWID""")
+
+    def _migration_marzban_user_map(self, c: sqlite3.Connection) -> None:
+        # نگاشت UUID هیدیفای به نام کاربری مرزبان (قبلا فقط uuid_to_marzban_user.json)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS marzban_user_map (
+                uuid TEXT PRIMARY KEY,        -- حروف کوچک
+                username TEXT NOT NULL,
+                source TEXT NOT NULL,         -- 'json' یا 'panel' (کشف‌شده از proxies کاربر مرزبان)
+                updated_at INTEGER NOT NULL
+            ) WITHOUT ROWID""")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_marzban_user_map_username ON marzban_user_map(username)")
+        # version با هر تغییر نگاشت یکی زیاد می‌شود تا پروسه‌های دیگر فقط در صورت تغییر دوباره بخوانند
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS marzban_user_map_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL DEFAULT 0,
+                json_mtime_ns INTEGER
+            )""")
+        c.execute("INSERT OR IGNORE INTO marzban_user_map_state (id, version) VALUES (1, 0)")
+
+    def _backfill_usage_daily(self, c: sqlite3.Connection) -> None:
+        """
+        One-time fill of usage_daily from the existing usage_snapshots rows.
+        Runs only while the rollup table is still empty.
+        """
+        if c.execute("SELECT 1 FROM usage_daily LIMIT 1").fetchone():
+            return
+        if not c.execute("SELECT 1 FROM usage_snapshots LIMIT 1").fetchone():
+            return
+
+        logger.info("Backfilling usage_daily from usage_snapshots...")
+        days: Dict[Tuple[int, str], List[float]] = {}
+        rows = c.execute("SELECT uuid_id, hiddify_usage_gb, marzban_usage_gb, taken_at FROM usage_snapshots WHERE taken_at IS NOT NULL")
+        for row in rows:
+            h_usage, m_usage = row['hiddify_usage_gb'] or 0.0, row['marzban_usage_gb'] or 0.0
+            key = (row['uuid_id'], _tehran_day(row['taken_at']))
+            agg = days.get(key)
+            if agg is None:
+                days[key] = [h_usage, h_usage, m_usage, m_usage]
+            else:
+                agg[0], agg[1] = min(agg[0], h_usage), max(agg[1], h_usage)
+                agg[2], agg[3] = min(agg[2], m_usage), max(agg[3], m_usage)
+
+        c.executemany(
+            _USAGE_DAILY_UPSERT,
+            [(uuid_id, day, h_min, h_max, m_min, m_max, h_max - h_min, m_max - m_min)
+             for (uuid_id, day), (h_min, h_max, m_min, m_max) in days.items()]
+        )
+        logger.info(f"Backfilled {len(days)} usage_daily rows.")
+
+    @staticmethod
+    def _rollup_snapshots(c: sqlite3.Connection, rows: List[Tuple[int, float, float, int, float, float]]) -> None:
+        """
+        Folds freshly written snapshots into usage_daily (same transaction as the insert).
+        Each row carries the lower bound to fold in as the day's min: the previous stored
+        value, so a day whose first stored row comes after idle hours still counts the
+        usage since that value; or the new value itself after a usage reset.
+        """
+        c.executemany(
+            _USAGE_DAILY_UPSERT,
+            [(uuid_id, _tehran_day(taken_at), h_low, h_usage, m_low, m_usage, h_usage - h_low, m_usage - m_low)
+             for uuid_id, h_usage, m_usage, taken_at, h_low, m_low in rows]
+        )
+
+    def _load_last_snapshots(self) -> Dict[int, Tuple[float, float, int]]:
+        """Seeds the in-memory last-value map from the newest stored snapshot of every uuid_id."""
+        if self._last_snapshots is None:
+            # ids grow with insert order, so MAX(id) is also the latest row when taken_at ties
+            query = """
+                SELECT uuid_id, hiddify_usage_gb, marzban_usage_gb, taken_at
+                FROM usage_snapshots WHERE id IN (SELECT MAX(id) FROM usage_snapshots GROUP BY uuid_id)
+            """
+            with self._conn() as c:
+                self._last_snapshots = {
+                    row['uuid_id']: (row['hiddify_usage_gb'] or 0.0, row['marzban_usage_gb'] or 0.0, row['taken_at'] or 0)
+                    for row in c.execute(query)
+                }
+        return self._last_snapshots
+
+    def _forget_last_snapshot(self, uuid_id: int) -> None:
+        with self._snapshot_lock:
+            if self._last_snapshots is not None:
+                self._last_snapshots.pop(uuid_id, None)
+
+    def add_usage_snapshot(self, uuid_id: int, hiddify_usage: float, marzban_usage: float) -> None:
+        self.add_usage_snapshots_bulk([(uuid_id, hiddify_usage, marzban_usage)])
+
+    def add_usage_snapshots_bulk(self, snapshots: Iterable[Tuple[int, float, float]]) -> int:
+        """
+        Writes many (uuid_id, hiddify_gb, marzban_gb) snapshots in a single transaction.
+        All rows share the same taken_at. A snapshot equal to the last stored value of its
+        uuid_id is skipped unless SNAPSHOT_KEYFRAME_INTERVAL has passed since that value was
+        stored. Returns the number of rows written.
+        """
+        taken_at = _epoch()
+        with self._snapshot_lock:
+            last_snapshots = self._load_last_snapshots()
+            rows = []
+            for uuid_id, h_usage, m_usage in snapshots:
+                last = last_snapshots.get(uuid_id)
+                if last is None:
+                    rows.append((uuid_id, h_usage, m_usage, taken_at, h_usage, m_usage))
+                    continue
+                last_h, last_m, last_taken_at = last
+                if (h_usage, m_usage) == (last_h, last_m) and taken_at - last_taken_at < SNAPSHOT_KEYFRAME_INTERVAL:
+                    continue
+                rows.append((
+                    uuid_id, h_usage, m_usage, taken_at,
+                    last_h if last_h <= h_usage else h_usage,
+                    last_m if last_m <= m_usage else m_usage
+                ))
+            if not rows:
+                return 0
+            with self.transaction() as c:
+                c.executemany(
+                    "INSERT INTO usage_snapshots (uuid_id, hiddify_usage_gb, marzban_usage_gb, taken_at) VALUES (?, ?, ?, ?)",
+                    [row[:4] for row in rows]
+                )
+                self._rollup_snapshots(c, rows)
+            for uuid_id, h_usage, m_usage, _, _, _ in rows:
+                last_snapshots[uuid_id] = (h_usage, m_usage, taken_at)
+        return len(rows)
+
+    def snapshot_keyframes_due(self, uuid_ids: Iterable[int]) -> set:
+        """uuid_id هایی که snapshot ذخیره‌شده ندارند یا keyframe آن‌ها سررسید شده است."""
+        now = _epoch()
+        with self._snapshot_lock:
+            last_snapshots = self._load_last_snapshots()
+            return {
+                uuid_id for uuid_id in uuid_ids
+                if uuid_id not in last_snapshots or now - last_snapshots[uuid_id][2] >= SNAPSHOT_KEYFRAME_INTERVAL
+            }
 
     def get_usage_since_midnight(self, uuid_id: int) -> Dict[str, float]:
-        """Calculates daily usage for both panels with a single, simplified, and robust query."""
-        tehran_tz = pytz.timezone("Asia/Tehran")
-        today_midnight_tehran = datetime.now(tehran_tz).replace(hour=0, minute=0, second=0, microsecond=0)
-        today_midnight_utc = today_midnight_tehran.astimezone(pytz.utc)
-        
+        """Daily usage of both panels since Tehran midnight, read from the usage_daily rollup."""
         result = {'hiddify': 0.0, 'marzban': 0.0}
 
         with self._conn() as c:
-            # *** FINAL FIX: Simplified and more robust query ***
-            query = """
-                SELECT
-                    (MAX(hiddify_usage_gb) - MIN(hiddify_usage_gb)) as h_diff,
-                    (MAX(marzban_usage_gb) - MIN(marzban_usage_gb)) as m_diff
-                FROM usage_snapshots
-                WHERE uuid_id = ? AND taken_at >= ?;
-            """
-            params = (uuid_id, today_midnight_utc)
-            row = c.execute(query, params).fetchone()
+            row = c.execute(
+                "SELECT hiddify_gb, marzban_gb FROM usage_daily WHERE uuid_id = ? AND day = ?",
+                (uuid_id, _tehran_day())
+            ).fetchone()
 
             if row:
                 # Use max(0, ...) to prevent negative results if usage resets during the day
-                result['hiddify'] = max(0, row['h_diff'] or 0.0)
-                result['marzban'] = max(0, row['m_diff'] or 0.0)
+                result['hiddify'] = max(0.0, row['hiddify_gb'] or 0.0)
+                result['marzban'] = max(0.0, row['marzban_gb'] or 0.0)
 
         return result
+
+    def get_user_daily_usage(self, uuid_id: int, days: int = 7) -> List[Dict[str, Any]]:
+        """
+        مصرف روزانه یک کاربر برای `days` روز اخیر (شامل امروز) با یک خواندن بازه‌ای از usage_daily.
+        خروجی به ترتیب صعودی تاریخ: [{'date': 'YYYY-MM-DD', 'hiddify': 1.2, 'marzban': 0.5}, ...]
+        """
+        day_keys = self._last_tehran_days(days)
+        with self._conn() as c:
+            rows = c.execute(
+                "SELECT day, hiddify_gb, marzban_gb FROM usage_daily WHERE uuid_id = ? AND day >= ? ORDER BY day",
+                (uuid_id, day_keys[0])
+            ).fetchall()
+        by_day = {row['day']: row for row in rows}
+        return [
+            {
+                'date': day,
+                'hiddify': max(0.0, by_day[day]['hiddify_gb'] or 0.0) if day in by_day else 0.0,
+                'marzban': max(0.0, by_day[day]['marzban_gb'] or 0.0) if day in by_day else 0.0,
+            }
+            for day in day_keys
+        ]
+
+    @staticmethod
+    def _last_tehran_days(days: int) -> List[str]:
+        """کلید `days` روز اخیر تهران به ترتیب صعودی (آخرین عنصر امروز است)."""
+        today = datetime.now(TEHRAN_TZ)
+        return [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days - 1, -1, -1)]
     
     def get_panel_usage_in_intervals(self, uuid_id: int, panel_name: str) -> Dict[int, float]:
         if panel_name not in ['hiddify_usage_gb', 'marzban_usage_gb']:
             return {}
+        return self.get_usage_in_intervals(uuid_id)[panel_name.split('_')[0]]
 
-        now_utc = datetime.now(pytz.utc)
-        intervals = {3: 0.0, 6: 0.0, 12: 0.0, 24: 0.0}
-        
+    def get_usage_in_intervals(self, uuid_id: int) -> Dict[str, Dict[int, float]]:
+        """
+        مصرف هر دو پنل در بازه‌های ۳/۶/۱۲/۲۴ ساعت اخیر با یک کوئری.
+        خروجی: {'hiddify': {3: 0.2, 6: ..., 12: ..., 24: ...}, 'marzban': {...}}
+        """
+        return self.get_usage_in_intervals_batch([uuid_id])[uuid_id]
+
+    def get_usage_in_intervals_batch(self, uuid_ids: Iterable[int]) -> Dict[int, Dict[str, Dict[int, float]]]:
+        """
+        نسخه دسته‌ای get_usage_in_intervals برای نمای ادمین: {uuid_id: {'hiddify': {...}, 'marzban': {...}}}
+        snapshot ها فقط در صورت تغییر ذخیره می‌شوند، پس برای هر UUID آخرین ردیفِ پیش از
+        بزرگ‌ترین بازه هم به عنوان مبنا خوانده می‌شود. سپس همه بازه‌ها در یک پیمایش مرتب محاسبه می‌شوند.
+        """
+        uuid_ids = list(dict.fromkeys(uuid_ids))
+        result = {
+            uuid_id: {'hiddify': dict.fromkeys(USAGE_INTERVAL_HOURS, 0.0), 'marzban': dict.fromkeys(USAGE_INTERVAL_HOURS, 0.0)}
+            for uuid_id in uuid_ids
+        }
+        if not uuid_ids:
+            return result
+
+        now_ts = _epoch()
+        starts = [now_ts - hours * 3600 for hours in USAGE_INTERVAL_HOURS]
+        widest = starts[-1]
+        # برای هر بازه یک ستون پرچم: آیا ردیف بعد از شروع آن بازه گرفته شده است؟
+        flags = ", ".join(f"taken_at > ? AS in_{hours}" for hours in USAGE_INTERVAL_HOURS)
+        zero_flags = ", ".join(f"0 AS in_{hours}" for hours in USAGE_INTERVAL_HOURS)
+
+        rows_by_uuid: Dict[int, List[sqlite3.Row]] = {}
         with self._conn() as c:
-            for hours in intervals.keys():
-                time_ago = now_utc - timedelta(hours=hours)
-                
+            for i in range(0, len(uuid_ids), _INTERVAL_BATCH_CHUNK):
+                chunk = uuid_ids[i:i + _INTERVAL_BATCH_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
                 query = f"""
-                    SELECT
-                        (SELECT {panel_name} FROM usage_snapshots WHERE uuid_id = ? AND taken_at >= ? ORDER BY taken_at ASC LIMIT 1) as start_usage,
-                        (SELECT {panel_name} FROM usage_snapshots WHERE uuid_id = ? AND taken_at >= ? ORDER BY taken_at DESC LIMIT 1) as end_usage
+                    SELECT id, uuid_id, hiddify_usage_gb, marzban_usage_gb, taken_at, {flags}
+                    FROM usage_snapshots
+                    WHERE uuid_id IN ({placeholders}) AND taken_at > ?
+                    UNION ALL
+                    SELECT id, uuid_id, hiddify_usage_gb, marzban_usage_gb, MAX(taken_at), {zero_flags}
+                    FROM usage_snapshots
+                    WHERE uuid_id IN ({placeholders}) AND taken_at <= ?
+                    GROUP BY uuid_id
+                    ORDER BY uuid_id, taken_at, id
                 """
-                params = (uuid_id, time_ago, uuid_id, time_ago)
-                row = c.execute(query, params).fetchone()
-                
-                if row and row['start_usage'] is not None and row['end_usage'] is not None:
-                    intervals[hours] = max(0, row['end_usage'] - row['start_usage'])
-                    
-        return intervals
+                params = (*starts, *chunk, widest, *chunk, widest)
+                for row in c.execute(query, params):
+                    rows_by_uuid.setdefault(row['uuid_id'], []).append(row)
+
+        for uuid_id, rows in rows_by_uuid.items():
+            end = rows[-1]
+            for hours in USAGE_INTERVAL_HOURS:
+                # ردیف‌های پیش از شروع بازه اول می‌آیند؛ مبنا آخرین آن‌هاست یا اگر نبود اولین ردیف بازه
+                before = sum(1 for row in rows if not row[f'in_{hours}'])
+                start = rows[before - 1] if before else rows[0]
+                for panel in ('hiddify', 'marzban'):
+                    column = f'{panel}_usage_gb'
+                    if start[column] is not None and end[column] is not None:
+                        result[uuid_id][panel][hours] = max(0.0, end[column] - start[column])
+
+        return result
         
     def log_warning(self, uuid_id: int, warning_type: str):
         with self._conn() as c:
             c.execute(
                 "INSERT INTO warning_log (uuid_id, warning_type, sent_at) VALUES (?, ?, ?) "
                 "ON CONFLICT(uuid_id, warning_type) DO UPDATE SET sent_at=excluded.sent_at",
-                (uuid_id, warning_type, datetime.now(pytz.utc))
+                (uuid_id, warning_type, _epoch())
             )
 
     def has_recent_warning(self, uuid_id: int, warning_type: str, hours: int = 24) -> bool:
-        time_ago = datetime.now(pytz.utc) - timedelta(hours=hours)
+        time_ago = _epoch() - hours * 3600
         with self._conn() as c:
             row = c.execute(
                 "SELECT 1 FROM warning_log WHERE uuid_id = ? AND warning_type = ? AND sent_at >= ?",
@@ -187,6 +741,27 @@ class DatabaseManager:
             ).fetchone()
             return row is not None
 
+    def get_recent_warnings(self, hours: int = 24) -> set:
+        """All (uuid_id, warning_type) pairs logged in the last `hours`, in one query."""
+        time_ago = _epoch() - hours * 3600
+        with self._conn() as c:
+            rows = c.execute("SELECT uuid_id, warning_type FROM warning_log WHERE sent_at >= ?", (time_ago,)).fetchall()
+            return {(row['uuid_id'], row['warning_type']) for row in rows}
+
+    def log_warnings(self, warnings: Iterable[Tuple[int, str]]) -> int:
+        """Batched log_warning: records many (uuid_id, warning_type) pairs in one transaction."""
+        sent_at = _epoch()
+        rows = [(uuid_id, warning_type, sent_at) for uuid_id, warning_type in warnings]
+        if not rows:
+            return 0
+        with self.transaction() as c:
+            c.executemany(
+                "INSERT INTO warning_log (uuid_id, warning_type, sent_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(uuid_id, warning_type) DO UPDATE SET sent_at=excluded.sent_at",
+                rows
+            )
+        return len(rows)
+
     def get_user_ids_by_uuids(self, uuids: List[str]) -> List[int]:
         if not uuids: return []
         placeholders = ','.join('?' for _ in uuids)
@@ -270,7 +845,7 @@ class DatabaseManager:
                         return "این UUID قبلاً توسط کاربر دیگری ثبت شده است."
                 else:
                     if existing['user_id'] == user_id:
-                        c.execute("UPDATE user_uuids SET is_active = 1, name = ?, updated_at = CURRENT_TIMESTAMP WHERE uuid = ?", (name, uuid_str))
+                        c.execute("UPDATE user_uuids SET is_active = 1, name = ?, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE uuid = ?", (name, uuid_str))
                         return "✅ اکانت شما که قبلاً حذف شده بود، با موفقیت دوباره فعال شد."
                     else:
                         return "این UUID متعلق به کاربر دیگری بوده و در حال حاضر غیرفعال است. امکان ثبت آن وجود ندارد."
@@ -305,6 +880,30 @@ class DatabaseManager:
             rows = c.execute("SELECT id, user_id, uuid, created_at FROM user_uuids WHERE is_active=1").fetchall()
             return [dict(r) for r in rows]
             
+    def get_active_uuids_with_settings(self) -> List[Dict[str, Any]]:
+        """
+        all_active_uuids به همراه وضعیت خوشامدگویی و تنظیمات اعلان کاربر صاحب هر UUID، با یک کوئری.
+        اگر کاربر ردیفی در users نداشته باشد، مانند get_user_settings همه تنظیمات فعال فرض می‌شوند.
+        """
+        query = """
+            SELECT uu.id, uu.user_id, uu.uuid, uu.created_at, uu.first_connection_time, uu.welcome_message_sent,
+                   COALESCE(u.daily_reports, 1) AS daily_reports,
+                   COALESCE(u.expiry_warnings, 1) AS expiry_warnings,
+                   COALESCE(u.data_warning_hiddify, 1) AS data_warning_hiddify,
+                   COALESCE(u.data_warning_marzban, 1) AS data_warning_marzban
+            FROM user_uuids uu
+            LEFT JOIN users u ON u.user_id = uu.user_id
+            WHERE uu.is_active = 1
+        """
+        settings_keys = ('daily_reports', 'expiry_warnings', 'data_warning_hiddify', 'data_warning_marzban')
+        with self._conn() as c:
+            result = []
+            for row in c.execute(query):
+                record = dict(row)
+                record['settings'] = {key: bool(record.pop(key)) for key in settings_keys}
+                result.append(record)
+            return result
+
     def get_all_user_ids(self) -> list[int]:
         with self._conn() as c:
             return [r['user_id'] for r in c.execute("SELECT user_id FROM users")]
@@ -339,7 +938,9 @@ class DatabaseManager:
     def delete_user_snapshots(self, uuid_id: int) -> int:
         with self._conn() as c:
             cursor = c.execute("DELETE FROM usage_snapshots WHERE uuid_id = ?", (uuid_id,))
-            return cursor.rowcount
+            c.execute("DELETE FROM usage_daily WHERE uuid_id = ?", (uuid_id,))
+        self._forget_last_snapshot(uuid_id)
+        return cursor.rowcount
     
     def get_todays_birthdays(self) -> list:
         today = datetime.now(pytz.utc)
@@ -371,6 +972,17 @@ class DatabaseManager:
             rows = c.execute("SELECT uuid, user_id FROM user_uuids WHERE is_active=1").fetchall()
             return {row['uuid']: row['user_id'] for row in rows}
         
+    def get_uuid_search_fields(self) -> List[Dict[str, Any]]:
+        """UUID های فعال به همراه نام کاربری و نام تلگرام و یادداشت ادمین صاحب آن‌ها (برای search_index)."""
+        query = """
+            SELECT uu.uuid, u.username, u.first_name, u.admin_note
+            FROM user_uuids uu
+            LEFT JOIN users u ON uu.user_id = u.user_id
+            WHERE uu.is_active = 1
+        """
+        with self._conn() as c:
+            return [dict(row) for row in c.execute(query)]
+
     def get_uuid_to_bot_user_map(self) -> Dict[str, Dict[str, Any]]:
         query = """
             SELECT uu.uuid, u.user_id, u.first_name, u.username
@@ -386,37 +998,111 @@ class DatabaseManager:
                     result_map[row['uuid']] = dict(row)
         return result_map
     
-    def delete_daily_snapshots(self, uuid_id: int) -> None:
-        """Deletes all usage snapshots for a given uuid_id that were taken today (UTC)."""
-        today_start_utc = datetime.now(pytz.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-        with self._conn() as c:
-            c.execute("DELETE FROM usage_snapshots WHERE uuid_id = ? AND taken_at >= ?", (uuid_id, today_start_utc))
-            logger.info(f"Deleted daily snapshots for uuid_id {uuid_id}.")
+    def apply_snapshot_retention(self, raw_days: int = 7, daily_days: int = 90, batch_size: int = 500,
+                                 dry_run: bool = False, pause: float = 0.05) -> Dict[str, int]:
+        """
+        سیاست نگهداری چندلایه برای usage_snapshots:
+          - جدیدتر از raw_days روز: همه ردیف‌های ساعتی دست‌نخورده می‌مانند.
+          - بین raw_days و daily_days روز: فقط آخرین ردیف هر UUID در هر روز تهران نگه داشته می‌شود.
+          - قدیمی‌تر از daily_days روز: حذف کامل (تاریخچه روزانه در usage_daily باقی می‌ماند).
+        حذف‌ها در دسته‌های کوچک و هر دسته در یک تراکنش جدا انجام می‌شود تا قفل نوشتن
+        طولانی نشود. با dry_run=True فقط تعداد ردیف‌های قابل حذف شمرده می‌شود.
+        خروجی: {'expired': n, 'downsampled': m}
+        """
+        if raw_days < 1 or daily_days < raw_days:
+            raise ValueError("retention tiers must satisfy 1 <= raw_days <= daily_days")
+
+        now = datetime.now(pytz.utc)
+        raw_cutoff = now - timedelta(days=raw_days)
+        daily_cutoff = now - timedelta(days=daily_days)
+        result = {'expired': 0, 'downsampled': 0}
+
+        # --- Tier 1: expired rows ---
+        if dry_run:
+            with self._conn() as c:
+                result['expired'] = c.execute(
+                    "SELECT COUNT(*) FROM usage_snapshots WHERE taken_at < ?", (_epoch(daily_cutoff),)
+                ).fetchone()[0]
+        else:
+            result['expired'] = self._delete_in_batches(
+                "SELECT id FROM usage_snapshots WHERE taken_at < ? LIMIT ?", (_epoch(daily_cutoff),), batch_size, pause
+            )
+
+        # --- Tier 2: downsample to one point per uuid per Tehran day, one day at a time ---
+        day_start = datetime.now(TEHRAN_TZ).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=daily_days)
+        while day_start.astimezone(pytz.utc) < raw_cutoff:
+            day_end = TEHRAN_TZ.normalize(day_start + timedelta(days=1))
+            window = (_epoch(max(day_start.astimezone(pytz.utc), daily_cutoff)), _epoch(min(day_end.astimezone(pytz.utc), raw_cutoff)))
+            # فقط روزهایی که کاملا خارج از بازه خام هستند فشرده می‌شوند
+            if day_end.astimezone(pytz.utc) <= raw_cutoff:
+                query = """
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY uuid_id ORDER BY taken_at DESC, id DESC) AS rn
+                        FROM usage_snapshots
+                        WHERE taken_at >= ? AND taken_at < ?
+                    ) WHERE rn > 1
+                """
+                if dry_run:
+                    with self._conn() as c:
+                        result['downsampled'] += c.execute(f"SELECT COUNT(*) FROM ({query})", window).fetchone()[0]
+                else:
+                    result['downsampled'] += self._delete_in_batches(query + " LIMIT ?", window, batch_size, pause)
+            day_start = day_end
+
+        action = "would reclaim" if dry_run else "reclaimed"
+        logger.info(f"Snapshot retention {action} {result['expired']} expired and {result['downsampled']} downsampled rows.")
+        return result
+
+    def _delete_in_batches(self, select_ids: str, params: Tuple, batch_size: int, pause: float) -> int:
+        """Deletes the snapshot ids returned by `select_ids` (last param is the LIMIT) one short transaction at a time."""
+        deleted = 0
+        while True:
+            with self.transaction() as c:
+                ids = [row[0] for row in c.execute(select_ids, (*params, batch_size)).fetchall()]
+                if ids:
+                    c.execute(f"DELETE FROM usage_snapshots WHERE id IN ({','.join('?' * len(ids))})", ids)
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                return deleted
+            # فرصت دادن به نویسنده‌های دیگر (وب‌اپ) بین دسته‌ها
+            time.sleep(pause)
 
     def set_first_connection_time(self, uuid_id: int, time: datetime):
         with self._conn() as c:
-            c.execute("UPDATE user_uuids SET first_connection_time = ? WHERE id = ?", (time, uuid_id))
+            c.execute("UPDATE user_uuids SET first_connection_time = ? WHERE id = ?", (_epoch(time), uuid_id))
 
     def mark_welcome_message_as_sent(self, uuid_id: int):
         with self._conn() as c:
             c.execute("UPDATE user_uuids SET welcome_message_sent = 1 WHERE id = ?", (uuid_id,))
 
+    def set_first_connection_times(self, uuid_ids: Iterable[int], time: datetime) -> None:
+        rows = [(_epoch(time), uuid_id) for uuid_id in uuid_ids]
+        if rows:
+            with self.transaction() as c:
+                c.executemany("UPDATE user_uuids SET first_connection_time = ? WHERE id = ?", rows)
+
+    def mark_welcome_messages_as_sent(self, uuid_ids: Iterable[int]) -> None:
+        rows = [(uuid_id,) for uuid_id in uuid_ids]
+        if rows:
+            with self.transaction() as c:
+                c.executemany("UPDATE user_uuids SET welcome_message_sent = 1 WHERE id = ?", rows)
+
     def add_payment_record(self, uuid_id: int) -> bool:
         """یک رکورد پرداخت برای کاربر با تاریخ فعلی ثبت می‌کند."""
         with self._conn() as c:
             c.execute("INSERT INTO payments (uuid_id, payment_date) VALUES (?, ?)",
-                      (uuid_id, datetime.now(pytz.utc)))
+                      (uuid_id, _epoch()))
             return True
 
     def get_payment_history(self) -> List[Dict[str, Any]]:
         """لیست تمام کاربرانی که پرداخت ثبت‌شده دارند را به همراه آخرین تاریخ پرداختشان برمی‌گرداند."""
         query = """
-            SELECT uu.name, p.payment_date
+            SELECT uu.name, MAX(p.payment_date) AS payment_date
             FROM payments p
             JOIN user_uuids uu ON p.uuid_id = uu.id
             WHERE uu.is_active = 1
             GROUP BY p.uuid_id
-            ORDER BY p.payment_date DESC;
+            ORDER BY payment_date DESC;
         """
         with self._conn() as c:
             rows = c.execute(query).fetchall()
@@ -541,28 +1227,20 @@ class DatabaseManager:
         مصرف روزانه تمام UUID ها را از نیمه‌شب به صورت یک‌جا محاسبه می‌کند.
         خروجی به صورت یک دیکشنری از UUID به مصرف است. {'uuid_str': {'hiddify': 1.2, 'marzban': 0.5}}
         """
-        tehran_tz = pytz.timezone("Asia/Tehran")
-        today_midnight_tehran = datetime.now(tehran_tz).replace(hour=0, minute=0, second=0, microsecond=0)
-        today_midnight_utc = today_midnight_tehran.astimezone(pytz.utc)
-        
         query = """
-            SELECT
-                uu.uuid,
-                MAX(s.hiddify_usage_gb) - MIN(s.hiddify_usage_gb) as h_diff,
-                MAX(s.marzban_usage_gb) - MIN(s.marzban_usage_gb) as m_diff
-            FROM usage_snapshots s
-            JOIN user_uuids uu ON s.uuid_id = uu.id
-            WHERE s.taken_at >= ?
-            GROUP BY uu.uuid;
+            SELECT uu.uuid, d.hiddify_gb, d.marzban_gb
+            FROM usage_daily d
+            JOIN user_uuids uu ON d.uuid_id = uu.id
+            WHERE d.day = ?;
         """
         
         usage_map = {}
         with self._conn() as c:
-            rows = c.execute(query, (today_midnight_utc,)).fetchall()
+            rows = c.execute(query, (_tehran_day(),)).fetchall()
             for row in rows:
                 usage_map[row['uuid']] = {
-                    'hiddify': max(0, row['h_diff'] or 0.0),
-                    'marzban': max(0, row['m_diff'] or 0.0)
+                    'hiddify': max(0.0, row['hiddify_gb'] or 0.0),
+                    'marzban': max(0.0, row['marzban_gb'] or 0.0)
                 }
         return usage_map
 
@@ -573,48 +1251,212 @@ class DatabaseManager:
             خروجی: لیستی از دیکشنری‌ها، هر کدام شامل 'date' و 'total_gb'.
             """
             logger.info(f"Calculating daily usage summary for the last {days} days.")
-            tehran_tz = pytz.timezone("Asia/Tehran")
-            summary = []
+            day_keys = self._last_tehran_days(days)
 
-            # کوئری اصلی که مصرف روزانه را برای هر کاربر در یک بازه زمانی محاسبه می‌کند
-            # و سپس مجموع کل مصرف روزانه را برمی‌گرداند.
+            # یک خواندن بازه‌ای روی ایندکس روز، به جای یک کوئری جدا برای هر روز
             query = """
-                SELECT
-                    SUM(COALESCE(h_diff, 0)) as total_h,
-                    SUM(COALESCE(m_diff, 0)) as total_m
-                FROM (
-                    SELECT
-                        MAX(hiddify_usage_gb) - MIN(hiddify_usage_gb) as h_diff,
-                        MAX(marzban_usage_gb) - MIN(marzban_usage_gb) as m_diff
-                    FROM usage_snapshots
-                    WHERE taken_at >= ? AND taken_at < ?
-                    GROUP BY uuid_id
-                )
+                SELECT day, SUM(MAX(hiddify_gb, 0)) as total_h, SUM(MAX(marzban_gb, 0)) as total_m
+                FROM usage_daily
+                WHERE day >= ?
+                GROUP BY day
             """
 
             with self._conn() as c:
-                for i in range(days):
-                    # محاسبه تاریخ شروع و پایان هر روز به وقت تهران و تبدیل به UTC
-                    target_date = datetime.now(tehran_tz) - timedelta(days=i)
-                    day_start_tehran = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                    day_end_tehran = day_start_tehran + timedelta(days=1)
-                    
-                    day_start_utc = day_start_tehran.astimezone(pytz.utc)
-                    day_end_utc = day_end_tehran.astimezone(pytz.utc)
-
-                    # اجرای کوئری برای روز مشخص شده
-                    row = c.execute(query, (day_start_utc, day_end_utc)).fetchone()
-                    
-                    total_gb = 0
-                    if row and (row['total_h'] is not None or row['total_m'] is not None):
-                        total_gb = (row['total_h'] or 0) + (row['total_m'] or 0)
-
-                    summary.append({
-                        'date': day_start_tehran.strftime('%Y-%m-%d'),
-                        'total_gb': round(total_gb, 2)
-                    })
-
-            # مرتب‌سازی نتیجه بر اساس تاریخ به صورت صعودی
-            return sorted(summary, key=lambda x: x['date'])
-
-db = DatabaseManager()
\ No newline at end of file
+                rows = c.execute(query, (day_keys[0],)).fetchall()
+            totals = {row['day']: (row['total_h'] or 0) + (row['total_m'] or 0) for row in rows}
+
+            return [{'date': day, 'total_gb': round(totals.get(day, 0), 2)} for day in day_keys]
+
+    # ------------------------------------------------------------------
+    # Panel mirror (panel_users)
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _panel_user_row(panel: str, user: Dict[str, Any], generation: int, synced_at: int) -> Optional[Tuple]:
+        key = panel_user_key(panel, user)
+        if not key:
+            return None
+        last_online = user.get('last_online')
+        last_online = _epoch(last_online) if isinstance(last_online, datetime) else None
+        data = {k: v for k, v in user.items() if k != 'last_online'}
+        return (
+            panel, key, (user.get('uuid') or None), user.get('name'), int(bool(user.get('is_active'))),
+            user.get('usage_limit_GB') or 0, user.get('current_usage_GB') or 0, user.get('expire'),
+            last_online, json.dumps(data, ensure_ascii=False, default=str), generation, synced_at,
+        )
+
+    @staticmethod
+    def _panel_user_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+        user = json.loads(row['data'])
+        user['last_online'] = datetime.fromtimestamp(row['last_online'], pytz.utc) if row['last_online'] else None
+        return panel_record(row['panel'], user)
+
+    def replace_panel_users(self, panel: str, users: Iterable[Dict[str, Any]]) -> int:
+        """
+        Stores a complete user list of one panel as a new sync generation of panel_users.
+        Users that are no longer on the panel (older generation) are removed in the same
+        transaction, so readers never see a half-written list. Returns the new generation.
+        """
+        now = _epoch()
+        with self.transaction() as c:
+            generation = self._next_panel_generation(c, panel)
+            rows = [r for r in (self._panel_user_row(panel, u, generation, now) for u in users) if r]
+            c.executemany(_PANEL_USER_UPSERT, rows)
+            c.execute("DELETE FROM panel_users WHERE panel = ? AND generation < ?", (panel, generation))
+            self._save_panel_sync_state(c, panel, generation, now, len(rows))
+        return generation
+
+    def apply_panel_user_changes(self, panel: str, upserts: Iterable[Dict[str, Any]],
+                                 removed_keys: Iterable[str], user_count: int) -> int:
+        """
+        Incremental counterpart of replace_panel_users: only added/changed users are written
+        and removed users deleted. Unchanged rows keep the generation they were last written in.
+        """
+        now = _epoch()
+        with self.transaction() as c:
+            generation = self._next_panel_generation(c, panel)
+            c.executemany(_PANEL_USER_UPSERT,
+                          [r for r in (self._panel_user_row(panel, u, generation, now) for u in upserts) if r])
+            c.executemany("DELETE FROM panel_users WHERE panel = ? AND panel_key = ?",
+                          [(panel, key) for key in removed_keys])
+            self._save_panel_sync_state(c, panel, generation, now, user_count)
+        return generation
+
+    def touch_panel_sync_state(self, panel: str, user_count: int) -> int:
+        """
+        Records a sync that found no changes: only synced_at/user_count move, so readers keyed
+        on the generation (UserDirectory, PlanIndex) keep their cached builds. Returns the generation.
+        """
+        with self.transaction() as c:
+            generation = self._next_panel_generation(c, panel) - 1
+            self._save_panel_sync_state(c, panel, generation, _epoch(), user_count)
+        return generation
+
+    @staticmethod
+    def _next_panel_generation(c: sqlite3.Connection, panel: str) -> int:
+        row = c.execute("SELECT generation FROM panel_sync_state WHERE panel = ?", (panel,)).fetchone()
+        return (row['generation'] if row else 0) + 1
+
+    @staticmethod
+    def _save_panel_sync_state(c: sqlite3.Connection, panel: str, generation: int, synced_at: int, user_count: int) -> None:
+        c.execute("""
+            INSERT INTO panel_sync_state (panel, generation, synced_at, user_count, last_error, last_error_at)
+            VALUES (?, ?, ?, ?, NULL, NULL)
+            ON CONFLICT(panel) DO UPDATE SET
+                generation = excluded.generation, synced_at = excluded.synced_at,
+                user_count = excluded.user_count, last_error = NULL, last_error_at = NULL
+        """, (panel, generation, synced_at, user_count))
+
+    def record_panel_sync_error(self, panel: str, error: str) -> None:
+        with self._conn() as c:
+            c.execute("""
+                INSERT INTO panel_sync_state (panel, last_error, last_error_at) VALUES (?, ?, ?)
+                ON CONFLICT(panel) DO UPDATE SET last_error = excluded.last_error, last_error_at = excluded.last_error_at
+            """, (panel, error[:500], _epoch()))
+
+    def get_panel_sync_state(self) -> Dict[str, Dict[str, Any]]:
+        """وضعیت آخرین همگام‌سازی هر پنل: generation، synced_at (epoch)، user_count و آخرین خطا."""
+        with self._conn() as c:
+            return {row['panel']: dict(row) for row in c.execute("SELECT * FROM panel_sync_state")}
+
+    def get_panel_users(self, panel: Optional[str] = None) -> List[Dict[str, Any]]:
+        """کاربران کپی‌شده یک پنل (یا همه پنل‌ها) با همان ساختار خروجی get_all_users هر handler."""
+        with self._conn() as c:
+            if panel:
+                rows = c.execute("SELECT panel, data, last_online FROM panel_users WHERE panel = ?", (panel,))
+            else:
+                rows = c.execute("SELECT panel, data, last_online FROM panel_users")
+            return [self._panel_user_from_row(row) for row in rows]
+
+    def get_plan_index(self, plans_key: str, generation: str) -> Optional[str]:
+        with self._conn() as c:
+            row = c.execute("SELECT data FROM plan_index WHERE plans_key = ? AND generation = ?",
+                            (plans_key, generation)).fetchone()
+            return row['data'] if row else None
+
+    def save_plan_index(self, plans_key: str, generation: str, data: str) -> None:
+        """فقط ایندکس آخرین generation نگه داشته می‌شود."""
+        with self.transaction() as c:
+            c.execute("DELETE FROM plan_index")
+            c.execute("INSERT INTO plan_index (plans_key, generation, data, built_at) VALUES (?, ?, ?, ?)",
+                      (plans_key, generation, data, _epoch()))
+
+    def get_marzban_user_map_state(self) -> Dict[str, Any]:
+        """version فعلی نگاشت و mtime آخرین فایل JSON وارد‌شده."""
+        with self._conn() as c:
+            row = c.execute("SELECT version, json_mtime_ns FROM marzban_user_map_state WHERE id = 1").fetchone()
+            return dict(row) if row else {'version': 0, 'json_mtime_ns': None}
+
+    def get_marzban_user_map(self) -> List[Tuple[str, str]]:
+        with self._conn() as c:
+            return [(row['uuid'], row['username']) for row in c.execute("SELECT uuid, username FROM marzban_user_map")]
+
+    def import_marzban_user_map(self, mapping: Dict[str, str], json_mtime_ns: Optional[int] = None,
+                                force: bool = False) -> Optional[int]:
+        """
+        محتوای uuid_to_marzban_user.json را به صورت افزایشی وارد می‌کند: فقط ردیف‌های جدید یا تغییرکرده
+        نوشته و ردیف‌هایی که از فایل حذف شده‌اند (با source='json') پاک می‌شوند. اگر فایلی با همین mtime
+        قبلا (مثلا توسط پروسه دیگر) وارد شده باشد و force نباشد، کاری انجام نمی‌شود و None برمی‌گردد؛
+        وگرنه تعداد تغییرات.
+        """
+        # مثل نسخه قبلی: اگر یک نام کاربری برای چند UUID آمده باشد، آخری معتبر است
+        by_username = {}
+        for uuid, username in mapping.items():
+            if uuid and username:
+                by_username[username] = uuid.lower()
+        wanted = {uuid: username for username, uuid in by_username.items()}
+        now = _epoch()
+        with self.transaction() as c:
+            state = c.execute("SELECT json_mtime_ns FROM marzban_user_map_state WHERE id = 1").fetchone()
+            if not force and json_mtime_ns is not None and state and state['json_mtime_ns'] == json_mtime_ns:
+                return None
+            current = {row['uuid']: (row['username'], row['source'])
+                       for row in c.execute("SELECT uuid, username, source FROM marzban_user_map")}
+            removed = [uuid for uuid, (_, source) in current.items() if source == 'json' and uuid not in wanted]
+            changed = [(uuid, username) for uuid, username in wanted.items()
+                       if current.get(uuid) != (username, 'json')]
+            c.executemany("DELETE FROM marzban_user_map WHERE uuid = ?", [(uuid,) for uuid in removed])
+            # ردیف دیگری که همین نام کاربری را دارد (مثلا کشف‌شده از پنل) جای خود را به فایل می‌دهد
+            c.executemany("DELETE FROM marzban_user_map WHERE username = ? AND uuid != ?",
+                          [(username, uuid) for uuid, username in changed])
+            c.executemany("""
+                INSERT INTO marzban_user_map (uuid, username, source, updated_at) VALUES (?, ?, 'json', ?)
+                ON CONFLICT(uuid) DO UPDATE SET username = excluded.username, source = 'json', updated_at = excluded.updated_at
+            """, [(uuid, username, now) for uuid, username in changed])
+            c.execute("UPDATE marzban_user_map_state SET json_mtime_ns = ?, version = version + ? WHERE id = 1",
+                      (json_mtime_ns, 1 if removed or changed else 0))
+            return len(removed) + len(changed)
+
+    def add_discovered_marzban_users(self, pairs: Iterable[Tuple[str, str]]) -> int:
+        """
+        نگاشت‌های کشف‌شده از داده پنل (uuid، username) را اضافه می‌کند؛ UUID یا نام کاربری‌ای که
+        قبلا نگاشت دارد دست نمی‌خورد. تعداد ردیف‌های اضافه‌شده را برمی‌گرداند.
+        """
+        now = _epoch()
+        with self.transaction() as c:
+            before = c.total_changes
+            c.executemany("""
+                INSERT INTO marzban_user_map (uuid, username, source, updated_at) VALUES (?, ?, 'panel', ?)
+                ON CONFLICT DO NOTHING
+            """, [(uuid.lower(), username, now) for uuid, username in pairs])
+            added = c.total_changes - before
+            if added:
+                c.execute("UPDATE marzban_user_map_state SET version = version + 1 WHERE id = 1")
+            return added
+
+    def filter_hiddify_uuids(self, uuids: Iterable[str]) -> Set[str]:
+        """از بین uuids آن‌هایی که در کپی کاربران هیدیفای یا user_uuids ربات وجود دارند."""
+        uuids = list(dict.fromkeys(uuids))
+        found = set()
+        with self._conn() as c:
+            # محدودیت تعداد پارامترهای SQLite
+            for i in range(0, len(uuids), 500):
+                chunk = uuids[i:i + 500]
+                marks = ','.join('?' * len(chunk))
+                found.update(row[0] for row in c.execute(
+                    f"SELECT uuid FROM panel_users WHERE panel = 'hiddify' AND uuid IN ({marks}) "
+                    f"UNION SELECT uuid FROM user_uuids WHERE uuid IN ({marks})", chunk + chunk))
+        return found
+
+db = DatabaseManager()
+# نمونه فقط‌خواندنی برای وب‌اپ؛ نوشتن‌ها همچنان از طریق db انجام می‌شوند
+read_db = DatabaseManager(read_only=True)
\ No newline at end of file
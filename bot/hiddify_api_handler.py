@@ -1,12 +1,13 @@
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Iterator, Optional, List
 import pytz
 import requests
 from requests.adapters import HTTPAdapter, Retry
-from cachetools import cached
-from .config import HIDDIFY_DOMAIN, ADMIN_PROXY_PATH, ADMIN_UUID, API_TIMEOUT, api_cache
+from .config import HIDDIFY_DOMAIN, ADMIN_PROXY_PATH, ADMIN_UUID, API_TIMEOUT, PANEL_CONCURRENCY_LIMIT
 from .utils import safe_float
+from .panel_cache import PanelCache
+from .records import HiddifyUser
 
 logger = logging.getLogger(__name__)
 
@@ -16,12 +17,13 @@ class HiddifyAPIHandler:
         self.api_key = ADMIN_UUID
         self.tehran_tz = pytz.timezone("Asia/Tehran")
         self.session = self._create_session()
+        self.users_cache = PanelCache('hiddify', self._fetch_all_users)
 
     def _create_session(self) -> requests.Session:
         session = requests.Session()
         session.headers.update({"Hiddify-API-Key": self.api_key, "Accept": "application/json"})
         retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
-        adapter = HTTPAdapter(max_retries=retries)
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=PANEL_CONCURRENCY_LIMIT)
         session.mount('https://', adapter)
         return session
 
@@ -71,27 +73,43 @@ class HiddifyAPIHandler:
             usage_limit = round(safe_float(raw.get("usage_limit_GB", 0)), 3)
             current_usage = round(safe_float(raw.get("current_usage_GB", 0)), 3)
             
-            normalized_data = {
-                "name": raw.get("name") or "کاربر ناشناس",
-                "uuid": raw.get("uuid", "").lower(),
-                "is_active": bool(raw.get("enable", False)),
-                "last_online": self._parse_api_datetime(raw.get("last_online")),
-                "usage_limit_GB": usage_limit,
-                "current_usage_GB": current_usage,
-                "remaining_GB": max(0, usage_limit - current_usage),
-                "usage_percentage": (current_usage / usage_limit * 100) if usage_limit > 0 else 0,
-                "expire": self._calculate_remaining_days(raw.get("start_date"), raw.get("package_days")),
-                "mode": raw.get("mode", "no_reset")
-            }
-            return normalized_data
-
-    @cached(api_cache)
-    def get_all_users(self) -> List[Dict[str, Any]]:
-        """فقط کاربران پنل Hiddify را برمیگرداند."""
+            # remaining_GB و usage_percentage هنگام خواندن از روی همین مقادیر حساب می‌شوند
+            return HiddifyUser(
+                name=raw.get("name") or "کاربر ناشناس",
+                uuid=raw.get("uuid", "").lower(),
+                is_active=bool(raw.get("enable", False)),
+                last_online=self._parse_api_datetime(raw.get("last_online")),
+                usage_limit_GB=usage_limit,
+                current_usage_GB=current_usage,
+                expire=self._calculate_remaining_days(raw.get("start_date"), raw.get("package_days")),
+                mode=raw.get("mode", "no_reset"),
+            )
+
+    def get_all_users(self, max_age: Optional[float] = None, allow_stale: bool = True) -> List[Dict[str, Any]]:
+        """فقط کاربران پنل Hiddify را برمیگرداند (از طریق users_cache؛ max_age و allow_stale به PanelCache.get می‌رسند)."""
+        return self.users_cache.get(max_age, allow_stale) or []
+
+    def iter_users(self) -> Iterator[HiddifyUser]:
+        """
+        کاربران پنل را یکی یکی و نرمال‌شده yield می‌کند. API نسخه ۲ هیدیفای صفحه‌بندی ندارد، پس
+        پاسخ یک‌جا دریافت می‌شود، ولی لیست نرمال‌شده دوم فقط وقتی ساخته می‌شود که فراخوان بخواهد.
+        اگر درخواست شکست بخورد RuntimeError می‌دهد.
+        """
         data = self._request("GET", "/user/")
-        if not data: return []
+        if data is None:
+            raise RuntimeError("Hiddify: Fetching the user list failed.")
         raw_users = data if isinstance(data, list) else data.get("results", []) or data.get("users", [])
-        return [norm_user for u in raw_users if (norm_user := self._norm(u))]
+        for raw in raw_users:
+            if norm_user := self._norm(raw):
+                yield norm_user
+
+    def _fetch_all_users(self) -> Optional[List[Dict[str, Any]]]:
+        """دانلود کامل لیست کاربران؛ در صورت خطا None برمیگرداند تا کش داده قبلی را نگه دارد."""
+        try:
+            return list(self.iter_users())
+        except RuntimeError as e:
+            logger.error(str(e))
+            return None
 
     def user_info(self, uuid: str) -> Optional[Dict[str, Any]]:
         """فقط اطلاعات یک کاربر از پنل Hiddify را برمیگرداند."""
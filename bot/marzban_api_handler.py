@@ -1,15 +1,27 @@
 import requests
+from requests.adapters import HTTPAdapter, Retry
 import logging
 import json
+import base64
+import threading
+import time
 from datetime import datetime, timedelta
+from typing import Iterator
 import pytz
-import os
-from .config import MARZBAN_API_BASE_URL, MARZBAN_API_USERNAME, MARZBAN_API_PASSWORD, API_TIMEOUT, api_cache
+from .config import (MARZBAN_API_BASE_URL, MARZBAN_API_USERNAME, MARZBAN_API_PASSWORD, API_TIMEOUT,
+                     PANEL_CONCURRENCY_LIMIT, MARZBAN_USERS_PAGE_SIZE, MARZBAN_USERS_FETCH_ATTEMPTS)
 from .database import db
-from cachetools import cached
+from .marzban_user_map import MarzbanUserMap
+from .panel_cache import PanelCache
+from .records import MarzbanUser
 
 logger = logging.getLogger(__name__)
 
+# توکن چند ثانیه قبل از انقضا تازه می‌شود تا درخواست‌ها به 401 نخورند
+TOKEN_REFRESH_MARGIN_SECONDS = 60
+# اگر توکن فیلد exp نداشت، این مدت معتبر فرض می‌شود
+TOKEN_FALLBACK_LIFETIME_SECONDS = 3600
+
 class MarzbanAPIHandler:
     def __init__(self):
         self.base_url = MARZBAN_API_BASE_URL.rstrip('/')
@@ -17,29 +29,44 @@ class MarzbanAPIHandler:
         self.username = MARZBAN_API_USERNAME
         self.password = MARZBAN_API_PASSWORD
         self.access_token = None
+        self.token_expires_at = 0.0
+        self._token_lock = threading.Lock()
         self.utc_tz = pytz.utc
-        self.uuid_to_username_map, self.username_to_uuid_map = {}, {}
+        # نگاشت UUID <-> نام کاربری از جدول marzban_user_map؛ هنگام استفاده به‌روز می‌شود
+        self.user_map = MarzbanUserMap()
         self.session = self._create_session() 
-        self.reload_uuid_maps()
+        self.users_cache = PanelCache('marzban', self._fetch_all_users)
 
     def _create_session(self) -> requests.Session:
+        # یک session با keep-alive برای همه درخواست‌ها؛ فقط متدهای idempotent دوباره ارسال می‌شوند
         session = requests.Session()
+        session.headers.update({"Accept": "application/json"})
+        retries = Retry(
+            total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset({"GET", "PUT", "DELETE", "HEAD", "OPTIONS"})
+        )
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=PANEL_CONCURRENCY_LIMIT)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
         return session
 
     def reload_uuid_maps(self) -> bool:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        uuid_map_path = os.path.join(current_dir, 'uuid_to_marzban_user.json')
+        """uuid_to_marzban_user.json را بدون توجه به mtime دوباره وارد جدول می‌کند (دکمه رفرش مپینگ ادمین)."""
+        return self.user_map.refresh(force_import=True)
+
+    @staticmethod
+    def _decode_token_expiry(token: str) -> float | None:
+        """زمان انقضای JWT (فیلد exp) را بدون بررسی امضا می‌خواند."""
         try:
-            with open(uuid_map_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                self.uuid_to_username_map = {k.lower(): v for k, v in data.items()}
-                self.username_to_uuid_map = {v: k.lower() for k, v in data.items()}
-                logger.info(f"Successfully loaded/reloaded {len(self.uuid_to_username_map)} user mappings from JSON.")
-                return True
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            logger.error(f"Could not load or reload {uuid_map_path}: {e}")
-            self.uuid_to_username_map, self.username_to_uuid_map = {}, {}
-            return False
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+            return float(exp) if exp else None
+        except (IndexError, ValueError, TypeError, AttributeError):
+            return None
+
+    def _token_is_fresh(self) -> bool:
+        return bool(self.access_token) and time.time() < self.token_expires_at - TOKEN_REFRESH_MARGIN_SECONDS
 
     def _get_access_token(self) -> bool:
         """Fetches and sets the access token. Returns True on success, False on failure."""
@@ -48,10 +75,11 @@ class MarzbanAPIHandler:
             data = {"username": self.username, "password": self.password}
             response = self.session.post(url, data=data, timeout=API_TIMEOUT) 
             response.raise_for_status()
-            self.access_token = response.json().get("access_token")
-            if self.access_token:
+            token = response.json().get("access_token")
+            if token:
+                self.token_expires_at = self._decode_token_expiry(token) or (time.time() + TOKEN_FALLBACK_LIFETIME_SECONDS)
+                self.access_token = token
                 logger.info("Marzban: Successfully obtained new access token.")
-                self.session.headers.update({"Authorization": f"Bearer {self.access_token}", "Accept": "application/json"})
                 return True
             logger.error("Marzban: Failed to get access token, token not found in response.")
             return False
@@ -59,28 +87,40 @@ class MarzbanAPIHandler:
             logger.error(f"Marzban: Failed to get access token: {e}", exc_info=True)
             self.access_token = None
             return False
+
+    def _ensure_token(self, stale_token: str | None = None) -> bool:
+        """
+        توکن معتبر را تضمین می‌کند. فقط یک thread در هر لحظه login می‌کند و بقیه منتظر همان
+        نتیجه می‌مانند. stale_token توکنی است که سرور با 401 رد کرده و باید حتما عوض شود.
+        """
+        if stale_token is None and self._token_is_fresh():
+            return True
+        with self._token_lock:
+            # شاید thread دیگری در زمان انتظار برای قفل توکن را تازه کرده باشد
+            if self._token_is_fresh() and self.access_token != stale_token:
+                return True
+            return self._get_access_token()
         
     def _request(self, method, endpoint, retry=True, **kwargs):
         """A central request function with automatic token refresh."""
-        if not self.access_token:
-            if not self._get_access_token():
-                return None
+        if not self._ensure_token():
+            return None
 
         url = f"{self.api_base_url}/{endpoint.strip('/')}"
-        headers = {"Authorization": f"Bearer {self.access_token}", "Accept": "application/json"}
-        kwargs['headers'] = headers
-        
+        token = self.access_token
+
         try:
-            response = self.session.request(method, url, timeout=API_TIMEOUT, **kwargs) 
+            response = self.session.request(
+                method, url, headers={"Authorization": f"Bearer {token}"}, timeout=API_TIMEOUT, **kwargs
+            )
             if response.status_code == 401 and retry:
                 logger.warning("Marzban: Access token expired or invalid. Retrying to get a new one.")
-                if self._get_access_token():
-                    kwargs['headers'] = self.session.headers
+                if self._ensure_token(stale_token=token):
                     return self._request(method, endpoint, retry=False, **kwargs)
 
             response.raise_for_status()
             
-            if response.status_code == 204:
+            if response.status_code == 204 or not response.content:
                 return True
             return response.json()
 
@@ -154,123 +194,140 @@ class MarzbanAPIHandler:
         
     def get_user_info(self, uuid: str) -> dict | None:
         """Gets a single user's details from Marzban by their Hiddify UUID."""
-        if not self.access_token:
-            if not self._get_access_token():
-                return None
-        
-        marzban_username = self.uuid_to_username_map.get(uuid.lower())
+        marzban_username = self.user_map.username_for(uuid)
         if not marzban_username:
             return None
 
         return self.get_user_by_username(marzban_username)
 
-    @cached(api_cache)
-    def get_all_users(self) -> list[dict]:
-            all_users_raw = self._request("GET", "/users")
-            if not all_users_raw or 'users' not in all_users_raw:
-                return []
+    def get_all_users(self, max_age: float | None = None, allow_stale: bool = True) -> list[dict]:
+        """کاربران پنل Marzban (از طریق users_cache؛ max_age و allow_stale به PanelCache.get می‌رسند)."""
+        return self.users_cache.get(max_age, allow_stale) or []
 
-            normalized_users = []
-            for user in all_users_raw['users']:
-                username = user.get("username")
-                if not username:
+    def _fetch_all_users(self) -> list[dict] | None:
+            """
+            دانلود کامل لیست کاربران (صفحه به صفحه)؛ در صورت خطا None برمی‌گرداند تا کش داده قبلی را نگه دارد.
+            اگر لیست بین دو صفحه جابجا شود کاربری ممکن است دو بار بیاید یا جا بماند؛ تکراری‌ها بر اساس
+            username یکتا می‌شوند و اگر تعداد یکتا با total پنل نخواند، دانلود دوباره انجام می‌شود. لیست
+            ناقص هرگز برگردانده نمی‌شود، چون همگام‌سازی کاربر جامانده را حذف‌شده حساب می‌کند.
+            """
+            for attempt in range(1, MARZBAN_USERS_FETCH_ATTEMPTS + 1):
+                users, candidates, page_info = {}, [], {}
+                try:
+                    for raw in self._iter_raw_users(MARZBAN_USERS_PAGE_SIZE, page_info):
+                        if user := self._normalize_user(raw):
+                            users[user['username']] = user
+                            if not user['uuid'] and (proxy_uuid := self._proxy_uuid(raw)):
+                                candidates.append((user['username'], proxy_uuid))
+                except RuntimeError as e:
+                    logger.error(f"{e} (attempt {attempt}/{MARZBAN_USERS_FETCH_ATTEMPTS})")
                     continue
+                total = page_info.get('total')
+                if total is None or len(users) == total:
+                    break
+                logger.warning(f"Marzban: Collected {len(users)} unique users but the panel reports {total} "
+                               f"(attempt {attempt}/{MARZBAN_USERS_FETCH_ATTEMPTS}).")
+            else:
+                return None
+            # کاربرانی که نگاشت ندارند ولی UUID پروتکلشان در هیدیفای هست، همین حالا نگاشت می‌گیرند
+            for username, uuid in self.user_map.discover(candidates).items():
+                users[username]['uuid'] = uuid
+            return list(users.values())
 
-                data_limit = user.get('data_limit')
-                limit_gb = round(data_limit / (1024**3), 3) if data_limit is not None else 0
-                
-                used_traffic = user.get('used_traffic', 0)
-                usage_gb = used_traffic / (1024 ** 3)
-                
-                uuid = self.username_to_uuid_map.get(username)
-                expire_timestamp = user.get('expire')
-                expire_days = None
-                if expire_timestamp and expire_timestamp > 0:
-                    expire_datetime = datetime.fromtimestamp(expire_timestamp, tz=self.utc_tz)
-                    expire_days = (expire_datetime - datetime.now(self.utc_tz)).days
-
-                normalized_data = {
-                    "username": username,
-                    "name": username,
-                    "uuid": uuid,
-                    "is_active": user.get('status') == 'active',
-                    "last_online": self._parse_marzban_datetime(user.get('online_at')),
-                    "usage_limit_GB": limit_gb,
-                    "current_usage_GB": usage_gb,
-                    "remaining_GB": max(0, limit_gb - usage_gb),
-                    "usage_percentage": (usage_gb / limit_gb * 100) if limit_gb > 0 else 0,
-                    "expire": expire_days,
-                }
-                normalized_users.append(normalized_data)
-                
-            return normalized_users
-        
-    def get_user_by_username(self, username: str) -> dict | None:
-        user = self._request("GET", f"/user/{username}")
-        if not user: return None
+    @staticmethod
+    def _proxy_uuid(user: dict) -> str | None:
+        """UUID پروتکل vless (یا vmess) کاربر؛ معمولا همان UUID کاربر در هیدیفای است."""
+        proxies = user.get('proxies') or {}
+        for protocol in ('vless', 'vmess'):
+            proxy_id = (proxies.get(protocol) or {}).get('id')
+            if proxy_id:
+                return proxy_id
+        return None
+
+    def iter_users(self, page_size: int = MARZBAN_USERS_PAGE_SIZE, **filters) -> Iterator[MarzbanUser]:
+        """
+        کاربران پنل را صفحه به صفحه (offset/limit) دریافت و نرمال‌شده yield می‌کند؛ در هر لحظه فقط یک
+        صفحه در حافظه است. filters (مثلا status='active' یا username) همان پارامترهای /users هستند.
+        اگر دریافت یک صفحه شکست بخورد RuntimeError می‌دهد.
+        """
+        for raw in self._iter_raw_users(page_size, **filters):
+            if user := self._normalize_user(raw):
+                yield user
+
+    def _iter_raw_users(self, page_size: int, page_info: dict | None = None, **filters) -> Iterator[dict]:
+        """
+        پاسخ خام /users صفحه به صفحه؛ iter_users و _fetch_all_users روی آن ساخته می‌شوند.
+        ترتیب با sort=created_at ثابت است تا کاربر جدید (که آخر لیست می‌آید) offset ها را جابجا نکند.
+        اگر total بین صفحه‌ها عوض شود (حذف یا افزودن حین صفحه‌بندی) RuntimeError می‌دهد؛ total آخرین
+        صفحه در page_info['total'] قرار می‌گیرد.
+        """
+        offset, first_total = 0, None
+        while True:
+            params = {'sort': 'created_at', **filters, 'offset': offset, 'limit': page_size}
+            page = self._request("GET", "/users", params=params)
+            if not isinstance(page, dict) or 'users' not in page:
+                raise RuntimeError(f"Marzban: Fetching users page at offset {offset} failed.")
+            users, total = page['users'], page.get('total')
+            if offset == 0:
+                first_total = total
+            elif total != first_total:
+                raise RuntimeError(f"Marzban: User list changed while paging (total {first_total} -> {total}).")
+            if page_info is not None:
+                page_info['total'] = total
+            yield from users
+            offset += len(users)
+            # صفحه ناقص، رسیدن به total، یا پنل قدیمی که offset/limit را نادیده می‌گیرد و همه را یک‌جا می‌فرستد
+            if len(users) != page_size or (total is not None and offset >= total):
+                return
+
+    def _normalize_user(self, user: dict) -> MarzbanUser | None:
+        username = user.get("username")
+        if not username:
+            return None
+
+        data_limit = user.get('data_limit')
+        limit_gb = round(data_limit / (1024**3), 3) if data_limit is not None else 0
+        usage_gb = (user.get('used_traffic') or 0) / (1024 ** 3)
 
-        uuid = self.username_to_uuid_map.get(username, None)
-        usage_gb = user.get('used_traffic', 0) / (1024 ** 3)
-        limit_gb = round(user.get('data_limit', 0) / (1024 ** 3), 3)
         expire_timestamp = user.get('expire')
         expire_days = None
         if expire_timestamp and expire_timestamp > 0:
             expire_datetime = datetime.fromtimestamp(expire_timestamp, tz=self.utc_tz)
             expire_days = (expire_datetime - datetime.now(self.utc_tz)).days
 
-        normalized_data = {
-            "username": username, "name": username, "uuid": uuid, "is_active": user.get('status') == 'active',
-            "last_online": self._parse_marzban_datetime(user.get('online_at')),
-            "usage_limit_GB": limit_gb, "current_usage_GB": usage_gb,
-            "remaining_GB": max(0, limit_gb - usage_gb),
-            "usage_percentage": (usage_gb / limit_gb * 100) if limit_gb > 0 else 0,
-            "expire": expire_days,
-        }
-        return normalized_data
+        return MarzbanUser(
+            username=username, name=username, uuid=self.user_map.uuid_for(username),
+            is_active=user.get('status') == 'active',
+            last_online=self._parse_marzban_datetime(user.get('online_at')),
+            usage_limit_GB=limit_gb, current_usage_GB=usage_gb, expire=expire_days,
+        )
+
+    def get_user_by_username(self, username: str) -> dict | None:
+        user = self._request("GET", f"/user/{username}")
+        if not user: return None
+        return self._normalize_user(user)
 
     def get_system_stats(self) -> dict | None:
-            if not self.access_token:
-                return None
-            try:
-                url = f"{self.base_url}/api/system"
-                headers = {"Authorization": f"Bearer {self.access_token}"}
-                response = requests.get(url, headers=headers, timeout=API_TIMEOUT)
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Marzban: Failed to get system stats: {e}")
-                return None
+        stats = self._request("GET", "/system")
+        return stats if isinstance(stats, dict) else None
 
     def delete_user(self, username: str) -> bool:
-        if not self.access_token:
-            return False
-        try:
-            url = f"{self.base_url}/api/user/{username}"
-            headers = {"Authorization": f"Bearer {self.access_token}"}
-            response = requests.delete(url, headers=headers, timeout=API_TIMEOUT)
-            response.raise_for_status()
-            return True
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Marzban: Failed to delete user '{username}': {e}")
+        if self._request("DELETE", f"/user/{username}") is None:
+            logger.error(f"Marzban: Failed to delete user '{username}'.")
             return False
+        return True
 
     def reset_user_usage(self, username: str) -> bool:
-        if not self.access_token:
-            return False
-        try:
-            url = f"{self.base_url}/api/user/{username}/reset"
-            headers = {"Authorization": f"Bearer {self.access_token}"}
-            response = requests.post(url, headers=headers, timeout=API_TIMEOUT)
-            response.raise_for_status()
-            return True
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Marzban: Failed to reset usage for user '{username}': {e}")
+        if self._request("POST", f"/user/{username}/reset") is None:
+            logger.error(f"Marzban: Failed to reset usage for user '{username}'.")
             return False
+        return True
 
     def check_connection(self) -> bool:
         """برای بررسی صحت اتصال و اطلاعات ورود، وضعیت سیستم را درخواست می‌کند."""
         logger.info("Checking Marzban panel connection...")
-        # تابع _get_access_token خودش اتصال را تست می‌کند
-        return self._get_access_token()
+        # توکن معتبر موجود دوباره استفاده می‌شود (login فقط وقتی لازم باشد)، ولی یک درخواست واقعی
+        # لازم است تا در دسترس نبودن پنل با توکن کش‌شده پنهان نماند
+        return self._request("GET", "/system") is not None
 
 marzban_handler = MarzbanAPIHandler()
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""
+نگاشت UUID هیدیفای <-> نام کاربری مرزبان.
+
+منبع اصلی جدول marzban_user_map است و هر پروسه (ربات و worker های وب‌اپ) یک کپی در حافظه دارد.
+هر MARZBAN_USER_MAP_CHECK_SECONDS ثانیه، فقط هنگام استفاده:
+  - اگر mtime فایل uuid_to_marzban_user.json عوض شده باشد، فایل به صورت افزایشی وارد جدول می‌شود
+    (اولین پروسه‌ای که تغییر را ببیند؛ بقیه با دیدن همان mtime در جدول دوباره وارد نمی‌کنند).
+  - اگر version جدول عوض شده باشد، کپی حافظه دوباره از جدول خوانده می‌شود.
+
+نگاشت‌های جدید از داده خود پنل هم کشف می‌شوند (discover): UUID پروتکل vless/vmess کاربر مرزبان،
+اگر همان UUID در هیدیفای یا ربات ثبت شده باشد. نگاشت فایل JSON بر نگاشت کشف‌شده اولویت دارد.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from .config import MARZBAN_USER_MAP_CHECK_SECONDS
+from .database import db
+
+logger = logging.getLogger(__name__)
+
+UUID_MAP_JSON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uuid_to_marzban_user.json')
+
+
+class MarzbanUserMap:
+    def __init__(self, json_path: str = UUID_MAP_JSON_PATH, database=db,
+                 check_interval: float = MARZBAN_USER_MAP_CHECK_SECONDS):
+        self.json_path = json_path
+        self.db = database
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._checked_at = float('-inf')
+        # فایل خرابی که یک بار خطا داده تا تغییر بعدی دوباره خوانده نمی‌شود
+        self._failed_mtime_ns: Optional[int] = None
+        self._uuid_to_username: Dict[str, str] = {}
+        self._username_to_uuid: Dict[str, str] = {}
+
+    @property
+    def uuid_to_username(self) -> Dict[str, str]:
+        self._maybe_refresh()
+        return self._uuid_to_username
+
+    @property
+    def username_to_uuid(self) -> Dict[str, str]:
+        self._maybe_refresh()
+        return self._username_to_uuid
+
+    def username_for(self, uuid: Optional[str]) -> Optional[str]:
+        return self.uuid_to_username.get(uuid.lower()) if uuid else None
+
+    def uuid_for(self, username: Optional[str]) -> Optional[str]:
+        return self.username_to_uuid.get(username) if username else None
+
+    def _maybe_refresh(self) -> None:
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self.refresh()
+
+    def refresh(self, force_import: bool = False) -> bool:
+        """
+        فایل JSON را در صورت تغییر (یا با force_import) وارد و کپی حافظه را در صورت تغییر version
+        به‌روز می‌کند. اگر فایل خوانده نشود False برمی‌گرداند؛ نگاشت جدول در هر حال استفاده می‌شود.
+        """
+        with self._lock:
+            self._checked_at = time.monotonic()
+            ok = self._import_json(force_import)
+            try:
+                state = self.db.get_marzban_user_map_state()
+                if state['version'] != self._version:
+                    rows = self.db.get_marzban_user_map()
+                    self._uuid_to_username = {uuid: username for uuid, username in rows}
+                    self._username_to_uuid = {username: uuid for uuid, username in rows}
+                    self._version = state['version']
+                    logger.info(f"MARZBAN_USER_MAP: Loaded {len(rows)} mappings (version {self._version}).")
+            except Exception as e:
+                logger.error(f"MARZBAN_USER_MAP: Reading mappings from the database failed: {e}")
+                return False
+            return ok
+
+    def _import_json(self, force: bool) -> bool:
+        try:
+            mtime_ns = os.stat(self.json_path).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        try:
+            if not force:
+                if mtime_ns == self._failed_mtime_ns:
+                    return False
+                state = self.db.get_marzban_user_map_state()
+                if state.get('json_mtime_ns') == mtime_ns:
+                    return True
+            with open(self.json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            changes = self.db.import_marzban_user_map(data, mtime_ns, force=force)
+            if changes:
+                logger.info(f"MARZBAN_USER_MAP: Imported {changes} changed mappings from {self.json_path}.")
+            return True
+        except (OSError, json.JSONDecodeError, AttributeError) as e:
+            logger.error(f"Could not load or reload {self.json_path}: {e}")
+            self._failed_mtime_ns = mtime_ns
+            return False
+        except Exception as e:
+            logger.error(f"MARZBAN_USER_MAP: Importing {self.json_path} failed: {e}")
+            return False
+
+    def discover(self, candidates: Iterable[Tuple[str, str]]) -> Dict[str, str]:
+        """
+        candidates: جفت‌های (username، UUID پروتکل) کاربران مرزبانی که نگاشت ندارند. آن‌هایی که UUID شان
+        در هیدیفای یا ربات وجود دارد ذخیره و به صورت {username: uuid} برگردانده می‌شوند.
+        """
+        candidates = {username: uuid.lower() for username, uuid in candidates if username and uuid}
+        if not candidates:
+            return {}
+        try:
+            known = self.db.filter_hiddify_uuids(candidates.values())
+            found = {username: uuid for username, uuid in candidates.items()
+                     if uuid in known and uuid not in self._uuid_to_username}
+            if found and self.db.add_discovered_marzban_users((uuid, username) for username, uuid in found.items()):
+                logger.info(f"MARZBAN_USER_MAP: Discovered {len(found)} mappings from panel data.")
+                self.refresh()
+            # ردیف‌هایی که به خاطر تداخل ذخیره نشدند در نگاشت نهایی نیستند
+            return {username: uuid for username, uuid in found.items() if self._username_to_uuid.get(username) == uuid}
+        except Exception as e:
+            logger.error(f"MARZBAN_USER_MAP: Discovering mappings failed: {e}")
+            return {}
@@ -0,0 +1,226 @@
+"""
+کش لیست کاربران هر پنل (PanelCache) و کش اطلاعات ترکیبی هر اکانت (UserInfoCache).
+
+- single-flight: در هر لحظه حداکثر یک دانلود /users برای هر پنل در جریان است و بقیه
+  فراخوانی‌ها منتظر همان نتیجه می‌مانند.
+- stale-while-revalidate: داده قدیمی‌تر از max_age (ولی جوان‌تر از stale_ttl) فورا برگردانده
+  می‌شود و یک refresh در پس‌زمینه شروع می‌شود.
+- هر مصرف‌کننده می‌تواند max_age خودش را بدهد؛ allow_stale=False یعنی حتما منتظر داده تازه بماند.
+- اگر دانلود شکست بخورد (loader مقدار None برگرداند یا خطا بدهد)، داده قبلی دور ریخته نمی‌شود.
+- دانلودی که قبل از invalidate شروع شده قدیمی است: نتیجه‌اش تازه حساب نمی‌شود و فراخوانی‌های
+  بعد از invalidate به جای منتظر ماندن برای آن، یک دانلود جدید شروع می‌کنند.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from .config import PANEL_CACHE_TTL, PANEL_CACHE_STALE_TTL, USER_INFO_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="panel-cache")
+_registry: Dict[str, Any] = {}
+
+
+class PanelCache:
+    def __init__(self, name: str, loader: Callable[[], Optional[List[Dict[str, Any]]]],
+                 ttl: float = PANEL_CACHE_TTL, stale_ttl: float = PANEL_CACHE_STALE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._value: Optional[List[Dict[str, Any]]] = None
+        self._loaded_at = 0.0
+        self._inflight: Optional[Future] = None
+        # با هر invalidate یک واحد زیاد می‌شود؛ هر refresh مقدار زمان شروعش را همراه دارد
+        self._invalidations = 0
+        self._inflight_invalidations = 0
+        self._stats = {
+            'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0,
+            'last_refresh_seconds': None, 'max_refresh_seconds': 0.0, 'total_refresh_seconds': 0.0,
+        }
+        _registry[name] = self
+
+    def get(self, max_age: Optional[float] = None, allow_stale: bool = True) -> Optional[List[Dict[str, Any]]]:
+        """
+        لیست کاربران پنل را برمی‌گرداند. max_age پیش‌فرض همان ttl است.
+        اگر هیچ داده‌ای در دسترس نباشد None برمی‌گرداند.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            age = time.monotonic() - self._loaded_at
+            if self._value is not None and age <= max_age:
+                self._stats['hits'] += 1
+                return self._value
+            if self._value is not None and allow_stale and age <= self.stale_ttl:
+                self._stats['stale_hits'] += 1
+                self._start_refresh()
+                return self._value
+            self._stats['misses'] += 1
+            future = self._start_refresh()
+        # _refresh خطا را خودش لاگ می‌کند و در آن صورت آخرین داده موجود (یا None) را برمی‌گرداند
+        return future.result()
+
+    def get_fresh(self, max_age: float) -> Optional[List[Dict[str, Any]]]:
+        """
+        مثل get(max_age, allow_stale=False)، با این تفاوت که اگر دانلود شکست بخورد به جای داده
+        قدیمی None برمی‌گرداند. برای همگام‌سازی‌ای که نباید داده قدیمی را نسخه جدید حساب کند.
+        """
+        started = time.monotonic()
+        value = self.get(max_age, allow_stale=False)
+        with self._lock:
+            fresh = value is not None and self._loaded_at >= started - max_age
+        return value if fresh else None
+
+    def peek(self, max_age: float) -> Optional[List[Dict[str, Any]]]:
+        """داده فعلی را فقط اگر جوان‌تر از max_age باشد برمی‌گرداند؛ هیچ دانلودی شروع نمی‌کند."""
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._loaded_at <= max_age:
+                return self._value
+        return None
+
+    def invalidate(self) -> None:
+        """داده فعلی را منقضی می‌کند؛ فراخوانی بعدی (در صورت اجازه) داده قدیمی را می‌گیرد و refresh شروع می‌شود."""
+        with self._lock:
+            self._invalidations += 1
+            self._loaded_at = time.monotonic() - self.stale_ttl
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['age_seconds'] = round(time.monotonic() - self._loaded_at, 1) if self._value is not None else None
+            stats['size'] = len(self._value) if self._value is not None else 0
+            stats['refreshing'] = self._inflight is not None
+        stats['total_refresh_seconds'] = round(stats['total_refresh_seconds'], 3)
+        stats['avg_refresh_seconds'] = (
+            round(stats['total_refresh_seconds'] / stats['refreshes'], 3) if stats['refreshes'] else None
+        )
+        return stats
+
+    def _start_refresh(self) -> Future:
+        """باید با self._lock گرفته‌شده صدا زده شود."""
+        if self._inflight is None or self._inflight_invalidations != self._invalidations:
+            self._inflight_invalidations = self._invalidations
+            self._inflight = _refresh_executor.submit(self._refresh, self._invalidations)
+        return self._inflight
+
+    def _refresh(self, invalidations: int) -> Optional[List[Dict[str, Any]]]:
+        started = time.monotonic()
+        try:
+            value = self._loader()
+        except Exception as e:
+            logger.error(f"PANEL_CACHE: Refreshing {self.name} users failed: {e}", exc_info=True)
+            value = None
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            if self._inflight_invalidations == invalidations:
+                self._inflight = None
+            self._stats['refreshes'] += 1
+            self._stats['last_refresh_seconds'] = round(elapsed, 3)
+            self._stats['max_refresh_seconds'] = max(self._stats['max_refresh_seconds'], round(elapsed, 3))
+            self._stats['total_refresh_seconds'] += elapsed
+            if value is None:
+                self._stats['errors'] += 1
+                return self._value
+            if invalidations != self._invalidations:
+                # ممکن است قبل از تغییر خوانده شده باشد؛ فقط اگر داده دیگری نباشد (منقضی) نگه داشته می‌شود
+                if self._value is None:
+                    self._value = value
+                logger.info(f"PANEL_CACHE: Discarded {self.name} refresh started before invalidation.")
+                return value
+            self._value = value
+            self._loaded_at = time.monotonic()
+        logger.info(f"PANEL_CACHE: Refreshed {self.name} users ({len(value)}) in {elapsed:.2f}s.")
+        return value
+
+
+class UserInfoCache:
+    """
+    کش اطلاعات ترکیبی اکانت‌ها. هر ورودی با چند کلید (UUID، نام کاربری و شناسه درخواستی)
+    ذخیره می‌شود و invalidate با هر کدام از آن‌ها کل ورودی را حذف می‌کند.
+    put و get رکوردهای پنل داخل breakdown را هم کپی می‌کنند تا نوشتن فراخوان به ورودی کش نرسد.
+    ورودی‌های منقضی هنگام put (حداکثر هر ttl ثانیه یک بار) پاک می‌شوند تا کش بی‌حد بزرگ نشود.
+    """
+    def __init__(self, name: str, ttl: float = USER_INFO_CACHE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._pruned_at = time.monotonic()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+        _registry[name] = self
+
+    @staticmethod
+    def _key(key: Any) -> Optional[str]:
+        return str(key).strip().lower() if key else None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(self._key(key))
+            if entry is None or entry['expires_at'] < time.monotonic():
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            return self._detach(entry['info'])
+
+    def put(self, info: Dict[str, Any], *keys: Any) -> None:
+        entry_keys = {k for k in map(self._key, (*keys, info.get('uuid'), info.get('name'))) if k}
+        entry = {'info': self._detach(info), 'keys': entry_keys, 'expires_at': time.monotonic() + self.ttl}
+        with self._lock:
+            self._prune()
+            for key in entry_keys:
+                self._drop(key)
+            for key in entry_keys:
+                self._entries[key] = entry
+
+    def invalidate(self, *keys: Any) -> None:
+        with self._lock:
+            for key in filter(None, map(self._key, keys)):
+                if self._drop(key):
+                    self._stats['invalidations'] += 1
+
+    def _drop(self, key: str) -> bool:
+        """باید با self._lock گرفته‌شده صدا زده شود."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        for alias in entry['keys']:
+            if self._entries.get(alias) is entry:
+                del self._entries[alias]
+        return True
+
+    @staticmethod
+    def _detach(info: Dict[str, Any]) -> Dict[str, Any]:
+        """کپی info با رکوردهای پنل جدا (fork)؛ فراخوان‌ها فیلدهای نمایشی را در breakdown می‌نویسند."""
+        info = dict(info)
+        breakdown = info.get('breakdown')
+        if isinstance(breakdown, dict):
+            info['breakdown'] = {panel: record.fork() if hasattr(record, 'fork') else dict(record)
+                                 for panel, record in breakdown.items()}
+        return info
+
+    def _prune(self) -> None:
+        """باید با self._lock گرفته‌شده صدا زده شود."""
+        now = time.monotonic()
+        if now - self._pruned_at < self.ttl:
+            return
+        self._pruned_at = now
+        expired = [key for key, entry in self._entries.items() if entry['expires_at'] < now]
+        for key in expired:
+            if self._drop(key):
+                self._stats['evictions'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len({id(entry) for entry in self._entries.values()})
+        return stats
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """شمارنده‌های کش همه پنل‌ها (برای گزارش و داشبورد)."""
+    return {name: cache.stats() for name, cache in _registry.items()}
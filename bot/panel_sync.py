@@ -0,0 +1,207 @@
+"""
+همگام‌سازی دوره‌ای لیست کاربران پنل‌ها با جدول panel_users.
+
+ربات و وب‌اپ دو پروسه جدا هستند و کش داخل حافظه را به اشتراک نمی‌گذارند؛ این سرویس (داخل
+پروسه ربات) هر PANEL_SYNC_INTERVAL ثانیه هر دو پنل را می‌خواند و نتیجه را به صورت یک
+generation در SQLite می‌نویسد. خواننده‌ها از combined_handler.get_all_users_mirrored استفاده می‌کنند.
+
+هر رکورد نرمال‌شده یک fingerprint دارد. هر همگام‌سازی با نسخه قبلی مقایسه و یک PanelDiff
+(کاربران اضافه‌شده، حذف‌شده و تغییرکرده به همراه فیلدهای تغییرکرده) ساخته می‌شود؛ فقط همین
+تغییرات در دیتابیس نوشته و برای subscriber ها (مثلا ChangeTracker کارهای scheduler) ارسال می‌شوند.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .config import PANEL_SYNC_INTERVAL, PANEL_MIRROR_MAX_AGE
+from .database import db, panel_user_key
+from .hiddify_api_handler import hiddify_handler
+from .marzban_api_handler import marzban_handler
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(user: Dict[str, Any]) -> bytes:
+    """اثر انگشت ۸ بایتی یک رکورد نرمال‌شده؛ ترتیب کلیدها اثری ندارد."""
+    payload = json.dumps(dict(user), sort_keys=True, ensure_ascii=False, default=str).encode()
+    return hashlib.blake2b(payload, digest_size=8).digest()
+
+
+class PanelDiff:
+    """
+    تفاوت یک همگام‌سازی با همگام‌سازی قبلی همان پنل.
+    full=True یعنی نسخه قبلی در دسترس نبوده (اولین همگام‌سازی پروسه) و همه کاربران در added هستند.
+    """
+    __slots__ = ('panel', 'generation', 'full', 'added', 'removed', 'changed')
+
+    def __init__(self, panel: str, generation: Optional[int], full: bool, added: Dict[str, Dict[str, Any]],
+                 removed: Dict[str, Dict[str, Any]], changed: Dict[str, Tuple[Dict[str, Any], Set[str]]]):
+        self.panel = panel
+        self.generation = generation
+        self.full = full
+        self.added = added
+        self.removed = removed
+        # key -> (رکورد جدید، نام فیلدهای تغییرکرده)
+        self.changed = changed
+
+    def __bool__(self) -> bool:
+        return bool(self.full or self.added or self.removed or self.changed)
+
+    def __repr__(self) -> str:
+        return (f"PanelDiff({self.panel}, gen={self.generation}, full={self.full}, +{len(self.added)} "
+                f"-{len(self.removed)} ~{len(self.changed)})")
+
+    def uuids(self, fields: Optional[Iterable[str]] = None) -> Set[str]:
+        """
+        UUID کاربرانی که اضافه یا حذف شده‌اند، یا یکی از fields آن‌ها تغییر کرده است
+        (اگر fields داده نشود، هر تغییری حساب می‌شود).
+        """
+        fields = set(fields) if fields else None
+        records = list(self.added.values()) + list(self.removed.values())
+        records += [user for user, changed in self.changed.values() if fields is None or changed & fields]
+        return {user['uuid'] for user in records if user.get('uuid')}
+
+
+def diff_users(panel: str, previous: Optional[Dict[str, Tuple[bytes, Dict[str, Any]]]],
+               users: List[Dict[str, Any]]) -> Tuple[PanelDiff, Dict[str, Tuple[bytes, Dict[str, Any]]]]:
+    """
+    لیست جدید را با نسخه قبلی (key -> (fingerprint, رکورد)) مقایسه می‌کند.
+    خروجی: diff و نسخه جدید برای مقایسه بعدی.
+    """
+    current: Dict[str, Tuple[bytes, Dict[str, Any]]] = {}
+    for user in users:
+        key = panel_user_key(panel, user)
+        if key:
+            current[key] = (fingerprint(user), user)
+
+    if previous is None:
+        return PanelDiff(panel, None, True, {k: u for k, (_, u) in current.items()}, {}, {}), current
+
+    added, changed = {}, {}
+    for key, (fp, user) in current.items():
+        old = previous.get(key)
+        if old is None:
+            added[key] = user
+        elif old[0] != fp:
+            old_user = old[1]
+            fields = {f for f in user.keys() | old_user.keys() if user.get(f) != old_user.get(f)}
+            changed[key] = (user, fields)
+    removed = {key: user for key, (_, user) in previous.items() if key not in current}
+    return PanelDiff(panel, None, False, added, removed, changed), current
+
+
+class ChangeTracker:
+    """
+    یک subscriber که UUID های تغییرکرده را بین دو drain() جمع می‌کند.
+    drain() وقتی None برمی‌گرداند که فهرست کامل نیست و مصرف‌کننده باید همه کاربران را بررسی کند:
+    اولین drain، بعد از یک diff کامل، یا وقتی همگام‌سازی بیش از max_gap ثانیه انجام نشده باشد.
+    """
+    def __init__(self, fields: Optional[Iterable[str]] = None, max_gap: float = PANEL_MIRROR_MAX_AGE):
+        self.fields = set(fields) if fields else None
+        self.max_gap = max_gap
+        self._lock = threading.Lock()
+        self._uuids: Set[str] = set()
+        self._full = True
+        self._last_diff_at: Dict[str, float] = {}
+
+    def __call__(self, diff: PanelDiff) -> None:
+        with self._lock:
+            self._last_diff_at[diff.panel] = time.monotonic()
+            if diff.full:
+                self._full = True
+            else:
+                self._uuids |= diff.uuids(self.fields)
+
+    def drain(self, panels: Iterable[str] = ('hiddify', 'marzban')) -> Optional[Set[str]]:
+        with self._lock:
+            now = time.monotonic()
+            stale = any(now - self._last_diff_at.get(p, float('-inf')) > self.max_gap for p in panels)
+            uuids, full = self._uuids, self._full or stale
+            self._uuids, self._full = set(), False
+        return None if full else uuids
+
+
+class PanelSyncService:
+    def __init__(self, interval: float = PANEL_SYNC_INTERVAL, database=db):
+        self.interval = interval
+        self.db = database
+        self._handlers = {'hiddify': hiddify_handler, 'marzban': marzban_handler}
+        self._states: Dict[str, Dict[str, Tuple[bytes, Dict[str, Any]]]] = {}
+        self._subscribers: List[Callable[[PanelDiff], None]] = []
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, callback: Callable[[PanelDiff], None]) -> Callable[[PanelDiff], None]:
+        """callback(diff) بعد از هر همگام‌سازی موفق هر پنل (در thread همگام‌سازی) صدا زده می‌شود."""
+        self._subscribers.append(callback)
+        return callback
+
+    def sync_once(self) -> Dict[str, Optional[PanelDiff]]:
+        """
+        هر دو پنل را یک بار همگام می‌کند. خروجی: diff هر پنل، یا None اگر ناموفق بود.
+        scheduler هم می‌تواند قبل از کارهایش این را صدا بزند؛ قفل مانع اجرای همزمان دو همگام‌سازی است.
+        """
+        with self._sync_lock:
+            return {panel: self._sync_panel(panel, handler) for panel, handler in self._handlers.items()}
+
+    def _sync_panel(self, panel: str, handler) -> Optional[PanelDiff]:
+        started = time.monotonic()
+        try:
+            # از همان کش single-flight استفاده می‌شود تا با خواننده‌های دیگر دانلود تکراری نشود
+            users = handler.users_cache.get_fresh(self.interval / 2)
+            if users is None:
+                raise RuntimeError("panel did not return a user list")
+            diff, state = diff_users(panel, self._states.get(panel), users)
+            if diff.full:
+                diff.generation = self.db.replace_panel_users(panel, users)
+            elif diff:
+                diff.generation = self.db.apply_panel_user_changes(
+                    panel, list(diff.added.values()) + [u for u, _ in diff.changed.values()],
+                    diff.removed.keys(), len(state)
+                )
+            else:
+                # بدون تغییر فقط synced_at جلو می‌رود تا خواننده‌ها کپی را تازه بدانند؛ generation ثابت
+                # می‌ماند تا ساخته‌های وابسته به آن (UserDirectory، PlanIndex) دوباره ساخته نشوند
+                diff.generation = self.db.touch_panel_sync_state(panel, len(state))
+            self._states[panel] = state
+            logger.info(f"PANEL_SYNC: {diff} in {time.monotonic() - started:.2f}s.")
+        except Exception as e:
+            logger.error(f"PANEL_SYNC: Syncing {panel} failed: {e}")
+            try:
+                self.db.record_panel_sync_error(panel, str(e))
+            except Exception:
+                logger.exception("PANEL_SYNC: Could not record sync error.")
+            return None
+
+        for callback in self._subscribers:
+            try:
+                callback(diff)
+            except Exception as e:
+                logger.error(f"PANEL_SYNC: Subscriber {callback!r} failed: {e}", exc_info=True)
+        return diff
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="panel-sync", daemon=True)
+        self._thread.start()
+        logger.info(f"PANEL_SYNC: Started, syncing every {self.interval}s.")
+
+    def shutdown(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+            except Exception as e:
+                logger.error(f"PANEL_SYNC: Loop error: {e}", exc_info=True)
+            self._stop.wait(self.interval)
+
+
+panel_sync = PanelSyncService()
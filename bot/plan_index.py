@@ -0,0 +1,127 @@
+"""
+ایندکس عضویت کاربران در پلن‌ها (plans.json) برای گزارش «کاربران بر اساس پلن» و دستورهای گروهی.
+
+مشخصات هر کاربر (حجم پنل آلمان، حجم پنل فرانسه) با حجم پلن‌ها مقایسه می‌شود؛ کاربری که در
+پنلی نیست حجم -1 دارد. ایندکس برای هر generation همگام‌سازی و هر نسخه plans.json فقط یک بار
+ساخته می‌شود، در جدول plan_index ذخیره می‌شود تا پروسه دیگر (وب‌اپ یا ربات) آن را دوباره نسازد،
+و بین صفحه‌های یک گزارش در حافظه می‌ماند.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .database import db
+from .user_directory import UserDirectory, get_user_directory, user_key
+from .utils import SERVICE_PLANS_PATH, load_service_plans, parse_volume_string
+
+logger = logging.getLogger(__name__)
+
+PlanSpec = Tuple[float, float]
+
+
+def plan_spec(plan: Dict[str, Any]) -> PlanSpec:
+    return (float(parse_volume_string(plan.get('volume_de', '0'))),
+            float(parse_volume_string(plan.get('volume_fr', '0'))))
+
+
+def user_spec(user: Dict[str, Any]) -> PlanSpec:
+    breakdown = user.get('breakdown', {})
+    return (breakdown.get('hiddify', {}).get('usage_limit_GB', -1.0),
+            breakdown.get('marzban', {}).get('usage_limit_GB', -1.0))
+
+
+def _plans_key() -> str:
+    try:
+        stat = os.stat(SERVICE_PLANS_PATH)
+    except OSError:
+        return 'missing'
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class PlanIndex:
+    def __init__(self, directory: UserDirectory, plans: List[Dict[str, Any]], plans_key: str,
+                 members: List[List[str]], unmatched: List[str]):
+        self.directory = directory
+        self.plans = plans
+        self.plans_key = plans_key
+        self._members = members
+        self._unmatched = unmatched
+
+    @classmethod
+    def build(cls, directory: UserDirectory, plans: List[Dict[str, Any]], plans_key: str) -> 'PlanIndex':
+        # چند پلن می‌توانند مشخصات یکسان داشته باشند؛ کاربر عضو همه آن‌ها می‌شود
+        plans_by_spec: Dict[PlanSpec, List[int]] = {}
+        for i, plan in enumerate(plans):
+            plans_by_spec.setdefault(plan_spec(plan), []).append(i)
+        members: List[List[str]] = [[] for _ in plans]
+        unmatched: List[str] = []
+        for user in directory.users:
+            key = user_key(user)
+            if not key:
+                continue
+            indexes = plans_by_spec.get(user_spec(user))
+            if indexes is None:
+                unmatched.append(key)
+            for i in indexes or ():
+                members[i].append(key)
+        return cls(directory, plans, plans_key, members, unmatched)
+
+    def to_json(self) -> str:
+        return json.dumps({'members': self._members, 'unmatched': self._unmatched}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, directory: UserDirectory, plans: List[Dict[str, Any]], plans_key: str, data: str) -> 'PlanIndex':
+        payload = json.loads(data)
+        return cls(directory, plans, plans_key, payload['members'], payload['unmatched'])
+
+    def _users(self, keys: List[str]) -> List[Dict[str, Any]]:
+        by_key = self.directory.by_key
+        return [by_key[key] for key in keys if key in by_key]
+
+    def users_in_plan(self, plan_index: int) -> List[Dict[str, Any]]:
+        return self._users(self._members[plan_index])
+
+    def users_without_plan(self) -> List[Dict[str, Any]]:
+        return self._users(self._unmatched)
+
+    def counts(self) -> Dict[str, Any]:
+        return {'plans': [len(keys) for keys in self._members], 'unmatched': len(self._unmatched)}
+
+
+_lock = threading.Lock()
+_index: Optional[PlanIndex] = None
+
+
+def get_plan_index() -> PlanIndex:
+    """ایندکس پلن‌ها برای UserDirectory فعلی و نسخه فعلی plans.json."""
+    global _index
+    directory = get_user_directory()
+    plans_key = _plans_key()
+    with _lock:
+        index = _index
+        if index is not None and index.directory is directory and index.plans_key == plans_key:
+            return index
+
+        plans = load_service_plans()
+        generation = ':'.join(map(str, directory.generation)) if directory.generation else None
+        index = None
+        if generation:
+            try:
+                data = db.get_plan_index(plans_key, generation)
+                if data:
+                    index = PlanIndex.from_json(directory, plans, plans_key, data)
+            except Exception as e:
+                logger.warning(f"PLAN_INDEX: Loading stored index failed: {e}")
+        if index is None:
+            index = PlanIndex.build(directory, plans, plans_key)
+            logger.info(f"PLAN_INDEX: Built for generation {generation}: {index.counts()}")
+            if generation and not directory.users.partial:
+                try:
+                    db.save_plan_index(plans_key, generation, index.to_json())
+                except Exception as e:
+                    logger.warning(f"PLAN_INDEX: Saving index failed: {e}")
+        if not directory.users.partial:
+            _index = index
+        return index
@@ -0,0 +1,88 @@
+"""
+بخش‌بندی کاربران بر اساس last_online با یک تعریف مشترک برای همه گزارش‌ها:
+
+  online           اتصال در ONLINE_WINDOW_SECONDS اخیر (زمان کمی جلوتر از الان هم آنلاین حساب می‌شود)
+  active           اتصال در ACTIVE_WINDOW_SECONDS اخیر
+  inactive         آخرین اتصال بین ACTIVE_WINDOW_SECONDS و INACTIVE_WINDOW_SECONDS پیش
+  dormant          آخرین اتصال DORMANT_AFTER_SECONDS پیش یا قدیمی‌تر
+  never_connected  بدون last_online
+
+PresenceIndex کاربران را بر اساس زمان آخرین اتصال مرتب نگه می‌دارد و هر بخش را با دو جستجوی
+دودویی (bisect) و بدون بررسی تک‌تک کاربران برمی‌گرداند. UserDirectory برای هر generation یک
+نمونه ترکیبی و یک نمونه برای هر پنل می‌سازد (UserDirectory.presence).
+"""
+import time
+from bisect import bisect_right
+from datetime import datetime
+from typing import Any, Iterable, List, Optional, Tuple
+
+import pytz
+
+from .config import ACTIVE_WINDOW_SECONDS, DORMANT_AFTER_SECONDS, INACTIVE_WINDOW_SECONDS, ONLINE_WINDOW_SECONDS
+
+
+def last_online_epoch(value: Any) -> Optional[float]:
+    """last_online (datetime با یا بدون منطقه زمانی، رشته ISO یا epoch) به epoch؛ بدون اتصال None."""
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = pytz.utc.localize(value)
+        return value.timestamp()
+    return None
+
+
+def is_online(last_online: Any, now: Optional[float] = None) -> bool:
+    seen = last_online_epoch(last_online)
+    return seen is not None and (now if now is not None else time.time()) - seen < ONLINE_WINDOW_SECONDS
+
+
+class PresenceIndex:
+    def __init__(self, entries: Iterable[Tuple[Any, Any]]):
+        """entries: جفت‌های (last_online، آیتم)؛ آیتم هر چیزی است که فراخوان می‌خواهد پس بگیرد."""
+        timed, self._never = [], []
+        for last_online, item in entries:
+            seen = last_online_epoch(last_online)
+            if seen is None:
+                self._never.append(item)
+            else:
+                timed.append((seen, item))
+        timed.sort(key=lambda entry: entry[0])
+        self._times = [seen for seen, _ in timed]
+        self._items = [item for _, item in timed]
+
+    def seen_between(self, newer_than: Optional[float], older_than: Optional[float], now: Optional[float] = None) -> List[Any]:
+        """
+        آیتم‌هایی که آخرین اتصالشان کمتر از newer_than ثانیه و حداقل older_than ثانیه پیش بوده است
+        (None یعنی بدون محدودیت)، به ترتیب جدیدترین اتصال.
+        """
+        now = now if now is not None else time.time()
+        start = bisect_right(self._times, now - newer_than) if newer_than is not None else 0
+        # اتصال ثبت‌شده کمی بعد از now (اختلاف ساعت پنل) در بازه‌های بدون older_than می‌ماند
+        end = bisect_right(self._times, now - older_than) if older_than is not None else len(self._times)
+        return self._items[start:end][::-1]
+
+    def online(self, now: Optional[float] = None) -> List[Any]:
+        return self.seen_between(ONLINE_WINDOW_SECONDS, None, now)
+
+    def active(self, now: Optional[float] = None) -> List[Any]:
+        return self.seen_between(ACTIVE_WINDOW_SECONDS, None, now)
+
+    def inactive(self, now: Optional[float] = None) -> List[Any]:
+        return self.seen_between(INACTIVE_WINDOW_SECONDS, ACTIVE_WINDOW_SECONDS, now)
+
+    def dormant(self, now: Optional[float] = None) -> List[Any]:
+        return self.seen_between(None, DORMANT_AFTER_SECONDS, now)
+
+    def never_connected(self) -> List[Any]:
+        return list(self._never)
+
+    def __len__(self) -> int:
+        return len(self._items) + len(self._never)
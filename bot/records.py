@@ -0,0 +1,272 @@
+"""
+رکوردهای فشرده کاربران پنل‌ها.
+
+HiddifyUser و MarzbanUser خروجی نرمال‌شده هر پنل و CombinedUser خروجی ترکیب دو پنل هستند.
+هر سه با __slots__ ساخته می‌شوند و فیلدهای محاسبه‌ای (remaining_GB، usage_percentage، usage،
+status، breakdown و ...) فقط هنگام خواندن حساب می‌شوند؛ CombinedUser هم به جای کپی کردن
+رکورد پنل‌ها فقط به آن‌ها اشاره می‌کند.
+
+برای formatter ها، template ها و کدهای قدیمی، رکوردها MutableMapping هستند و مثل dict رفتار
+می‌کنند (get، [] ، in، items، ** و dict(record)). کلیدهایی که جزو فیلدها نیستند (مثل
+expire_shamsi یا daily_usage_gb که وب‌اپ اضافه می‌کند) در یک dict جانبی نگه داشته می‌شوند که
+فقط در صورت نیاز ساخته می‌شود. برای JSON از to_dict() استفاده کنید.
+"""
+from collections.abc import Mapping, MutableMapping
+from datetime import datetime
+from types import MappingProxyType
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import pytz
+
+from .presence import is_online
+
+
+class Record(MutableMapping):
+    """پایه رکوردها: fields در slot ها ذخیره می‌شوند و derived ها property های فقط‌خواندنی هستند."""
+    __slots__ = ('_extra',)
+    fields: Tuple[str, ...] = ()
+    derived: Tuple[str, ...] = ()
+
+    def __init__(self, **values: Any):
+        for field in self.fields:
+            setattr(self, field, values.pop(field, None))
+        for key in self.derived:
+            values.pop(key, None)
+        self._extra = values or None
+
+    def _inherited(self) -> Optional[Mapping]:
+        """کلیدهایی که رکورد خودش ندارد از این mapping خوانده می‌شوند (برای CombinedUser)."""
+        return None
+
+    def __getitem__(self, key: str) -> Any:
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        if key in self._field_set or key in self._derived_set:
+            return getattr(self, key)
+        inherited = self._inherited()
+        if inherited is not None:
+            return inherited[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in self._field_set:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.fields
+        extra = self._extra or {}
+        own = self._field_set | self._derived_set
+        yield from (key for key in self.derived if key not in extra)
+        inherited = self._inherited()
+        if inherited is not None:
+            yield from (key for key in inherited if key not in own and key not in extra)
+        yield from (key for key in extra if key not in self._field_set)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __bool__(self) -> bool:
+        # رکورد همیشه فیلدهایش را دارد؛ بدون این، bool() همه کلیدها را می‌شمرد
+        return True
+
+    def __contains__(self, key: object) -> bool:
+        if key in self._field_set or key in self._derived_set or (self._extra is not None and key in self._extra):
+            return True
+        inherited = self._inherited()
+        return inherited is not None and key in inherited
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def copy(self) -> Dict[str, Any]:
+        """مثل dict.copy یک کپی سطحی (به صورت dict) برمی‌گرداند."""
+        return dict(self.items())
+
+    def fork(self) -> 'Record':
+        """
+        کپی سبک با همان مقادیر ولی dict جانبی جدا؛ برای افزودن فیلد به رکوردهای مشترک (مثلا
+        کاربران UserDirectory) بدون اثر روی بقیه مصرف‌کننده‌ها. رکوردهای پنل کپی نمی‌شوند.
+        """
+        clone = object.__new__(type(self))
+        for slot in self._slots:
+            setattr(clone, slot, getattr(self, slot))
+        clone._extra = dict(self._extra) if self._extra else None
+        return clone
+
+    def to_dict(self) -> Dict[str, Any]:
+        """تبدیل کامل به dict (رکوردهای تودرتو هم تبدیل می‌شوند)؛ برای jsonify و ذخیره."""
+        return {key: _plain(value) for key, value in self.items()}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.fields)
+        cls._derived_set = frozenset(cls.derived)
+        cls._slots = tuple(slot for klass in cls.__mro__ for slot in klass.__dict__.get('__slots__', ())
+                           if slot != '_extra')
+
+
+Record._field_set = frozenset()
+Record._derived_set = frozenset()
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    return value
+
+
+class PanelUser(Record):
+    __slots__ = ()
+    derived = ('remaining_GB', 'usage_percentage')
+
+    @property
+    def remaining_GB(self) -> float:
+        return max(0, self.usage_limit_GB - self.current_usage_GB)
+
+    @property
+    def usage_percentage(self) -> float:
+        return (self.current_usage_GB / self.usage_limit_GB * 100) if self.usage_limit_GB > 0 else 0
+
+
+class HiddifyUser(PanelUser):
+    """خروجی HiddifyAPIHandler._norm."""
+    fields = ('name', 'uuid', 'is_active', 'last_online', 'usage_limit_GB', 'current_usage_GB', 'expire', 'mode')
+    __slots__ = fields
+
+
+class MarzbanUser(PanelUser):
+    """خروجی نرمال‌سازی MarzbanAPIHandler."""
+    fields = ('username', 'name', 'uuid', 'is_active', 'last_online', 'usage_limit_GB', 'current_usage_GB', 'expire')
+    __slots__ = fields
+
+
+PANEL_RECORDS = {'hiddify': HiddifyUser, 'marzban': MarzbanUser}
+
+
+def panel_record(panel: str, data: Dict[str, Any]) -> PanelUser:
+    """ساخت رکورد یک پنل از dict (مثلا ستون data جدول panel_users)."""
+    return PANEL_RECORDS[panel](**data)
+
+
+def _aware(value: Any) -> Optional[datetime]:
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(value, datetime) and value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value or None
+
+
+_EMPTY = MappingProxyType({})
+
+
+class CombinedUser(Record):
+    """
+    اطلاعات ترکیبی یک کاربر از هر دو پنل (خروجی combined_handler._process_single_user_data).
+    کلیدهای رکورد پنل اصلی (Hiddify اگر باشد، وگرنه Marzban) که اینجا بازنویسی نشده‌اند،
+    مثل current_usage_GB، از همان رکورد خوانده می‌شوند.
+    """
+    fields = ('name', 'uuid', 'is_active', 'last_online', 'expire')
+    derived = ('breakdown', 'panels', 'usage', 'status', 'is_online', 'username', 'on_hiddify', 'on_marzban')
+    __slots__ = fields + ('hiddify', 'marzban', '_breakdown')
+
+    def __init__(self, h_info: Optional[Mapping], m_info: Optional[Mapping]):
+        self._extra = None
+        self._breakdown = None
+        # پنلی که کاربر روی آن نیست None نگه داشته می‌شود و در breakdown به صورت {} دیده می‌شود
+        self.hiddify = h_info or None
+        self.marzban = m_info or None
+        h_info, m_info = h_info or _EMPTY, m_info or _EMPTY
+
+        self.is_active = h_info.get('is_active', False) or m_info.get('is_active', False)
+        self.name = h_info.get('name') or m_info.get('name', 'ناشناس')
+        self.uuid = h_info.get('uuid') or m_info.get('uuid')
+
+        h_online, m_online = _aware(h_info.get('last_online')), _aware(m_info.get('last_online'))
+        self.last_online = max(h_online, m_online) if h_online and m_online else (h_online or m_online)
+
+        h_expire = h_info.get('expire', -1)
+        m_expire = m_info.get('expire', -1)
+        if h_expire == -1 and m_expire == -1:
+            self.expire = -1  # نامحدود
+        elif h_expire == -1:
+            self.expire = m_expire
+        elif m_expire == -1:
+            self.expire = h_expire
+        else:
+            self.expire = max(h_expire, m_expire)
+
+    def _inherited(self) -> Optional[Mapping]:
+        return self.hiddify or self.marzban
+
+    def fork(self) -> 'CombinedUser':
+        clone = super().fork()
+        clone._breakdown = None
+        return clone
+
+    @property
+    def breakdown(self) -> Dict[str, Mapping]:
+        # یک بار ساخته و نگه داشته می‌شود تا تغییرات فراخوان (setdefault و ...) حفظ شوند
+        if self._breakdown is None:
+            self._breakdown = {'hiddify': self.hiddify or {}, 'marzban': self.marzban or {}}
+        return self._breakdown
+
+    @property
+    def panels(self) -> str:
+        panels = []
+        if self.hiddify:
+            panels.append("آلمان (Hiddify)")
+        if self.marzban:
+            panels.append("فرانسه (Marzban)")
+        return " + ".join(panels) if panels else "نامشخص"
+
+    @property
+    def usage(self) -> Dict[str, float]:
+        h_info, m_info = self.hiddify or _EMPTY, self.marzban or _EMPTY
+        total_limit = h_info.get('usage_limit_GB', 0) + m_info.get('usage_limit_GB', 0)
+        total_usage = h_info.get('current_usage_GB', 0) + m_info.get('current_usage_GB', 0)
+        return {
+            'total_usage_GB': total_usage,
+            'data_limit_GB': total_limit,
+            'remaining_GB': max(0, total_limit - total_usage),
+            'percentage': (total_usage / total_limit * 100) if total_limit > 0 else 0
+        }
+
+    @property
+    def status(self) -> str:
+        if self.is_active:
+            return 'active'
+        h_info, m_info = self.hiddify or _EMPTY, self.marzban or _EMPTY
+        if (h_info.get('expire', -1) < 0) or (m_info.get('expire', -1) < 0):
+            return 'expired'
+        return 'disabled'
+
+    @property
+    def is_online(self) -> bool:
+        return is_online(self.last_online)
+
+    @property
+    def username(self) -> str:
+        return self.name
+
+    @property
+    def on_hiddify(self) -> bool:
+        return bool(self.hiddify)
+
+    @property
+    def on_marzban(self) -> bool:
+        return bool(self.marzban)
@@ -2,15 +2,20 @@ import logging
 import threading
 import time
 from datetime import datetime
+from typing import Optional, Set, Tuple
 import schedule
 import pytz
 from telebot import apihelper, TeleBot
 from .config import (DAILY_REPORT_TIME, TEHRAN_TZ, ADMIN_IDS,BIRTHDAY_GIFT_GB, BIRTHDAY_GIFT_DAYS,
                      WARNING_USAGE_THRESHOLD,WARNING_DAYS_BEFORE_EXPIRY,
                      USAGE_WARNING_CHECK_HOURS, ONLINE_REPORT_UPDATE_HOURS, EMOJIS,
-                     DAILY_USAGE_ALERT_THRESHOLD_GB)
+                     DAILY_USAGE_ALERT_THRESHOLD_GB, SNAPSHOT_RAW_RETENTION_DAYS,
+                     SNAPSHOT_DAILY_RETENTION_DAYS, SNAPSHOT_RETENTION_BATCH_SIZE, SNAPSHOT_RETENTION_TIME)
 from .database import db
 from . import combined_handler
+from .async_api import run_bulk
+from .panel_sync import panel_sync, ChangeTracker
+from .user_directory import UserDirectory, get_user_directory
 from .utils import escape_markdown, format_daily_usage
 from .menu import menu
 from .admin_formatters import fmt_admin_report, fmt_online_users_list
@@ -26,20 +31,50 @@ class SchedulerManager:
         self.running = False
         self.tz = pytz.timezone(TEHRAN_TZ) if isinstance(TEHRAN_TZ, str) else TEHRAN_TZ
         self.tz_str = str(self.tz)
+        # تغییرات همگام‌سازی پنل‌ها بین دو اجرای هر کار جمع می‌شود تا فقط اکانت‌های تغییرکرده بررسی شوند
+        self._snapshot_changes = panel_sync.subscribe(ChangeTracker(fields={'current_usage_GB'}))
+        self._warning_changes = panel_sync.subscribe(ChangeTracker(
+            fields={'current_usage_GB', 'usage_limit_GB', 'expire', 'is_active', 'last_online'}
+        ))
+        # اکانت‌هایی که در اجرای قبلی در شرایط هشدار بودند؛ تا وقتی در آن شرایط بمانند دوباره بررسی می‌شوند
+        self._warning_carry_over: Set[str] = set()
+
+    def _users_with_changes(self, tracker: ChangeTracker) -> Tuple[UserDirectory, Optional[Set[str]]]:
+        """
+        پنل‌ها را همگام می‌کند و UserDirectory همان generation را برمی‌گرداند، به همراه UUID هایی که از
+        اجرای قبلی همین کار تغییر کرده‌اند. اگر همگام‌سازی ناموفق باشد، داده زنده و None (بررسی همه) برمی‌گردد.
+        """
+        diffs = panel_sync.sync_once()
+        changed = tracker.drain()
+        if any(diff is None for diff in diffs.values()):
+            return UserDirectory.build(combined_handler.get_all_users_combined(allow_stale=False)), None
+        return get_user_directory(), changed
 
     def _hourly_snapshots(self) -> None:
         logger.info("Scheduler: Running hourly usage snapshot job.")
+        job_start = time.perf_counter()
         
-        all_users_info = combined_handler.get_all_users_combined()
+        # snapshot باید مصرف فعلی را ثبت کند؛ همگام‌سازی قبل از خواندن انجام می‌شود
+        directory, changed = self._users_with_changes(self._snapshot_changes)
+        all_users_info = directory.users
         if not all_users_info:
             return
+        if all_users_info.partial:
+            # مصرف پنل غایب صفر ثبت می‌شد و در rollup روزانه مثل ریست مصرف دیده می‌شد
+            logger.warning(f"Scheduler: Skipping usage snapshots, panels missing: {', '.join(all_users_info.missing_panels)}.")
+            return
             
-        user_info_map = {user['uuid']: user for user in all_users_info}
+        user_info_map = directory.by_uuid
 
         all_uuids_from_db = db.all_active_uuids()
         if not all_uuids_from_db:
             return
+        if changed is not None:
+            # مقدار بدون تغییر فقط وقتی keyframe آن سررسید شده باشد نوشته می‌شود
+            due = db.snapshot_keyframes_due(row['id'] for row in all_uuids_from_db)
+            all_uuids_from_db = [row for row in all_uuids_from_db if row['uuid'] in changed or row['id'] in due]
 
+        snapshots = []
         for u_row in all_uuids_from_db:
             try:
                 uuid_str = u_row['uuid']
@@ -53,20 +88,51 @@ class SchedulerManager:
                     h_usage = h_info.get('current_usage_GB', 0.0) if h_info else 0.0
                     m_usage = m_info.get('current_usage_GB', 0.0) if m_info else 0.0
 
-                    db.add_usage_snapshot(u_row['id'], h_usage, m_usage)
+                    snapshots.append((u_row['id'], h_usage, m_usage))
 
             except Exception as e:
                 logger.error(f"Scheduler: Failed to process snapshot for uuid_id {u_row['id']}: {e}")
 
+        write_start = time.perf_counter()
+        try:
+            written = db.add_usage_snapshots_bulk(snapshots)
+        except Exception as e:
+            logger.error(f"Scheduler: Failed to write {len(snapshots)} usage snapshots: {e}", exc_info=True)
+            return
+        now = time.perf_counter()
+        logger.info(f"Scheduler: Wrote {written}/{len(snapshots)} usage snapshots (unchanged skipped) in {now - write_start:.3f}s (job total {now - job_start:.3f}s).")
+
     def _check_for_warnings(self) -> None:
             logger.info("Scheduler: Running warnings check job.")
             
-            all_uuids_from_db = db.all_active_uuids()
+            # همه داده‌های لازم با تعداد ثابتی کوئری خوانده می‌شوند و تصمیم‌ها در حافظه گرفته می‌شود
+            all_uuids_from_db = db.get_active_uuids_with_settings()
             if not all_uuids_from_db:
                 logger.info("SCHEDULER: No active UUIDs in DB to check warnings for. JOB STOPPED.") # لاگ مهم
                 return
 
-            all_users_info_map = {u['uuid']: u for u in combined_handler.get_all_users_combined()}
+            directory, changed = self._users_with_changes(self._warning_changes)
+            all_users_info_map = directory.by_uuid
+            recent_warnings = db.get_recent_warnings(hours=24)
+            daily_usage_map = db.get_all_daily_usage_since_midnight() if DAILY_USAGE_ALERT_THRESHOLD_GB > 0 else {}
+            now_utc = datetime.now(pytz.utc)
+
+            if changed is not None:
+                # بقیه اکانت‌ها از اجرای قبلی تغییری نکرده‌اند و شرایط هشدارشان هم عوض نشده است؛
+                # پیام خوشامد و هشدار مصرف روزانه به داده دیتابیس وابسته‌اند و جدا اضافه می‌شوند
+                candidates = changed | self._warning_carry_over | {
+                    uuid for uuid, usage in daily_usage_map.items()
+                    if sum(usage.values()) >= DAILY_USAGE_ALERT_THRESHOLD_GB
+                }
+                total = len(all_uuids_from_db)
+                all_uuids_from_db = [
+                    row for row in all_uuids_from_db
+                    if row['uuid'] in candidates or not row.get('first_connection_time') or not row.get('welcome_message_sent')
+                ]
+                logger.info(f"SCHEDULER: Checking {len(all_uuids_from_db)}/{total} UUIDs changed since the last run.")
+
+            new_warnings, first_connections, welcomed = [], [], []
+            carry_over = set()
             
             for u_row in all_uuids_from_db:
                 uuid_str = u_row['uuid']
@@ -78,16 +144,16 @@ class SchedulerManager:
                 if not info:
                     continue
 
-                user_settings = db.get_user_settings(user_id_in_telegram)
+                user_settings = u_row['settings']
                 user_name = escape_markdown(info.get('name', 'کاربر ناشناس'))
 
                 # 1. Welcome Message Logic
                 if info.get('last_online') and not u_row.get('first_connection_time'):
-                    db.set_first_connection_time(uuid_id_in_db, datetime.now(pytz.utc))
+                    first_connections.append(uuid_id_in_db)
                 
                 if u_row.get('first_connection_time') and not u_row.get('welcome_message_sent'):
-                    first_conn_time = u_row['first_connection_time'].replace(tzinfo=pytz.utc)
-                    if (datetime.now(pytz.utc) - first_conn_time).total_seconds() >= 48 * 3600:
+                    # first_connection_time به صورت epoch ذخیره شده است
+                    if now_utc.timestamp() - u_row['first_connection_time'] >= 48 * 3600:
                         welcome_text = (
                             f"🎉 *به جمع ما خوش آمدی!* 🎉\n\n"
                             f"از اینکه به ما اعتماد کردی خوشحالیم. امیدواریم از کیفیت سرویس لذت ببری.\n\n"
@@ -96,7 +162,7 @@ class SchedulerManager:
                         )
                         try:
                             self.bot.send_message(user_id_in_telegram, welcome_text, parse_mode="MarkdownV2")
-                            db.mark_welcome_message_as_sent(uuid_id_in_db)
+                            welcomed.append(uuid_id_in_db)
                             logger.info(f"Welcome message sent to user {user_id_in_telegram}")
                         except Exception as e:
                             logger.error(f"Failed to send welcome message to user {user_id_in_telegram}: {e}")
@@ -105,12 +171,13 @@ class SchedulerManager:
                 if user_settings.get('expiry_warnings'):
                     expire_days = info.get('expire')
                     if expire_days is not None and 0 <= expire_days <= WARNING_DAYS_BEFORE_EXPIRY:
-                        if not db.has_recent_warning(uuid_id_in_db, 'expiry'):
+                        carry_over.add(uuid_str)
+                        if (uuid_id_in_db, 'expiry') not in recent_warnings:
                             msg = (f"{EMOJIS['warning']} *هشدار انقضای اکانت*\n\n"
                                 f"اکانت *{user_name}* شما تا *{expire_days}* روز دیگر منقضی می‌شود.")
                             try:
                                 self.bot.send_message(user_id_in_telegram, msg, parse_mode="MarkdownV2")
-                                db.log_warning(uuid_id_in_db, 'expiry')
+                                new_warnings.append((uuid_id_in_db, 'expiry'))
                             except Exception as e:
                                 logger.error(f"Failed to send expiry warning to user {user_id_in_telegram}: {e}")
 
@@ -129,8 +196,9 @@ class SchedulerManager:
                         if limit > 0:
                             usage_percent = (usage / limit) * 100
                             if usage_percent >= WARNING_USAGE_THRESHOLD:
+                                carry_over.add(uuid_str)
                                 warning_type = f'low_data_{code}'
-                                if not db.has_recent_warning(uuid_id_in_db, warning_type):
+                                if (uuid_id_in_db, warning_type) not in recent_warnings:
                                     remaining_gb = max(0, limit - usage)
                                     server_name = details['name']
                                     msg = (f"{EMOJIS['warning']} *هشدار اتمام حجم*\n\n"
@@ -138,17 +206,17 @@ class SchedulerManager:
                                         f"{list_bullet}حجم باقیمانده: *{remaining_gb:.2f} GB*")
                                     try:
                                         self.bot.send_message(user_id_in_telegram, msg, parse_mode="MarkdownV2")
-                                        db.log_warning(uuid_id_in_db, warning_type)
+                                        new_warnings.append((uuid_id_in_db, warning_type))
                                     except Exception as e:
                                         logger.error(f"Failed to send data warning to user {user_id_in_telegram}: {e}")
                 
                 # 4. Unusual Daily Usage Alert (for Admin)
                 if DAILY_USAGE_ALERT_THRESHOLD_GB > 0:
-                    daily_usage_dict = db.get_usage_since_midnight(uuid_id_in_db)
+                    daily_usage_dict = daily_usage_map.get(uuid_str, {})
                     total_daily_usage = sum(daily_usage_dict.values())
                     if total_daily_usage >= DAILY_USAGE_ALERT_THRESHOLD_GB:
                         warning_type = 'unusual_daily_usage'
-                        if not db.has_recent_warning(uuid_id_in_db, warning_type, hours=24):
+                        if (uuid_id_in_db, warning_type) not in recent_warnings:
                             list_bullet = escape_markdown("- ")
                             alert_msg = (f"{EMOJIS['warning']} *هشدار مصرف غیرعادی روزانه*\n\n"
                                         f"کاربر *{user_name}* (`{escape_markdown(uuid_str)}`) از حد مجاز مصرف روزانه عبور کرده است.\n\n"
@@ -159,7 +227,18 @@ class SchedulerManager:
                                     self.bot.send_message(admin_id, alert_msg, parse_mode="MarkdownV2")
                                 except Exception as e:
                                     logger.error(f"Failed to send unusual usage alert to admin {admin_id}: {e}")
-                            db.log_warning(uuid_id_in_db, warning_type)
+                            new_warnings.append((uuid_id_in_db, warning_type))
+
+            self._warning_carry_over = carry_over
+
+            # --- Batched writes ---
+            try:
+                db.set_first_connection_times(first_connections, now_utc)
+                db.mark_welcome_messages_as_sent(welcomed)
+                db.log_warnings(new_warnings)
+            except Exception as e:
+                logger.error(f"Scheduler: Failed to persist warning job results: {e}", exc_info=True)
+            logger.info(f"Scheduler: Warnings check finished, {len(new_warnings)} warning(s) logged.")
 
     def _nightly_report(self) -> None:
             tehran_tz = pytz.timezone("Asia/Tehran")
@@ -168,14 +247,15 @@ class SchedulerManager:
             now_str = now_shamsi.strftime("%Y/%m/%d - %H:%M")
             logger.info(f"SCHEDULER: ----- Running nightly report at {now_str} -----")
 
-            all_users_info_from_api = combined_handler.get_all_users_combined()
+            directory = get_user_directory()
+            all_users_info_from_api = directory.users
             if not all_users_info_from_api:
                 logger.warning("SCHEDULER: Could not fetch any user info from API. JOB STOPPED.")
                 return
                 
             logger.info(f"SCHEDULER: Fetched {len(all_users_info_from_api)} total users from API.")
 
-            user_info_map = {user['uuid']: user for user in all_users_info_from_api}
+            user_info_map = directory.by_uuid
             all_bot_users = db.get_all_user_ids()
             separator = '\n' + '─' * 18 + '\n'
 
@@ -201,7 +281,7 @@ class SchedulerManager:
 
                     # --- User Report (for ALL users, including admins) ---
                     logger.info(f"SCHEDULER: Now checking for personal user report for user_id: {user_id}.")
-                    user_uuids_from_db = db.uuids(user_id)
+                    user_uuids_from_db = directory.uuid_rows_of(user_id)
                     user_infos_for_report = []
                     
                     if not user_uuids_from_db:
@@ -210,8 +290,9 @@ class SchedulerManager:
                         logger.info(f"SCHEDULER: User {user_id} has {len(user_uuids_from_db)} UUID(s) in DB. Matching with API data...")
                         for u_row in user_uuids_from_db:
                             if u_row['uuid'] in user_info_map:
-                                user_data = user_info_map[u_row['uuid']]
-                                user_data['db_id'] = u_row['id'] 
+                                # رکوردهای directory مشترک‌اند؛ فیلد اضافه روی کپی نوشته می‌شود
+                                user_data = user_info_map[u_row['uuid']].fork()
+                                user_data['db_id'] = u_row['id']
                                 user_infos_for_report.append(user_data)
                         
                         if user_infos_for_report:
@@ -226,11 +307,7 @@ class SchedulerManager:
                         else:
                             logger.warning(f"SCHEDULER: No active accounts found in API for user {user_id} after matching. No user report will be sent.")
 
-                    # --- Cleanup Snapshots ---
-                    if user_uuids_from_db:
-                        for info in user_uuids_from_db:
-                            db.delete_daily_snapshots(info['id'])
-                        logger.info(f"Scheduler: Cleaned up daily snapshots for user {user_id}.")
+                    # پاک‌سازی snapshot ها به _snapshot_retention منتقل شده است
                             
                 except Exception as e:
                     logger.error(f"SCHEDULER: CRITICAL FAILURE while processing main loop for user {user_id}: {e}", exc_info=True)
@@ -240,19 +317,24 @@ class SchedulerManager:
         logger.info("Scheduler: Running 3-hourly online user report update.")
         
         messages_to_update = db.get_scheduled_messages('online_users_report')
+        if not messages_to_update:
+            return
+        directory = get_user_directory()
+        # مصرف امروز همه UUID ها با یک کوئری برای همه پیام‌ها
+        daily_usage_map = db.get_all_daily_usage_since_midnight()
         
         for msg_info in messages_to_update:
             try:
                 chat_id = msg_info['chat_id']
                 message_id = msg_info['message_id']
                 
-                online_list = [u for u in combined_handler.get_all_users_combined() if u.get('last_online') and (datetime.now(pytz.utc) - u['last_online']).total_seconds() < 180]
+                online_list = [u.fork() for u in directory.presence().online()]
 
                 for user in online_list:
                     if user.get('uuid'):
-                        user['daily_usage_GB'] = sum(db.get_usage_since_midnight_by_uuid(user['uuid']).values())
+                        user['daily_usage_GB'] = sum(daily_usage_map.get(user['uuid'], {}).values())
                 
-                text = fmt_online_users_list(online_list, 0)
+                text = fmt_online_users_list(online_list, 0, bot_users=directory.bot_users)
                 # Note: The back button here is a placeholder as this is an automated update.
                 kb = menu.create_pagination_menu("admin:list:online_users:both", 0, len(online_list), "admin:reports_menu") 
                 
@@ -279,11 +361,11 @@ class SchedulerManager:
             if not user_uuids:
                 continue
             
-            gift_applied_successfully = False
-            for row in user_uuids:
-                uuid = row['uuid']
-                if combined_handler.modify_user_on_all_panels(uuid, add_gb=BIRTHDAY_GIFT_GB, add_days=BIRTHDAY_GIFT_DAYS):
-                    gift_applied_successfully = True
+            results = run_bulk(
+                combined_handler.modify_user_on_all_panels, [row['uuid'] for row in user_uuids],
+                add_gb=BIRTHDAY_GIFT_GB, add_days=BIRTHDAY_GIFT_DAYS
+            )
+            gift_applied_successfully = any(results)
             
             if gift_applied_successfully:
                 try:
@@ -299,6 +381,17 @@ class SchedulerManager:
                 except Exception as e:
                     logger.error(f"Scheduler: Failed to send birthday message to user {user_id}: {e}")
 
+    def _snapshot_retention(self) -> None:
+        logger.info("Scheduler: Running usage snapshot retention job.")
+        try:
+            db.apply_snapshot_retention(
+                raw_days=SNAPSHOT_RAW_RETENTION_DAYS,
+                daily_days=SNAPSHOT_DAILY_RETENTION_DAYS,
+                batch_size=SNAPSHOT_RETENTION_BATCH_SIZE
+            )
+        except Exception as e:
+            logger.error(f"Scheduler: Snapshot retention failed: {e}", exc_info=True)
+
     def _run_monthly_vacuum(self) -> None:
         today = datetime.now(self.tz)
         if today.day == 1:
@@ -318,6 +411,7 @@ class SchedulerManager:
         schedule.every().day.at(report_time_str, self.tz_str).do(self._nightly_report)
         schedule.every(ONLINE_REPORT_UPDATE_HOURS).hours.do(self._update_online_reports)
         schedule.every().day.at("00:05", self.tz_str).do(self._birthday_gifts_job)
+        schedule.every().day.at(SNAPSHOT_RETENTION_TIME, self.tz_str).do(self._snapshot_retention)
         schedule.every().day.at("04:00", self.tz_str).do(self._run_monthly_vacuum)
         
         self.running = True
@@ -0,0 +1,241 @@
+"""
+ایندکس جستجوی سراسری ادمین (combined_handler.search_user).
+
+هر کاربر پنل (و مشخصات تلگرام و یادداشت ادمین هر UUID) یک سند است. متن فیلدها نرمال می‌شود و
+سه‌حرفی‌های (trigram) آن در ایندکس ثبت می‌شود؛ جستجوی سه حرف یا بیشتر اشتراک لیست‌های
+سه‌حرفی‌هاست و بعد با زیررشته بودن واقعی تایید می‌شود. جستجوی یک یا دو حرفی فقط روی ابتدای
+کلمات (به جز UUID) انجام می‌شود.
+
+ایندکس با diff های panel_sync به‌روز می‌شود (فقط کاربران اضافه‌شده، حذف‌شده و تغییرکرده) و
+مشخصات تلگرام هر PROFILE_REFRESH_SECONDS ثانیه از دیتابیس دوباره خوانده می‌شود. تا وقتی هر دو
+پنل همگام نشده باشند، search() مقدار None برمی‌گرداند و جستجو روی کپی کامل کاربران انجام می‌شود.
+"""
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .config import PANEL_MIRROR_MAX_AGE, SEARCH_RESULT_LIMIT
+from .database import db, panel_user_key
+from .panel_sync import PanelDiff, panel_sync
+
+logger = logging.getLogger(__name__)
+
+# وزن هر فیلد در رتبه‌بندی نتایج
+FIELD_WEIGHTS = {'name': 1.0, 'uuid': 1.0, 'username': 1.0, 'telegram': 0.8, 'note': 0.5}
+PROFILE_REFRESH_SECONDS = 60
+
+_TOKEN_SPLIT = re.compile(r"[\s\-_.@/]+")
+_CHAR_MAP = str.maketrans({'ي': 'ی', 'ك': 'ک', '\u200c': ' '})
+
+
+def normalize(text: Any) -> str:
+    """حروف کوچک، ی و ک فارسی و فاصله به جای نیم‌فاصله."""
+    return str(text).translate(_CHAR_MAP).casefold().strip() if text else ''
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _tokens(text: str) -> List[str]:
+    return [token for token in _TOKEN_SPLIT.split(text) if token]
+
+
+class _Doc:
+    __slots__ = ('entity', 'fields')
+
+    def __init__(self, entity: str, fields: Tuple[Tuple[str, str], ...]):
+        self.entity = entity
+        self.fields = fields
+
+
+class SearchIndex:
+    def __init__(self, database=db, max_age: float = PANEL_MIRROR_MAX_AGE):
+        self.db = database
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._ids: Dict[Tuple[str, str], int] = {}
+        self._docs: Dict[int, _Doc] = {}
+        self._next_id = 0
+        self._grams: Dict[str, Set[int]] = {}
+        self._prefixes: Dict[str, Set[int]] = {}
+        # entity (UUID یا marzban_<نام>) -> رکورد هر پنل، برای ساخت نتیجه بدون خواندن لیست کامل
+        self._records: Dict[str, Dict[str, Any]] = {'hiddify': {}, 'marzban': {}}
+        self._synced_at: Dict[str, float] = {}
+        self._profiles: Dict[str, Tuple[Tuple[str, str], ...]] = {}
+        self._profiles_loaded_at = float('-inf')
+
+    # ------------------------------------------------------------------
+    # به‌روزرسانی
+    # ------------------------------------------------------------------
+    def __call__(self, diff: PanelDiff) -> None:
+        """subscriber همگام‌سازی پنل‌ها."""
+        with self._lock:
+            panel = diff.panel
+            if diff.full:
+                for source in [s for s in self._ids if s[0] == panel]:
+                    self._remove(source)
+                self._records[panel].clear()
+            for key in diff.removed:
+                self._remove_panel_user(panel, key)
+            for user in diff.added.values():
+                self._add_panel_user(panel, user)
+            for user, _ in diff.changed.values():
+                self._add_panel_user(panel, user)
+            self._synced_at[panel] = time.monotonic()
+        if time.monotonic() - self._profiles_loaded_at >= PROFILE_REFRESH_SECONDS:
+            self.refresh_profiles()
+
+    def refresh_profiles(self) -> None:
+        """مشخصات تلگرام و یادداشت ادمین UUID ها؛ فقط ردیف‌های تغییرکرده دوباره ایندکس می‌شوند."""
+        try:
+            rows = self.db.get_uuid_search_fields()
+        except Exception as e:
+            logger.error(f"SEARCH_INDEX: Loading Telegram profiles failed: {e}")
+            return
+        profiles = {}
+        for row in rows:
+            fields = [('telegram', normalize(row.get(key))) for key in ('username', 'first_name')]
+            fields.append(('note', normalize(row.get('admin_note'))))
+            profiles[row['uuid']] = tuple(f for f in fields if f[1])
+        with self._lock:
+            for uuid in self._profiles.keys() - profiles.keys():
+                self._remove(('profile', uuid))
+            for uuid, fields in profiles.items():
+                if self._profiles.get(uuid) != fields:
+                    self._remove(('profile', uuid))
+                    if fields:
+                        self._add(('profile', uuid), uuid, fields)
+            self._profiles = profiles
+            self._profiles_loaded_at = time.monotonic()
+
+    @staticmethod
+    def _entity(panel: str, user: Dict[str, Any]) -> Optional[str]:
+        # همان کلیدی که combined_handler برای ترکیب کاربران دو پنل استفاده می‌کند
+        if user.get('uuid'):
+            return user['uuid']
+        return f"marzban_{user['name']}" if panel == 'marzban' and user.get('name') else None
+
+    def _add_panel_user(self, panel: str, user: Dict[str, Any]) -> None:
+        key = panel_user_key(panel, user)
+        self._remove_panel_user(panel, key)
+        entity = self._entity(panel, user)
+        if not key or not entity:
+            return
+        fields = [('name', normalize(user.get('name'))), ('uuid', normalize(user.get('uuid')))]
+        if panel == 'marzban':
+            fields.append(('username', normalize(user.get('username'))))
+        self._add((panel, key), entity, tuple(f for f in dict.fromkeys(fields) if f[1]))
+        self._records[panel][entity] = user
+
+    def _remove_panel_user(self, panel: str, key: Optional[str]) -> None:
+        doc_id = self._ids.get((panel, key))
+        if doc_id is None:
+            return
+        entity = self._docs[doc_id].entity
+        self._records[panel].pop(entity, None)
+        self._remove((panel, key))
+
+    def _add(self, source: Tuple[str, str], entity: str, fields: Tuple[Tuple[str, str], ...]) -> None:
+        doc_id = self._next_id
+        self._next_id += 1
+        self._ids[source] = doc_id
+        self._docs[doc_id] = _Doc(entity, fields)
+        for gram in self._doc_grams(fields):
+            self._grams.setdefault(gram, set()).add(doc_id)
+        for prefix in self._doc_prefixes(fields):
+            self._prefixes.setdefault(prefix, set()).add(doc_id)
+
+    def _remove(self, source: Tuple[str, str]) -> None:
+        doc_id = self._ids.pop(source, None)
+        if doc_id is None:
+            return
+        doc = self._docs.pop(doc_id)
+        for index, keys in ((self._grams, self._doc_grams(doc.fields)), (self._prefixes, self._doc_prefixes(doc.fields))):
+            for key in keys:
+                postings = index.get(key)
+                if postings is not None:
+                    postings.discard(doc_id)
+                    if not postings:
+                        del index[key]
+
+    @staticmethod
+    def _doc_grams(fields: Iterable[Tuple[str, str]]) -> Set[str]:
+        return set().union(*(_trigrams(text) for _, text in fields))
+
+    @staticmethod
+    def _doc_prefixes(fields: Iterable[Tuple[str, str]]) -> Set[str]:
+        # جستجوی یکی دو حرفی روی UUID بی‌معنی است و فقط هزاران نتیجه اضافه می‌کند
+        return {token[:n] for kind, text in fields if kind != 'uuid' for token in _tokens(text) for n in (1, 2)}
+
+    # ------------------------------------------------------------------
+    # جستجو
+    # ------------------------------------------------------------------
+    def is_ready(self) -> bool:
+        now = time.monotonic()
+        return all(now - self._synced_at.get(p, float('-inf')) <= self.max_age for p in ('hiddify', 'marzban'))
+
+    def search(self, query: str, limit: int = SEARCH_RESULT_LIMIT) -> Optional[List[Tuple[Optional[Dict], Optional[Dict]]]]:
+        """
+        نتایج رتبه‌بندی‌شده به صورت (رکورد هیدیفای، رکورد مرزبان) برای هر کاربر.
+        اگر ایندکس هنوز ساخته نشده یا قدیمی است None برمی‌گرداند.
+        """
+        q = normalize(query)
+        if not self.is_ready():
+            return None
+        if not q:
+            return []
+
+        with self._lock:
+            if len(q) >= 3:
+                postings = sorted((self._grams.get(g) or set() for g in _trigrams(q)), key=len)
+                candidates = postings[0].intersection(*postings[1:]) if postings[0] else set()
+            else:
+                candidates = self._prefixes.get(q, set())
+
+            word_start = re.compile(r"(?:^|[\s\-_.@/])" + re.escape(q))
+            scores: Dict[str, float] = {}
+            for doc_id in candidates:
+                doc = self._docs[doc_id]
+                score = max((self._score(q, word_start, FIELD_WEIGHTS[kind], text) for kind, text in doc.fields), default=0)
+                if score > scores.get(doc.entity, 0):
+                    scores[doc.entity] = score
+
+            results = []
+            for entity in sorted(scores, key=lambda e: (-scores[e], self._sort_name(e))):
+                h_info = self._records['hiddify'].get(entity)
+                m_info = self._records['marzban'].get(entity)
+                if h_info or m_info:
+                    results.append((h_info, m_info))
+                    if len(results) >= limit:
+                        break
+            return results
+
+    @staticmethod
+    def _score(q: str, word_start: re.Pattern, weight: float, text: str) -> float:
+        """تطابق کامل > ابتدای فیلد > ابتدای یک کلمه > هر جای متن."""
+        if q not in text:
+            return 0
+        if text == q:
+            return weight * 4
+        if text.startswith(q):
+            return weight * 3
+        if word_start.search(text):
+            return weight * 2
+        return weight
+
+    def _sort_name(self, entity: str) -> str:
+        user = self._records['hiddify'].get(entity) or self._records['marzban'].get(entity) or {}
+        return normalize(user.get('name'))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'documents': len(self._docs), 'trigrams': len(self._grams), 'prefixes': len(self._prefixes),
+                'ready': self.is_ready(),
+            }
+
+
+search_index = panel_sync.subscribe(SearchIndex())
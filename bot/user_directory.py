@@ -0,0 +1,150 @@
+"""
+UserDirectory: کاربران ترکیبی هر دو پنل به همراه اطلاعات ربات (user_uuids و users)، با ایندکس‌های
+آماده بر اساس UUID، نام کانفیگ، نام کاربری مرزبان، شناسه تلگرام و uuid_id.
+
+get_user_directory() برای هر generation همگام‌سازی پنل‌ها (panel_sync_state) فقط یک بار
+ساخته می‌شود و همه کارهای scheduler، گزارش‌ها و داشبورد وب‌اپ همان نمونه را به اشتراک می‌گذارند.
+اگر کپی محلی قدیمی باشد و داده زنده خوانده شود، نمونه ساخته‌شده تا PANEL_CACHE_TTL ثانیه استفاده می‌شود.
+
+رکوردهای داخل آن مشترک‌اند و نباید تغییر کنند؛ کدی که فیلدی به کاربر اضافه می‌کند (مثل
+daily_usage_gb) باید با fork() یک کپی سبک بگیرد.
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import combined_handler
+from .config import PANEL_CACHE_TTL, PANEL_MIRROR_MAX_AGE
+from .database import read_db
+from .presence import PresenceIndex
+
+logger = logging.getLogger(__name__)
+
+
+def user_key(user: Dict[str, Any]) -> Optional[str]:
+    """کلید یکتای کاربر ترکیبی؛ همان کلیدی که combined_handler برای ترکیب دو پنل استفاده می‌کند."""
+    if user.get('uuid'):
+        return user['uuid']
+    return f"marzban_{user['name']}" if user.get('name') else None
+
+
+class UserDirectory:
+    def __init__(self, users: combined_handler.CombinedUsers, uuid_rows: List[Dict[str, Any]],
+                 bot_users: Dict[str, Dict[str, Any]], generation: Optional[Tuple[int, int]] = None):
+        self.users = users
+        self.generation = generation
+        self.built_at = time.monotonic()
+        # uuid -> ردیف users (user_id، first_name، username) برای UUID های فعال
+        self.bot_users = bot_users
+        self._presence: Dict[Optional[str], PresenceIndex] = {}
+
+        self.by_uuid: Dict[str, Dict[str, Any]] = {}
+        self.by_key: Dict[str, Dict[str, Any]] = {}
+        self.by_name: Dict[str, Dict[str, Any]] = {}
+        self.by_marzban_username: Dict[str, Dict[str, Any]] = {}
+        for user in users:
+            if user.get('uuid'):
+                self.by_uuid[user['uuid']] = user
+            self.by_name[user.get('name')] = user
+            key = user_key(user)
+            if key:
+                self.by_key[key] = user
+            marzban_info = user.get('breakdown', {}).get('marzban')
+            if marzban_info and marzban_info.get('username'):
+                self.by_marzban_username[marzban_info['username']] = user
+
+        # uuid_rows به ترتیب created_at نزولی است (get_all_user_uuids)
+        self.uuid_row_by_id: Dict[int, Dict[str, Any]] = {}
+        self.uuid_row_by_uuid: Dict[str, Dict[str, Any]] = {}
+        self._rows_by_user_id: Dict[int, List[Dict[str, Any]]] = {}
+        for row in uuid_rows:
+            self.uuid_row_by_id[row['id']] = row
+            self.uuid_row_by_uuid[row['uuid']] = row
+            self._rows_by_user_id.setdefault(row['user_id'], []).append(row)
+        for rows in self._rows_by_user_id.values():
+            rows.reverse()
+
+    @classmethod
+    def build(cls, users: combined_handler.CombinedUsers, generation: Optional[Tuple[int, int]] = None) -> 'UserDirectory':
+        return cls(users, read_db.get_all_user_uuids(), read_db.get_uuid_to_bot_user_map(), generation)
+
+    def get(self, uuid: Optional[str]) -> Optional[Dict[str, Any]]:
+        return self.by_uuid.get(uuid)
+
+    def uuid_rows_of(self, user_id: int, active_only: bool = True) -> List[Dict[str, Any]]:
+        """ردیف‌های user_uuids یک کاربر تلگرام به ترتیب created_at (مثل db.uuids)."""
+        rows = self._rows_by_user_id.get(user_id, [])
+        return [row for row in rows if row['is_active']] if active_only else list(rows)
+
+    def users_of(self, user_id: int) -> List[Dict[str, Any]]:
+        """اطلاعات ترکیبی اکانت‌های فعال یک کاربر تلگرام که روی پنل‌ها پیدا شده‌اند."""
+        return [self.by_uuid[row['uuid']] for row in self.uuid_rows_of(user_id) if row['uuid'] in self.by_uuid]
+
+    def get_by_uuid_id(self, uuid_id: int) -> Optional[Dict[str, Any]]:
+        """اطلاعات ترکیبی اکانت بر اساس id ردیف user_uuids."""
+        row = self.uuid_row_by_id.get(uuid_id)
+        return self.by_uuid.get(row['uuid']) if row else None
+
+    def presence(self, panel: Optional[str] = None) -> PresenceIndex:
+        """
+        PresenceIndex کاربران بر اساس آخرین اتصال ترکیبی، یا با panel فقط کاربران آن پنل بر اساس
+        last_online همان پنل. آیتم‌ها در هر دو حالت کاربران ترکیبی هستند.
+        """
+        index = self._presence.get(panel)
+        if index is None:
+            if panel:
+                entries = ((user['breakdown'][panel].get('last_online'), user)
+                           for user in self.users if user.get('breakdown', {}).get(panel))
+            else:
+                entries = ((user.get('last_online'), user) for user in self.users)
+            index = self._presence[panel] = PresenceIndex(entries)
+        return index
+
+    def telegram_id(self, uuid: Optional[str]) -> Optional[int]:
+        bot_user = self.bot_users.get(uuid)
+        return bot_user.get('user_id') if bot_user else None
+
+
+_lock = threading.Lock()
+_directory: Optional[UserDirectory] = None
+
+
+def _mirror_generation(max_age: float) -> Optional[Tuple[int, int]]:
+    """generation فعلی هر دو پنل، یا None اگر کپی محلی قدیمی‌تر از max_age یا در دسترس نباشد."""
+    try:
+        state = read_db.get_panel_sync_state()
+    except Exception as e:
+        logger.warning(f"USER_DIRECTORY: Reading panel sync state failed: {e}")
+        return None
+    now = time.time()
+    generations = []
+    for panel in ('hiddify', 'marzban'):
+        panel_state = state.get(panel) or {}
+        if not panel_state.get('synced_at') or now - panel_state['synced_at'] > max_age:
+            return None
+        generations.append(panel_state['generation'])
+    return tuple(generations)
+
+
+def get_user_directory(max_age: float = PANEL_MIRROR_MAX_AGE, live_max_age: Optional[float] = None) -> UserDirectory:
+    """
+    UserDirectory مربوط به آخرین همگام‌سازی. فقط وقتی generation یکی از پنل‌ها عوض شده باشد
+    دوباره ساخته می‌شود؛ فراخوانی‌های همزمان منتظر همان یک ساخت می‌مانند.
+    """
+    global _directory
+    generation = _mirror_generation(max_age)
+    with _lock:
+        directory = _directory
+        if directory is not None and directory.generation == generation and (
+                generation is not None or time.monotonic() - directory.built_at < PANEL_CACHE_TTL):
+            return directory
+
+        started = time.monotonic()
+        directory = UserDirectory.build(combined_handler.get_all_users_mirrored(max_age, live_max_age), generation)
+        # داده ناقص (یکی از پنل‌ها پاسخ نداده) برای بقیه نگه داشته نمی‌شود
+        if not directory.users.partial:
+            _directory = directory
+        logger.info(f"USER_DIRECTORY: Built for generation {generation} with {len(directory.users)} users "
+                    f"in {time.monotonic() - started:.2f}s.")
+        return directory
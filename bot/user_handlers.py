@@ -86,8 +86,8 @@ def _show_manage_menu(call: types.CallbackQuery):
     user_uuids_from_db = db.uuids(uid)
     
     user_accounts_details = []
-    for row in user_uuids_from_db:
-        info = combined_handler.get_combined_user_info(row["uuid"])
+    infos = combined_handler.get_combined_user_infos([row["uuid"] for row in user_uuids_from_db])
+    for row, info in zip(user_uuids_from_db, infos):
         if info:
             info['id'] = row['id']
             user_accounts_details.append(info)
@@ -22,14 +22,23 @@ def initialize_utils(b_instance):
 
 PERSIAN_MONTHS = { "Farvardin": "فروردین", "Ordibehesht": "اردیبهشت", "Khordad": "خرداد", "Tir": "تیر", "Mordad": "مرداد", "Shahrivar": "شهریور", "Mehr": "مهر", "Aban": "آبان", "Azar": "آذر", "Dey": "دی", "Bahman": "بهمن", "Esfand": "اسفند" }
 
-def to_shamsi(dt: Optional[Union[datetime, date, str]], include_time: bool = False) -> str:
-    """تابع جامع برای تبدیل تاریخ میلادی (datetime, date یا str) به شمسی."""
+def epoch_to_datetime(ts: Optional[Union[int, float]]) -> Optional[datetime]:
+    """زمان epoch ذخیره‌شده در دیتابیس (ثانیه، UTC) را به datetime آگاه از منطقه زمانی تبدیل می‌کند."""
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts, tz=pytz.utc)
+
+def to_shamsi(dt: Optional[Union[datetime, date, str, int, float]], include_time: bool = False) -> str:
+    """تابع جامع برای تبدیل تاریخ میلادی (datetime, date, str یا epoch) به شمسی."""
     if not dt:
         return "نامشخص"
     import jdatetime
     from datetime import datetime, date
     import re
     try:
+        # اگر epoch عددی از دیتابیس هست
+        if isinstance(dt, (int, float)) and not isinstance(dt, bool):
+            dt = epoch_to_datetime(dt)
         # اگر تاریخ شمسی هست
         if isinstance(dt, jdatetime.datetime):
             if include_time:
@@ -87,8 +96,13 @@ def to_shamsi(dt: Optional[Union[datetime, date, str]], include_time: bool = Fal
 
 
 
-def format_relative_time(dt: Optional[datetime]) -> str:
-    """یک شیء datetime را به زمان نسبی خوانا تبدیل می‌کند."""
+def format_shamsi_tehran(dt: Optional[Union[datetime, int, float]]) -> str:
+    """تاریخ و ساعت شمسی به وقت تهران، به شکل YYYY/MM/DD HH:MM."""
+    return to_shamsi(dt, include_time=True)
+
+def format_relative_time(dt: Optional[Union[datetime, int, float]]) -> str:
+    """یک شیء datetime یا epoch را به زمان نسبی خوانا تبدیل می‌کند."""
+    if isinstance(dt, (int, float)) and not isinstance(dt, bool): dt = epoch_to_datetime(dt)
     if not dt or not isinstance(dt, datetime): return "هرگز"
     now = datetime.now(pytz.utc); dt_utc = dt if dt.tzinfo else pytz.utc.localize(dt)
     delta = now - dt_utc; seconds = delta.total_seconds()
@@ -131,12 +145,11 @@ def load_json_file(file_name: str) -> dict | list:
 # ==============================================================================
 # تابع اصلاح شده و هوشمند
 # ==============================================================================
+SERVICE_PLANS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plans.json')
+
 def load_service_plans():
+    json_path = SERVICE_PLANS_PATH
     try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        project_root = os.path.dirname(script_dir)
-        json_path = os.path.join(script_dir, 'plans.json')
-        
         with open(json_path, 'r', encoding='utf-8') as f:
             return json.load(f)
     except FileNotFoundError:
@@ -228,17 +241,16 @@ def get_processed_user_data(uuid: str) -> Optional[dict]:
     processed_info['last_online_relative'] = format_relative_time(info.get('last_online'))
     
     # پردازش جزئیات هر پنل با استفاده از تابع to_shamsi
+    daily_usage = db.get_usage_since_midnight_by_uuid(uuid) if processed_info['on_hiddify'] or processed_info['on_marzban'] else {}
     if processed_info['on_hiddify']:
         h_info = breakdown['hiddify']
         h_info['last_online_shamsi'] = to_shamsi(h_info.get('last_online'), include_time=True)
-        daily_usage_h = db.get_usage_since_midnight_by_uuid(uuid).get('hiddify', 0.0)
-        h_info['daily_usage_formatted'] = format_usage(daily_usage_h)
+        h_info['daily_usage_formatted'] = format_usage(daily_usage.get('hiddify', 0.0))
 
     if processed_info['on_marzban']:
         m_info = breakdown['marzban']
         m_info['last_online_shamsi'] = to_shamsi(m_info.get('last_online'), include_time=True)
-        daily_usage_m = db.get_usage_since_midnight_by_uuid(uuid).get('marzban', 0.0)
-        m_info['daily_usage_formatted'] = format_usage(daily_usage_m)
+        m_info['daily_usage_formatted'] = format_usage(daily_usage.get('marzban', 0.0))
 
     # تبدیل روزهای انقضا به تاریخ شمسی
     expire_days = info.get('expire')
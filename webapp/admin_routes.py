@@ -2,7 +2,8 @@ from flask import Blueprint, render_template, request, abort, jsonify
 from functools import wraps
 import logging
 from bot.config import ADMIN_SECRET_KEY
-from bot.database import db
+from bot.database import read_db
+from bot.panel_cache import cache_stats
 
 from .services import (
     get_dashboard_data,
@@ -50,6 +51,12 @@ def comprehensive_report_page():
         logger.error(f"Failed to generate comprehensive report: {e}", exc_info=True)
         return render_template('admin_error.html', error_message="خطا در تولید گزارش جامع.", is_admin=True)
 
+@admin_bp.route('/api/cache-stats')
+@admin_required
+def cache_stats_api():
+    """شمارنده‌های کش لیست کاربران پنل‌ها (hit/miss/stale و زمان refresh)."""
+    return jsonify(cache_stats())
+
 # --- بخش مدیریت کاربران ---
 @admin_bp.route('/users')
 @admin_required
@@ -101,7 +108,7 @@ def delete_user_api(uuid):
 @admin_bp.route('/templates')
 @admin_required
 def manage_templates_page():
-    templates = db.get_all_config_templates()
+    templates = read_db.get_all_config_templates()
     return render_template('admin_templates.html', templates=templates, is_admin=True)
 
 @admin_bp.route('/api/templates', methods=['POST'])
@@ -1,10 +1,13 @@
+import time
 from datetime import datetime, timedelta
 import pytz
-from bot.database import db
+from bot.database import db, read_db
 from bot.hiddify_api_handler import hiddify_handler
 from bot.marzban_api_handler import marzban_handler
-from bot.combined_handler import get_all_users_combined, get_combined_user_info
-from bot.utils import to_shamsi, format_relative_time, format_usage, days_until_next_birthday
+from bot.combined_handler import get_combined_user_info, invalidate_user_info
+from bot.user_directory import get_user_directory, user_key
+from bot.config import PANEL_CACHE_WEBAPP_MAX_AGE
+from bot.utils import to_shamsi, format_relative_time, format_usage, days_until_next_birthday, epoch_to_datetime
 import logging
 
 logger = logging.getLogger(__name__)
@@ -30,7 +33,7 @@ def _check_system_health():
     return health
 
 
-def _process_user_data(all_users_data):
+def _process_user_data(all_users_data, directory):
     """
     داده‌های کاربران را پردازش کرده و آمار و لیست‌های مورد نیاز برای داشبورد را استخراج می‌کند.
     این نسخه بهبود یافته، کاربران روی هر دو پنل را نیز تفکیک می‌کند.
@@ -41,11 +44,15 @@ def _process_user_data(all_users_data):
         "hiddify_only_active": 0, "marzban_only_active": 0, "both_panels_active": 0
     }
     expiring_soon_users, online_users_hiddify, online_users_marzban = [], [], []
-    db_users_map = {u['uuid']: u for u in db.get_all_user_uuids()}
+    db_users_map = directory.uuid_row_by_uuid
     now_utc = datetime.now(pytz.utc)
+    # آنلاین بودن در هر پنل از PresenceIndex همان generation؛ all_users_data کپی (fork) کاربران است
+    online_keys = {panel: {user_key(u) for u in directory.presence(panel).online()} for panel in ('hiddify', 'marzban')}
+    # مصرف امروز همه UUID ها با یک کوئری
+    daily_usage_map = read_db.get_all_daily_usage_since_midnight()
 
     for user in all_users_data:
-        daily_usage = db.get_usage_since_midnight_by_uuid(user.get('uuid', ''))
+        daily_usage = daily_usage_map.get(user.get('uuid'), {})
         user['daily_usage_gb'] = sum(daily_usage.values())
         stats['total_usage_today_gb'] += user['daily_usage_gb']
 
@@ -62,16 +69,11 @@ def _process_user_data(all_users_data):
                 stats['both_panels_active'] += 1
 
         is_online_in_any_panel = False
+        key = user_key(user)
         for panel_name, online_list in [('hiddify', online_users_hiddify), ('marzban', online_users_marzban)]:
-            panel_info = user.get('breakdown', {}).get(panel_name, {})
-            if panel_info:
-                last_online = panel_info.get('last_online')
-                if last_online and isinstance(last_online, datetime):
-                    last_online_aware = last_online if last_online.tzinfo else pytz.utc.localize(last_online)
-                    if (now_utc - last_online_aware).total_seconds() < 180:
-                        if not any(u['uuid'] == user['uuid'] for u in online_list):
-                            online_list.append(user)
-                        is_online_in_any_panel = True
+            if key in online_keys[panel_name]:
+                online_list.append(user)
+                is_online_in_any_panel = True
 
         if is_online_in_any_panel:
             stats['online_users'] += 1
@@ -83,8 +85,7 @@ def _process_user_data(all_users_data):
 
         db_user = db_users_map.get(user.get('uuid'))
         if db_user and db_user.get('created_at'):
-            created_at_dt = db_user['created_at']
-            if created_at_dt.tzinfo is None: created_at_dt = pytz.utc.localize(created_at_dt)
+            created_at_dt = epoch_to_datetime(db_user['created_at'])
             if (now_utc - created_at_dt).days < 1: stats['new_users_today'] += 1
             user['created_at'] = created_at_dt
 
@@ -112,14 +113,16 @@ def get_dashboard_data():
     }
 
     try:
-        all_users_data = get_all_users_combined()
+        directory = get_user_directory(live_max_age=PANEL_CACHE_WEBAPP_MAX_AGE)
+        # رکوردهای directory بین درخواست‌ها مشترک‌اند؛ daily_usage_gb و created_at روی کپی نوشته می‌شوند
+        all_users_data = [user.fork() for user in directory.users]
     except Exception as e:
         logger.error(f"Failed to get combined user data: {e}", exc_info=True)
-        all_users_data = []
+        directory, all_users_data = None, []
 
     try:
         # فراخوانی تابع جدید برای دریافت آمار مصرف روزانه
-        daily_usage_summary = db.get_daily_usage_summary(days=7)
+        daily_usage_summary = read_db.get_daily_usage_summary(days=7)
     except Exception as e:
         logger.error(f"Failed to get daily usage summary: {e}", exc_info=True)
         daily_usage_summary = []
@@ -156,7 +159,7 @@ def get_dashboard_data():
         }
 
     # پردازش داده‌های کاربران موجود
-    stats, expiring_soon_users, online_users_hiddify, online_users_marzban = _process_user_data(all_users_data)
+    stats, expiring_soon_users, online_users_hiddify, online_users_marzban = _process_user_data(all_users_data, directory)
 
     # تبدیل آمار مصرف روزانه به فرمت قابل نمایش
     stats['total_usage_today'] = f"{stats['total_usage_today_gb']:.2f} GB"
@@ -224,12 +227,14 @@ def get_dashboard_data():
 # ===================================================================
 def generate_comprehensive_report_data():
     logger.info("Starting comprehensive report generation...")
-    all_users_data = get_all_users_combined()
-    daily_usage_map = db.get_all_daily_usage_since_midnight()
-    user_panel_info_map = { u.get('uuid'): {'on_hiddify': u.get('on_hiddify', False), 'on_marzban': u.get('on_marzban', False)} for u in all_users_data if u.get('uuid') }
-    now_utc = datetime.now(pytz.utc)
+    directory = get_user_directory(live_max_age=PANEL_CACHE_WEBAPP_MAX_AGE)
+    # کپی (fork) هر کاربر برای افزودن panel_display و last_online_relative؛ بخش‌ها از PresenceIndex می‌آیند
+    forks = {id(user): user.fork() for user in directory.users}
+    all_users_data = list(forks.values())
+    daily_usage_map = read_db.get_all_daily_usage_since_midnight()
+    user_panel_info_map = directory.by_uuid
     summary = { "total_users": len(all_users_data), "active_users": 0, "total_de": 0, "total_fr": 0, "active_de": 0, "active_fr": 0, "online_users": 0, "usage_de_gb": 0, "usage_fr_gb": 0 }
-    online_users, active_last_24h, inactive_1_to_7_days, never_connected, expiring_soon_users = set(), [], [], [], []
+    expiring_soon_users = []
     
     for user in all_users_data:
         uuid = user.get('uuid')
@@ -244,26 +249,28 @@ def generate_comprehensive_report_data():
             if user.get('on_hiddify'): summary['active_de'] += 1
             if user.get('on_marzban'): summary['active_fr'] += 1
         if user.get('expire') is not None and 0 <= user.get('expire') <= 7: expiring_soon_users.append(user)
-        last_online = user.get('last_online')
-        if last_online:
-            if last_online >= (now_utc - timedelta(minutes=3)): online_users.add(uuid)
-            if last_online >= (now_utc - timedelta(hours=24)): user['last_online_relative'] = format_relative_time(last_online); active_last_24h.append(user)
-            elif (now_utc - timedelta(days=7)) <= last_online < (now_utc - timedelta(days=1)): user['last_online_relative'] = format_relative_time(last_online); inactive_1_to_7_days.append(user)
-        else: never_connected.append(user)
+
+    presence = directory.presence()
+    now_ts = time.time()
+    online_users = presence.online(now_ts)
+    active_last_24h = [forks[id(u)] for u in presence.active(now_ts)]
+    inactive_1_to_7_days = [forks[id(u)] for u in presence.inactive(now_ts)]
+    never_connected = [forks[id(u)] for u in presence.never_connected()]
+    for user in active_last_24h + inactive_1_to_7_days:
+        user['last_online_relative'] = format_relative_time(user.get('last_online'))
 
     summary['online_users'] = len(online_users); summary['total_usage'] = f"{(summary['usage_de_gb'] + summary['usage_fr_gb']):.2f} GB"
     top_consumers = sorted([u for u in all_users_data if u.get('usage', {}).get('data_limit_GB', 0) > 0], key=lambda u: u.get('usage', {}).get('total_usage_GB', 0), reverse=True)[:10]
-    users_with_payments = db.get_payment_history()
-    uuid_by_configname = {u.get('name'): u.get('uuid') for u in all_users_data}
+    users_with_payments = read_db.get_payment_history()
     for p in users_with_payments:
-        uuid = uuid_by_configname.get(p['config_name']); panel_info = user_panel_info_map.get(uuid, {}); panels = []
+        uuid = directory.by_name.get(p['config_name'], {}).get('uuid'); panel_info = user_panel_info_map.get(uuid, {}); panels = []
         if panel_info.get('on_hiddify'): panels.append('🇩🇪')
         if panel_info.get('on_marzban'): panels.append('🇫🇷')
         p['panel_display'] = ' '.join(panels) if panels else '?'
-    users_with_birthdays = db.get_users_with_birthdays()
-    uuid_by_userid = {u['user_id']: u['uuid'] for u in db.get_all_user_uuids()}
+    users_with_birthdays = read_db.get_users_with_birthdays()
     for b in users_with_birthdays:
-        uuid = uuid_by_userid.get(b['user_id']); panel_info = user_panel_info_map.get(uuid, {}); panels = []
+        rows = directory.uuid_rows_of(b['user_id'], active_only=False)
+        uuid = rows[0]['uuid'] if rows else None; panel_info = user_panel_info_map.get(uuid, {}); panels = []
         if panel_info.get('on_hiddify'): panels.append('🇩🇪')
         if panel_info.get('on_marzban'): panels.append('🇫🇷')
         b['panel_display'] = ' '.join(panels) if panels else '?'
@@ -277,7 +284,7 @@ def generate_comprehensive_report_data():
             b['days_remaining'] = days_until_next_birthday(b['birthday'])
 
     
-    return { "summary": summary, "active_last_24h": sorted(active_last_24h, key=lambda u: u.get('last_online'), reverse=True), "inactive_1_to_7_days": sorted(inactive_1_to_7_days, key=lambda u: u.get('last_online'), reverse=True), "never_connected": sorted(never_connected, key=lambda u: u.get('name', '').lower()), "top_consumers": top_consumers, "expiring_soon_users": sorted(expiring_soon_users, key=lambda u: u.get('expire', 999)), "bot_users": db.get_all_bot_users(), "users_with_payments": users_with_payments, "users_with_birthdays": sorted(users_with_birthdays, key=lambda u: u.get('days_remaining', 999)), "today_shamsi": to_shamsi(datetime.now()) }
+    return { "summary": summary, "active_last_24h": sorted(active_last_24h, key=lambda u: u.get('last_online'), reverse=True), "inactive_1_to_7_days": sorted(inactive_1_to_7_days, key=lambda u: u.get('last_online'), reverse=True), "never_connected": sorted(never_connected, key=lambda u: u.get('name', '').lower()), "top_consumers": top_consumers, "expiring_soon_users": sorted(expiring_soon_users, key=lambda u: u.get('expire', 999)), "bot_users": read_db.get_all_bot_users(), "users_with_payments": users_with_payments, "users_with_birthdays": sorted(users_with_birthdays, key=lambda u: u.get('days_remaining', 999)), "today_shamsi": to_shamsi(datetime.now()) }
 
 # ===================================================================
 # == سرویس مدیریت کاربران ==
@@ -286,18 +293,20 @@ def get_paginated_users(args: dict):
     page = args.get('page', 1, type=int); per_page = args.get('per_page', 15, type=int)
     search_query = args.get('search', '', type=str).lower()
     logger.info(f"Fetching paginated users. Page: {page}, Query: '{search_query}'")
-    all_users_data = get_all_users_combined()
-    for user in all_users_data:
+    all_users_data = get_user_directory(live_max_age=PANEL_CACHE_WEBAPP_MAX_AGE).users
+    filtered_users = [u for u in all_users_data if search_query in (u.get('name') or '').lower() or search_query in (u.get('uuid') or '').lower()] if search_query else list(all_users_data)
+    filtered_users.sort(key=lambda u: (u.get('name') or '').lower())
+    total_items = len(filtered_users)
+    # فقط کاربران همین صفحه تبدیل و تکمیل می‌شوند؛ رکوردهای directory دست نمی‌خورند
+    paginated_users = [u.to_dict() for u in filtered_users[(page - 1) * per_page : page * per_page]]
+    daily_usage_map = read_db.get_all_daily_usage_since_midnight() if paginated_users else {}
+    for user in paginated_users:
         if user.get('uuid'):
-            daily_usage = db.get_usage_since_midnight_by_uuid(user.get('uuid'));
+            daily_usage = daily_usage_map.get(user.get('uuid'), {})
             if user.get('on_hiddify'): user.setdefault('breakdown', {}).setdefault('hiddify', {})['daily_usage_formatted'] = format_usage(daily_usage.get('hiddify', 0))
             if user.get('on_marzban'): user.setdefault('breakdown', {}).setdefault('marzban', {})['daily_usage_formatted'] = format_usage(daily_usage.get('marzban', 0))
         if user.get('expire') is not None and user.get('expire') >= 0: user['expire_shamsi'] = to_shamsi(datetime.now() + timedelta(days=user.get('expire')))
         user['last_online_relative'] = format_relative_time(user.get('last_online'))
-    filtered_users = [u for u in all_users_data if search_query in (u.get('name') or '').lower() or search_query in (u.get('uuid') or '').lower()] if search_query else all_users_data
-    filtered_users.sort(key=lambda u: (u.get('name') or '').lower())
-    total_items = len(filtered_users)
-    paginated_users = filtered_users[(page - 1) * per_page : page * per_page]
     return { "users": paginated_users, "pagination": {"page": page, "per_page": per_page, "total_items": total_items, "total_pages": (total_items + per_page - 1) // per_page} }
 
 def create_user_in_panel(data: dict):
@@ -315,6 +324,7 @@ def create_user_in_panel(data: dict):
         logger.error(f"Failed to create user in panel '{panel}'. API Response: {error_detail}")
         raise Exception(error_detail)
 
+    invalidate_user_info(result.get('uuid'), result.get('username'), data.get('name'))
     logger.info(f"Successfully created user in '{panel}'. Result: {result}")
     return result
 
@@ -340,6 +350,7 @@ def update_user_in_panels(data: dict):
     elif 'common_name' in data and 'h_usage_limit_GB' not in data:
          hiddify_handler.modify_user(uuid, {'name': data.get('common_name')})
 
+    invalidate_user_info(uuid)
     logger.info(f"Update process finished for user UUID: {uuid}")
     return True
 
@@ -355,6 +366,7 @@ def delete_user_from_panels(uuid: str):
     if user_info.get('on_marzban'):
         username = user_info.get('breakdown', {}).get('marzban', {}).get('username')
         if username: marzban_handler.delete_user(username)
+    invalidate_user_info(uuid, user_info.get('name'))
 
     logger.info(f"Deleting user record for UUID '{uuid}' from the local database.")
     db.delete_user_by_uuid(uuid)
@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, abort, request, Response, url_for
 from bot.utils import load_json_file, generate_user_subscription_configs
 from bot.config import ADMIN_SUPPORT_CONTACT
-from bot.database import db
+from bot.database import read_db
 from .user_service import user_service
 import base64
 import urllib.parse
@@ -77,10 +77,10 @@ def usage_chart_page(uuid):
     
     chart_data = {"series": [], "categories": []}
     try:
-        uuid_id = db.get_uuid_id_by_uuid(uuid)
+        uuid_id = read_db.get_uuid_id_by_uuid(uuid)
         if uuid_id:
-            h_usage = db.get_panel_usage_in_intervals(uuid_id, 'hiddify_usage_gb')
-            m_usage = db.get_panel_usage_in_intervals(uuid_id, 'marzban_usage_gb')
+            interval_usage = read_db.get_usage_in_intervals(uuid_id)
+            h_usage, m_usage = interval_usage['hiddify'], interval_usage['marzban']
             h_data = [float(h_usage.get(h, 0)) for h in [24, 12, 6, 3]]
             m_data = [float(m_usage.get(h, 0)) for h in [24, 12, 6, 3]]
             chart_data = {
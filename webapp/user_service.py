@@ -1,6 +1,6 @@
 from datetime import datetime, timedelta
 import pytz
-from bot.database import db
+from bot.database import read_db
 from bot.combined_handler import get_combined_user_info
 from bot.utils import to_shamsi, format_relative_time, days_until_next_birthday
 import logging
@@ -12,27 +12,16 @@ class UserService:
     
     @staticmethod
     def get_user_usage_stats(uuid_id):
-        tehran_tz = pytz.timezone("Asia/Tehran")
         labels, hiddify_data, marzban_data = [], [], []
         total_usage_7_days = 0
         
-        with db._conn() as c:
-            for i in range(6, -1, -1):
-                target_date = datetime.now(tehran_tz) - timedelta(days=i)
-                day_start = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                day_end = day_start + timedelta(days=1)
-                day_start_utc, day_end_utc = day_start.astimezone(pytz.utc), day_end.astimezone(pytz.utc)
-                
-                query = "SELECT (MAX(hiddify_usage_gb) - MIN(hiddify_usage_gb)) as h, (MAX(marzban_usage_gb) - MIN(marzban_usage_gb)) as m FROM usage_snapshots WHERE uuid_id = ? AND taken_at >= ? AND taken_at < ?"
-                row = c.execute(query, (uuid_id, day_start_utc, day_end_utc)).fetchone()
-                
-                h_usage = max(0, row['h'] or 0) if row else 0
-                m_usage = max(0, row['m'] or 0) if row else 0
-                
-                labels.append(day_start.strftime('%m/%d'))
-                hiddify_data.append(round(h_usage, 2))
-                marzban_data.append(round(m_usage, 2))
-                total_usage_7_days += h_usage + m_usage
+        for day in read_db.get_user_daily_usage(uuid_id, days=7):
+            h_usage, m_usage = day['hiddify'], day['marzban']
+            
+            labels.append(datetime.strptime(day['date'], '%Y-%m-%d').strftime('%m/%d'))
+            hiddify_data.append(round(h_usage, 2))
+            marzban_data.append(round(m_usage, 2))
+            total_usage_7_days += h_usage + m_usage
         
         avg_daily_usage = total_usage_7_days / 7 if total_usage_7_days > 0 else 0
         chart_data = {"labels": labels, "hiddify_data": hiddify_data, "marzban_data": marzban_data}
@@ -95,11 +84,11 @@ class UserService:
     @staticmethod
     def get_processed_user_data(uuid):
         try:
-            uuid_record = db.get_user_uuid_record(uuid)
+            uuid_record = read_db.get_user_uuid_record(uuid)
             if not uuid_record: return None
             
             uuid_id = uuid_record['id']
-            user_basic = db.user(uuid_record.get('user_id')) or {}
+            user_basic = read_db.user(uuid_record.get('user_id')) or {}
             combined_info = get_combined_user_info(uuid) or {}
             
             expire_days = combined_info.get('expire')
@@ -108,7 +97,7 @@ class UserService:
             usage_limit = combined_info.get('usage', {}).get('data_limit_GB', 50)
             usage_percentage = (current_usage / usage_limit * 100) if usage_limit > 0 else 0
             
-            usage_today = db.get_usage_since_midnight_by_uuid(uuid)
+            usage_today = read_db.get_usage_since_midnight_by_uuid(uuid)
             chart_data, avg_daily_usage = UserService.get_user_usage_stats(uuid_id)
             
             is_active = uuid_record.get("is_active", 0) == 1